@@ -18,6 +18,8 @@ class VisynPlugin(AVisynPlugin):
         registry.append("tdp-sql-database-definition", "cohortdb", "coral.db", {"configKey": "coral"})
 
         registry.append("namespace", "db_connector", "coral.sql", {"namespace": "/api/cohortdb/db"})
+        # async implementation of the read only cohort routes (/api/cohortdb/async), requires asyncpg
+        registry.append("fastapi_router", "coral_async", "coral.sql_async", {})
 
         registry.append(
             "tdp-sql-database-migration",
@@ -14,6 +14,8 @@ columns["cohort"] = [
     ["entity_schema", "text"],
     ["entity_table", "text"],
     ["statement", "text"],
+    ["filters", "text"],
+    ["size", "number"],
 ]
 
 # columns['cohort_entity'] = [
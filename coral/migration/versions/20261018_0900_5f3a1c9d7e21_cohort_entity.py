@@ -0,0 +1,35 @@
+"""Create cohort_entity table to store the membership of cohorts
+
+Revision ID: 5f3a1c9d7e21
+Revises: ddd776aa28c3
+Create Date: 2026-10-18 09:00:12.318274
+
+"""
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "5f3a1c9d7e21"
+down_revision = "ddd776aa28c3"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    connection = op.get_bind()
+    for cmd in [
+        """
+CREATE TABLE IF NOT EXISTS cohort.cohort_entity
+(
+    cohort_id integer NOT NULL,
+    entity_id character varying COLLATE pg_catalog."default" NOT NULL,
+    CONSTRAINT cohort_entity_pkey PRIMARY KEY (cohort_id, entity_id),
+    CONSTRAINT cohort_entity_cohort_id_fkey FOREIGN KEY (cohort_id) REFERENCES cohort.cohort (id) ON DELETE CASCADE
+);
+""",
+    ]:
+        connection.execute(cmd)
+
+
+def downgrade():
+    connection = op.get_bind()
+    connection.execute("DROP TABLE IF EXISTS cohort.cohort_entity;")
@@ -0,0 +1,24 @@
+"""Add filters column to store the structured filter of a cohort
+
+Revision ID: a84c2e6b1f07
+Revises: 5f3a1c9d7e21
+Create Date: 2026-10-18 09:30:41.902113
+
+"""
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "a84c2e6b1f07"
+down_revision = "5f3a1c9d7e21"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    connection = op.get_bind()
+    connection.execute('ALTER TABLE cohort.cohort ADD COLUMN IF NOT EXISTS filters character varying COLLATE pg_catalog."default";')
+
+
+def downgrade():
+    connection = op.get_bind()
+    connection.execute("ALTER TABLE cohort.cohort DROP COLUMN IF EXISTS filters;")
@@ -0,0 +1,25 @@
+"""Add size column to store the number of entities of a cohort
+
+Revision ID: 3b9d07e4c6a2
+Revises: a84c2e6b1f07
+Create Date: 2026-10-18 10:00:05.561930
+
+"""
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "3b9d07e4c6a2"
+down_revision = "a84c2e6b1f07"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    connection = op.get_bind()
+    # existing cohorts keep a NULL size, it is computed on first access
+    connection.execute("ALTER TABLE cohort.cohort ADD COLUMN IF NOT EXISTS size integer;")
+
+
+def downgrade():
+    connection = op.get_bind()
+    connection.execute("ALTER TABLE cohort.cohort DROP COLUMN IF EXISTS size;")
@@ -0,0 +1,42 @@
+"""Add entity_dictionary table and bitmap column to store the membership of cohorts as compressed bitmaps
+
+Revision ID: c7d2e9a41f58
+Revises: 3b9d07e4c6a2
+Create Date: 2026-10-18 11:00:41.208519
+
+"""
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "c7d2e9a41f58"
+down_revision = "3b9d07e4c6a2"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    connection = op.get_bind()
+    for cmd in [
+        # dense position of every entity id of an entity table, the bit of the entity in the bitmaps of the cohorts
+        """
+CREATE TABLE IF NOT EXISTS cohort.entity_dictionary
+(
+    entity_database character varying COLLATE pg_catalog."default" NOT NULL,
+    entity_schema character varying COLLATE pg_catalog."default" NOT NULL,
+    entity_table character varying COLLATE pg_catalog."default" NOT NULL,
+    entity_id character varying COLLATE pg_catalog."default" NOT NULL,
+    "position" integer NOT NULL,
+    CONSTRAINT entity_dictionary_pkey PRIMARY KEY (entity_database, entity_schema, entity_table, entity_id),
+    CONSTRAINT entity_dictionary_position_key UNIQUE (entity_database, entity_schema, entity_table, "position")
+);
+""",
+        # existing cohorts keep a NULL bitmap, it is created on first use
+        "ALTER TABLE cohort.cohort ADD COLUMN IF NOT EXISTS bitmap bytea;",
+    ]:
+        connection.execute(cmd)
+
+
+def downgrade():
+    connection = op.get_bind()
+    connection.execute("ALTER TABLE cohort.cohort DROP COLUMN IF EXISTS bitmap;")
+    connection.execute("DROP TABLE IF EXISTS cohort.entity_dictionary;")
@@ -9,6 +9,30 @@ class CoralSettings(BaseModel):
     statement_timeout: str = "300000"
     supp_statement_timeout: str = "40000"
     statement_timeout_query: str = "set statement_timeout to {}"
+    statement_timeout_local_query: str = "set local statement_timeout to {}"
+    engine_echo: bool = False  # log all statements and pool events of the engines
+    result_cache_enabled: bool = True
+    result_cache_max_bytes: int = 128 * 1024 * 1024
+    result_cache_ttl: int = 3600  # seconds
+    # scores of the genes shown in the gene score columns and histograms (see sql_score_cache)
+    score_cache_enabled: bool = True
+    score_cache_max_bytes: int = 64 * 1024 * 1024
+    score_cache_ttl: int = 3600  # seconds
+    # decoded membership bitmaps of the cohorts (see sql_bitmap)
+    bitmap_cache_max_bytes: int = 64 * 1024 * 1024
+    bitmap_cache_ttl: int = 24 * 3600  # seconds
+    # concurrent requests per priority class and worker (see sql_admission), more requests wait or are rejected
+    admission_limits: dict = {"write": 4, "size": 6, "data": 6, "hist": 6}
+    admission_queue_size: int = 32  # waiting requests per priority class
+    admission_max_wait: float = 10.0  # seconds
+    admission_retry_after: int = 1  # seconds, sent to rejected requests
+    cohort_cache_max_entries: int = 10000
+    cohort_cache_notify: bool = False  # send the invalidations of the cohort cache to the other workers with postgres NOTIFY
+    # threads that run the independent queries of the requests (see sql_parallel), and the queries a request runs at the same time
+    parallel_workers: int = 8
+    parallel_request_limit: int = 4
+    stream_fetch_size: int = 2000  # rows per fetch of the streamed responses
+    stats_catalog_max_age: int = 24 * 3600  # seconds
     logging: dict = {"version": 1, "disable_existing_loggers": False, "loggers": {"coral": {"level": "DEBUG"}}}
 
 
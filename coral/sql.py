@@ -1,10 +1,28 @@
+import json
 import logging
 
-from flask import Flask, abort, jsonify, request
+from flask import Flask, abort, g, jsonify, request
 from visyn_core.security import login_required
 
 from .settings import get_settings
-from .sql_query_mapper import QueryElements
+from .sql_admission import PRIORITY_DATA, PRIORITY_HIST, PRIORITY_SIZE, PRIORITY_WRITE, admission_controller, admitted
+from .sql_bitmap import cohort_bitmaps
+from .sql_cache import cached_result, get_result_cache, invalidate_results
+from .sql_cancel import REQUEST_ID_PARAM, QueryCancelledError, get_request_user, running_queries
+from .sql_engines import engine_registry
+from .sql_query_mapper import (
+    ENTITY_ID_COLUMNS,
+    HIST_BINS,
+    HIST_MAX_BINS,
+    SET_OPERATION_DIFFERENCE,
+    SET_OPERATION_INTERSECTION,
+    SET_OPERATION_UNION,
+    QueryElements,
+)
+from .sql_response import CONTINUATION_TOKEN_HEADER, MIMETYPE_ARROW, MIMETYPE_NDJSON, get_response_mimetype, json_response
+from .sql_score_cache import score_vectors
+from .sql_stats import stats_catalog
+from .sql_treatment import treatment_tables
 
 _log = logging.getLogger(__name__)
 
@@ -12,8 +30,47 @@ app = Flask(__name__)
 config = get_settings()
 
 
+@app.errorhandler(QueryCancelledError)
+def query_cancelled(error):
+    # the client abandoned the request (or it was superseded by a newer request of its group)
+    response = jsonify({"error": str(error), "requestId": error.request_id})
+    response.status_code = 409
+    return response
+
+
+@app.teardown_request
+def close_queries(error=None):
+    # return the connections of the QueryElements of this request to their pools
+    for query in g.pop("coral_queries", []):
+        query.close()
+
+
+def cohort_data_response(query, sql_text, args, cohort, error_msg):
+    # the data of a cohort, sorted and paginated if a page size (limit) is requested
+    if args.get("limit") is None:
+        return data_response(query, sql_text, cohort.entity_database)
+
+    # a page is returned as json, the token of the next page is sent in a header (missing on the last page)
+    page_sql = query.get_cohort_page_sql(args, sql_text, cohort, error_msg)
+    rows = query.execute_sql_query_as_dict(page_sql, cohort.entity_database)
+    token = query.get_continuation_token(args, rows, cohort)
+    response = json_response(rows)
+    if token is not None:
+        response.headers[CONTINUATION_TOKEN_HEADER] = token
+    return response
+
+
+def data_response(query, sql_text, database):
+    # the data routes return json or, if requested with the Accept header, stream newline delimited json or arrow
+    mimetype = get_response_mimetype()
+    if mimetype in [MIMETYPE_NDJSON, MIMETYPE_ARROW]:
+        return query.stream_sql_query(sql_text, database, mimetype=mimetype)
+    return query.execute_sql_query(sql_text, database)
+
+
 @app.route("/create", methods=["GET", "POST"])
 @login_required
+@admitted(PRIORITY_WRITE)
 def insert_cohort():
     # create?name=dummy&previous=-1&isInitial=1&database=tdp_publicdb&schema=tissue&table=tdp_tissue&statement=SELECT * FROM tissue.tdp_tissue
     error_msg = """Paramerter missing or wrong!
@@ -40,8 +97,53 @@ def insert_cohort():
         abort(400, error)
 
 
+def create_set_operation(operation, route):
+    # createUnion, createIntersection and createDifference
+    error_msg = """Paramerter missing or wrong!
+    For the {route} query the following parameters are needed:
+    - cohortIds: ids of at least two cohorts with the same entity table, separator '&#x2e31;', e.g. 'id1%26%23x2e31%3Bid2'
+    - name: name of the new cohort""".format(
+        route=route
+    )
+
+    try:
+        query = QueryElements()
+        new_cohort, entity_ids = query.create_cohort_set_operation(request.values, operation, error_msg)
+        return query.add_cohort_to_db(new_cohort, entity_ids)  # save new cohort into DB
+    except RuntimeError as error:
+        abort(400, error)
+
+
+@app.route("/createUnion", methods=["GET", "POST"])
+@login_required
+@admitted(PRIORITY_WRITE)
+def insert_cohort_union():
+    # createUnion?cohortIds=2%26%23x2e31%3B50&name=TeSt
+    # the entities of any of the cohorts
+    return create_set_operation(SET_OPERATION_UNION, "createUnion")
+
+
+@app.route("/createIntersection", methods=["GET", "POST"])
+@login_required
+@admitted(PRIORITY_WRITE)
+def insert_cohort_intersection():
+    # createIntersection?cohortIds=2%26%23x2e31%3B50&name=TeSt
+    # the entities of all cohorts
+    return create_set_operation(SET_OPERATION_INTERSECTION, "createIntersection")
+
+
+@app.route("/createDifference", methods=["GET", "POST"])
+@login_required
+@admitted(PRIORITY_WRITE)
+def insert_cohort_difference():
+    # createDifference?cohortIds=2%26%23x2e31%3B50&name=TeSt
+    # the entities of the first cohort that are in none of the other cohorts
+    return create_set_operation(SET_OPERATION_DIFFERENCE, "createDifference")
+
+
 @app.route("/createUseEqulasFilter", methods=["GET", "POST"])
 @login_required
+@admitted(PRIORITY_WRITE)
 def insert_cohort_equals_filtered():
     # createUseEqulasFilter?cohortId=1&name=TeSt&attribute=gender&numeric=false&values=female%26%23x2e31%3Bmale
     error_msg = """Paramerter missing or wrong!
@@ -65,6 +167,7 @@ def insert_cohort_equals_filtered():
 
 @app.route("/createUseTreatmentFilter", methods=["GET", "POST"])
 @login_required
+@admitted(PRIORITY_WRITE)
 def insert_cohort_treatment_filtered():
     # createUseTreatmentFilter?cohortId=29892&name=testTreatment&agent=Crizotinib%26%23x2e31%3BCisplatin&regimen=2&baseAgent=true
     error_msg = """Paramerter missing or wrong!
@@ -89,6 +192,8 @@ def insert_cohort_treatment_filtered():
 
 @app.route("/dataUseEqulasFilter", methods=["GET", "POST"])
 @login_required
+@cached_result
+@admitted(PRIORITY_DATA)
 def data_cohort_equals_filtered():
     # dataUseEqulasFilter?cohortId=1&attribute=gender&numeric=false&values=female%26%23x2e31%3Bmale
     error_msg = """Paramerter missing or wrong!
@@ -110,7 +215,7 @@ def data_cohort_equals_filtered():
 
         del dict_args["attribute"]  # remove attribute element to show all data
         sql_text = query.get_cohort_data_sql(dict_args, clone_cohort)  # create sql statement from the cohort
-        return query.execute_sql_query(sql_text, cohort.entity_database)  # execute sql statement
+        return cohort_data_response(query, sql_text, dict_args, clone_cohort, error_msg)  # execute sql statement
 
     except RuntimeError as error:
         abort(400, error)
@@ -118,6 +223,8 @@ def data_cohort_equals_filtered():
 
 @app.route("/sizeUseEqulasFilter", methods=["GET", "POST"])
 @login_required
+@cached_result
+@admitted(PRIORITY_SIZE)
 def size_cohort_equals_filtered():
     # sizeUseEqulasFilter?cohortId=1&attribute=gender&numeric=false&values=female%26%23x2e31%3Bmale
     error_msg = """Paramerter missing or wrong!
@@ -146,6 +253,7 @@ def size_cohort_equals_filtered():
 
 @app.route("/createUseNumFilter", methods=["GET", "POST"])
 @login_required
+@admitted(PRIORITY_WRITE)
 def insert_cohort_num_filtered():
     # createUseNumFilter?cohortId=1&name=TeSt&attribute=age&ranges=gt_2%lte_5;gte_10
     error_msg = """Paramerter missing or wrong!
@@ -168,6 +276,8 @@ def insert_cohort_num_filtered():
 
 @app.route("/dataUseNumFilter", methods=["GET", "POST"])
 @login_required
+@cached_result
+@admitted(PRIORITY_DATA)
 def data_cohort_num_filtered():
     # dataUseNumFilter?cohortId=1&attribute=age&ranges=gt_2%lte_5;gte_10
     error_msg = """Paramerter missing or wrong!
@@ -188,7 +298,7 @@ def data_cohort_num_filtered():
 
         del dict_args["attribute"]  # remove attribute element to show all data
         sql_text = query.get_cohort_data_sql(dict_args, clone_cohort)  # create sql statement from the cohort
-        return query.execute_sql_query(sql_text, cohort.entity_database)  # execute sql statement
+        return cohort_data_response(query, sql_text, dict_args, clone_cohort, error_msg)  # execute sql statement
 
     except RuntimeError as error:
         abort(400, error)
@@ -196,6 +306,8 @@ def data_cohort_num_filtered():
 
 @app.route("/sizeUseNumFilter", methods=["GET", "POST"])
 @login_required
+@cached_result
+@admitted(PRIORITY_SIZE)
 def size_cohort_num_filtered():
     # sizeUseNumFilter?cohortId=1&attribute=age&ranges=gt_2%lte_5;gte_10
     error_msg = """Paramerter missing or wrong!
@@ -223,6 +335,7 @@ def size_cohort_num_filtered():
 
 @app.route("/createUseGeneNumFilter", methods=["GET", "POST"])
 @login_required
+@admitted(PRIORITY_WRITE)
 def insert_cohort_gene_num_filtered():
     # createUseGeneNumFilter?cohortId=1&name=TeSt&table=copynumber&attribute=relativecopynumber&ensg=ENSG00000141510&ranges=gt_2%lte_5;gte_10
     error_msg = """Paramerter missing or wrong!
@@ -248,6 +361,8 @@ def insert_cohort_gene_num_filtered():
 
 @app.route("/dataUseGeneNumFilter", methods=["GET", "POST"])
 @login_required
+@cached_result
+@admitted(PRIORITY_DATA)
 def data_cohort_gene_num_filtered():
     # dataUseGeneNumFilter?cohortId=1&table=copynumber&attribute=relativecopynumber&ensg=ENSG00000141510&ranges=gt_2%lte_5;gte_10
     error_msg = """Paramerter missing or wrong!
@@ -270,7 +385,7 @@ def data_cohort_gene_num_filtered():
 
         del dict_args["attribute"]  # remove attribute element to show all data
         sql_text = query.get_cohort_data_sql(dict_args, clone_cohort)  # create sql statement from the cohort
-        return query.execute_sql_query(sql_text, cohort.entity_database)  # execute sql statement
+        return cohort_data_response(query, sql_text, dict_args, clone_cohort, error_msg)  # execute sql statement
 
     except RuntimeError as error:
         abort(400, error)
@@ -278,6 +393,8 @@ def data_cohort_gene_num_filtered():
 
 @app.route("/sizeUseGeneNumFilter", methods=["GET", "POST"])
 @login_required
+@cached_result
+@admitted(PRIORITY_SIZE)
 def size_cohort_gene_num_filtered():
     # sizeUseGeneNumFilter?cohortId=1&table=copynumber&attribute=relativecopynumber&ensg=ENSG00000141510&ranges=gt_2%lte_5;gte_10
     error_msg = """Paramerter missing or wrong!
@@ -307,6 +424,7 @@ def size_cohort_gene_num_filtered():
 
 @app.route("/createUseGeneEqualsFilter", methods=["GET", "POST"])
 @login_required
+@admitted(PRIORITY_WRITE)
 def insert_cohort_gene_equals_filtered():
     # createUseGeneEqualsFilter?cohortId=1&name=TestGeneEquals&table=mutation&attribute=dna_mutated&ensg=ENSG00000141510&numeric=false&values=false%26%23x2e31%3Btrue
     error_msg = """Paramerter missing or wrong!
@@ -333,6 +451,8 @@ def insert_cohort_gene_equals_filtered():
 
 @app.route("/dataUseGeneEqualsFilter", methods=["GET", "POST"])
 @login_required
+@cached_result
+@admitted(PRIORITY_DATA)
 def data_cohort_gene_equals_filtered():
     # dataUseGeneEqualsFilter?cohortId=1&name=TestGeneEquals&table=mutation&attribute=dna_mutated&ensg=ENSG00000141510&numeric=false&values=false%26%23x2e31%3Btrue
     error_msg = """Paramerter missing or wrong!
@@ -358,7 +478,7 @@ def data_cohort_gene_equals_filtered():
 
         del dict_args["attribute"]  # remove attribute element to show all data
         sql_text = query.get_cohort_data_sql(dict_args, clone_cohort)  # create sql statement from the cohort
-        return query.execute_sql_query(sql_text, cohort.entity_database)  # execute sql statement
+        return cohort_data_response(query, sql_text, dict_args, clone_cohort, error_msg)  # execute sql statement
 
     except RuntimeError as error:
         abort(400, error)
@@ -366,6 +486,8 @@ def data_cohort_gene_equals_filtered():
 
 @app.route("/sizeUseGeneEqualsFilter", methods=["GET", "POST"])
 @login_required
+@cached_result
+@admitted(PRIORITY_SIZE)
 def size_cohort_gene_equals_filtered():
     # sizeUseGeneEqualsFilter?cohortId=1&name=TestGeneEquals&table=mutation&attribute=dna_mutated&ensg=ENSG00000141510&numeric=false&values=false%26%23x2e31%3Btrue
     error_msg = """Paramerter missing or wrong!
@@ -395,8 +517,60 @@ def size_cohort_gene_equals_filtered():
         abort(400, error)
 
 
+@app.route("/sizePreview", methods=["GET", "POST"])
+@login_required
+@cached_result
+@admitted(PRIORITY_SIZE)
+def size_preview():
+    # sizePreview?cohortId=1&type=equals&attribute=gender&numeric=false&candidates=["male", "female", "null"]
+    # sizePreview?cohortId=1&type=geneNum&table=expression&attribute=tpm&ensg=ENSG00000141510&candidates=["lt_1", "gte_1%lt_10", "gte_10"]
+    error_msg = """Paramerter missing or wrong!
+    For the {route} query the following parameter is needed:
+    - cohortId: id of the cohort parent cohort
+    - type: equals | num | geneEquals | geneNum | depletionNum | panel
+    - candidates: json list of the candidate values (equals, geneEquals, panel) or ranges (num, geneNum, depletionNum)
+      in the format of the corresponding create route, e.g. ["male", "female&#x2e31;null"] or ["gt_2%lte_5", "gte_10"]
+
+    Depending on the 'type' the other parameters of the filter have to exist
+    --> Type: equals: attribute, numeric
+    --> Type: num: attribute
+    --> Type: geneEquals: table, attribute, ensg, numeric
+    --> Type: geneNum: table, attribute, ensg
+    --> Type: depletionNum: table, attribute, ensg, depletionscreen
+    --> Type: panel: panel
+
+    The sizes are returned in the order of the candidates""".format(
+        route="sizePreview"
+    )
+
+    try:
+        query = QueryElements()
+
+        candidates_raw = request.values.get("candidates")
+        if candidates_raw is None:
+            raise RuntimeError(error_msg)
+        try:
+            candidates = json.loads(candidates_raw)
+        except ValueError:
+            raise RuntimeError(error_msg) from None
+        if not isinstance(candidates, list):
+            raise RuntimeError(error_msg)
+
+        cohort = query.get_cohort_from_db(request.values, error_msg)  # get parent cohort
+
+        sql_text = query.get_size_preview_sql(request.values, candidates, cohort, error_msg)
+        sizes = query.execute_sql_query_as_dict(sql_text, cohort.entity_database)[0]  # execute sql statement
+        return jsonify(
+            [{"candidate": candidate, "size": sizes["size_{index}".format(index=index)]} for index, candidate in enumerate(candidates)]
+        )
+
+    except RuntimeError as error:
+        abort(400, error)
+
+
 @app.route("/getDBCohorts", methods=["GET", "POST"])
 @login_required
+@admitted(PRIORITY_SIZE)
 def database_cohort_data():
     # getDBCohorts?cohortIds=2%26%23x2e31%3B50
     error_msg = """Paramerter missing or wrong!
@@ -409,13 +583,36 @@ def database_cohort_data():
         query = QueryElements()
         sql_text = query.get_cohorts_by_id_sql(request.values, error_msg)  # get sql statement to retrieve cohorts
         # print('cohort DB SQL:', sql_text)
-        return query.execute_sql_query(sql_text, "cohort")  # execute sql statement
+        cohorts = query.execute_sql_query_as_dict(sql_text, "cohort")  # execute sql statement
+        return jsonify(query.add_missing_cohort_sizes(cohorts, error_msg))  # sizes of old cohorts are computed once
+    except RuntimeError as error:
+        abort(400, error)
+
+
+@app.route("/cohortOverlaps", methods=["GET", "POST"])
+@login_required
+@cached_result
+@admitted(PRIORITY_SIZE)
+def cohort_overlaps():
+    # cohortOverlaps?cohortIds=2%26%23x2e31%3B50%26%23x2e31%3B51
+    error_msg = """Paramerter missing or wrong!
+    For the {route} query the following parameter is needed:
+    - cohortIds: ids of the cohorts with the same entity table, separator '&#x2e31;', e.g. 'id1%26%23x2e31%3Bid2'
+
+    Returns the size of the overlap of every pair of the cohorts""".format(
+        route="cohortOverlaps"
+    )
+
+    try:
+        query = QueryElements()
+        return jsonify(query.get_cohort_overlaps(request.values, error_msg))
     except RuntimeError as error:
         abort(400, error)
 
 
 @app.route("/updateCohortName", methods=["GET", "POST"])
 @login_required
+@admitted(PRIORITY_WRITE)
 def update_cohort_name():
     # updateCohortName?cohortId=37151&name=123Test123Test
     error_msg = """Paramerter missing or wrong!
@@ -435,13 +632,22 @@ def update_cohort_name():
 
 @app.route("/cohortData", methods=["GET", "POST"])
 @login_required
+@cached_result
+@admitted(PRIORITY_DATA)
 def data_cohort():
     # cohortData?cohortId=2&attribute=gender
+    # cohortData?cohortId=2&attributes=gender,age,tumortype
+    # cohortData?cohortId=2&orderBy=age&direction=desc&limit=100&after=WzYwLCAiVENHQS0wMSJd
     error_msg = """Paramerter missing or wrong!
     For the {route} query the following parameter is needed:
     - cohortId: id of the cohort
-    There is also one optional parameter:
-    - attribute: one column of the entity table""".format(
+    There are also optional parameters (the entity id is always returned):
+    - attribute: one column of the entity table
+    - attributes: columns of the entity table, separator ',' (takes precedence over attribute)
+    - limit: page size, the entities are sorted by orderBy and the entity id
+    - orderBy: sort column of the pages
+    - direction: asc | desc, sort direction of orderBy (default asc)
+    - after: continuation token of the next page, sent in the X-Continuation-Token header of the previous page""".format(
         route="cohortData"
     )
 
@@ -449,13 +655,15 @@ def data_cohort():
         query = QueryElements()
         cohort = query.get_cohort_from_db(request.values, error_msg)  # get parent cohort
         sql_text = query.get_cohort_data_sql(request.values, cohort)  # get sql statement to retrieve data
-        return query.execute_sql_query(sql_text, cohort.entity_database)  # execute sql statement
+        return cohort_data_response(query, sql_text, request.values, cohort, error_msg)  # execute sql statement
     except RuntimeError as error:
         abort(400, error)
 
 
 @app.route("/size", methods=["GET", "POST"])
 @login_required
+@cached_result
+@admitted(PRIORITY_SIZE)
 def size_cohort():
     # size?cohortId=2
     error_msg = """Paramerter missing or wrong!
@@ -467,14 +675,15 @@ def size_cohort():
     try:
         query = QueryElements()
         cohort = query.get_cohort_from_db(request.values, error_msg)  # get parent cohort
-        sql_text = query.get_cohort_size_sql(cohort)  # get sql statement to get size of cohort
-        return query.execute_sql_query(sql_text, cohort.entity_database)  # execute sql statement
+        return jsonify([{"size": query.get_cohort_size(cohort)}])  # stored size of the cohort
     except RuntimeError as error:
         abort(400, error)
 
 
 @app.route("/geneScore", methods=["GET", "POST"])
 @login_required
+@cached_result
+@admitted(PRIORITY_DATA)
 def gene_score_tissue():
     # geneScore?cohortId=2&table=copynumber&attribute=relativecopynumber&ensg=ENSG00000141510
     error_msg = """Paramerter missing or wrong!
@@ -490,13 +699,15 @@ def gene_score_tissue():
         query = QueryElements()
         cohort = query.get_cohort_from_db(request.values, error_msg)  # get parent cohort
         sql_text = query.get_gene_score_sql(request.values, cohort, error_msg)  # get sql statement to get gene score for tissue
-        return query.execute_sql_query(sql_text, cohort.entity_database)  # execute sql statement
+        return data_response(query, sql_text, cohort.entity_database)  # execute sql statement
     except RuntimeError as error:
         abort(400, error)
 
 
 @app.route("/celllineDepletionScore", methods=["GET", "POST"])
 @login_required
+@cached_result
+@admitted(PRIORITY_DATA)
 def depletion_score_cellline():
     # celllineDepletionScore?cohortId=3&table=depletionscore&attribute=rsa&ensg=ENSG00000141510&depletionscreen=Drive
     error_msg = """Paramerter missing or wrong!
@@ -513,13 +724,14 @@ def depletion_score_cellline():
         query = QueryElements()
         cohort = query.get_cohort_from_db(request.values, error_msg)  # get parent cohort
         sql_text = query.get_gene_score_depletion_sql(request.values, cohort, error_msg)  # get sql statement to get depletion score
-        return query.execute_sql_query(sql_text, cohort.entity_database)  # execute sql statement
+        return data_response(query, sql_text, cohort.entity_database)  # execute sql statement
     except RuntimeError as error:
         abort(400, error)
 
 
 @app.route("/createUseDepletionScoreFilter", methods=["GET", "POST"])
 @login_required
+@admitted(PRIORITY_WRITE)
 def insert_cohort_depletion_score_filtered():
     # createUseDepletionScoreFilter?cohortId=3&name=TeStDepletion&table=depletionscore&attribute=rsa&ensg=ENSG00000141510&depletionscreen=Drive&ranges=gte_-0.1%lt_-0.01
     error_msg = """Paramerter missing or wrong!
@@ -548,6 +760,8 @@ def insert_cohort_depletion_score_filtered():
 
 @app.route("/dataUseDepletionScoreFilter", methods=["GET", "POST"])
 @login_required
+@cached_result
+@admitted(PRIORITY_DATA)
 def data_cohort_depletion_score_filtered():
     # dataUseDepletionScoreFilter?cohortId=3&table=depletionscore&attribute=rsa&ensg=ENSG00000141510&depletionscreen=Drive&ranges=gte_-0.1%lt_-0.01
     error_msg = """Paramerter missing or wrong!
@@ -573,7 +787,7 @@ def data_cohort_depletion_score_filtered():
 
         del dict_args["attribute"]  # remove attribute element to show all data
         sql_text = query.get_cohort_data_sql(dict_args, clone_cohort)  # create sql statement from the cohort
-        return query.execute_sql_query(sql_text, cohort.entity_database)  # execute sql statement
+        return cohort_data_response(query, sql_text, dict_args, clone_cohort, error_msg)  # execute sql statement
 
     except RuntimeError as error:
         abort(400, error)
@@ -581,6 +795,8 @@ def data_cohort_depletion_score_filtered():
 
 @app.route("/sizeUseDepletionScoreFilter", methods=["GET", "POST"])
 @login_required
+@cached_result
+@admitted(PRIORITY_SIZE)
 def size_cohort_depletion_score_filtered():
     # sizeUseDepletionScoreFilter?cohortId=3&table=depletionscore&attribute=rsa&ensg=ENSG00000141510&depletionscreen=Drive&ranges=gte_-0.1%lt_-0.01
     error_msg = """Paramerter missing or wrong!
@@ -613,6 +829,8 @@ def size_cohort_depletion_score_filtered():
 
 @app.route("/panelAnnotation", methods=["GET", "POST"])
 @login_required
+@cached_result
+@admitted(PRIORITY_DATA)
 def panel_annotation():
     # panelAnnotation?cohortId=3&panel=TCGA normals
     error_msg = """Paramerter missing or wrong!
@@ -626,13 +844,14 @@ def panel_annotation():
         query = QueryElements()
         cohort = query.get_cohort_from_db(request.values, error_msg)  # get parent cohort
         sql_text = query.get_panel_annotation_sql(request.values, cohort, error_msg)  # get sql statement for panel annotation
-        return query.execute_sql_query(sql_text, cohort.entity_database)  # execute sql statement
+        return data_response(query, sql_text, cohort.entity_database)  # execute sql statement
     except RuntimeError as error:
         abort(400, error)
 
 
 @app.route("/createUsePanelAnnotationFilter", methods=["GET", "POST"])
 @login_required
+@admitted(PRIORITY_WRITE)
 def insert_cohort_panel_annotation_filtered():
     # createUsePanelAnnotationFilter?cohortId=1&name=testPanelAnno&panel=TCGA normals&values=true
     error_msg = """Paramerter missing or wrong!
@@ -657,6 +876,8 @@ def insert_cohort_panel_annotation_filtered():
 
 @app.route("/dataUsePanelAnnotationFilter", methods=["GET", "POST"])
 @login_required
+@cached_result
+@admitted(PRIORITY_DATA)
 def data_cohort_panel_annotation_filtered():
     # dataUsePanelAnnotationFilter?cohortId=1&panel=TCGA normals&values=true
     error_msg = """Paramerter missing or wrong!
@@ -678,7 +899,7 @@ def data_cohort_panel_annotation_filtered():
         )  # get filtered cohort from args and cohort
 
         sql_text = query.get_cohort_data_sql(dict_args, clone_cohort)  # create sql statement from the cohort
-        return query.execute_sql_query(sql_text, cohort.entity_database)  # execute sql statement
+        return cohort_data_response(query, sql_text, dict_args, clone_cohort, error_msg)  # execute sql statement
 
     except RuntimeError as error:
         abort(400, error)
@@ -686,6 +907,8 @@ def data_cohort_panel_annotation_filtered():
 
 @app.route("/sizeUsePanelAnnotationFilter", methods=["GET", "POST"])
 @login_required
+@cached_result
+@admitted(PRIORITY_SIZE)
 def size_cohort_panel_annotation_filtered():
     # sizeUsePanelAnnotationFilter?cohortId=1&panel=TCGA normals&values=true
     error_msg = """Paramerter missing or wrong!
@@ -715,6 +938,8 @@ def size_cohort_panel_annotation_filtered():
 
 @app.route("/hist", methods=["GET", "POST"])
 @login_required
+@cached_result
+@admitted(PRIORITY_HIST)
 def hist():
     # hist?cohortId=2&type=dataCat&attribute=race
     # hist?cohortId=2&type=dataNum&attribute=age
@@ -740,8 +965,12 @@ def hist():
     - ensg: name of the gene
     - depletionscreen: name of the screen
     --> Type: panelAnnotation
-    - panel: name of the panel""".format(
-        route="hist"
+    - panel: name of the panel
+
+    There are also optional parameters for the numeric types (dataNum | geneScoreNum | depletionScore):
+    - bins: number of bins, 1 to {max_bins} (default {bins})
+    - binning: equal | quantile, bins of the same width or with the same number of entities (default equal)""".format(
+        route="hist", bins=HIST_BINS, max_bins=HIST_MAX_BINS
     )
 
     try:
@@ -755,7 +984,7 @@ def hist():
         cohort = query.get_cohort_from_db(request.values, error_msg)  # get cohort
         database = cohort.entity_database
 
-        num_bins = 10
+        num_bins = query.get_hist_bins(request.values, error_msg)
         if type == "dataCat":
             # - cohortId: id of the cohort
             # - attribute: the entity attribute
@@ -803,6 +1032,137 @@ def hist():
         abort(400, error)
 
 
+@app.route("/histBatch", methods=["GET", "POST"])
+@login_required
+@cached_result
+@admitted(PRIORITY_HIST)
+def hist_batch():
+    # histBatch?cohortId=2&specs=[{"type": "dataCat", "attribute": "race"}, {"type": "dataNum", "attribute": "age"}]
+    error_msg = """Paramerter missing or wrong!
+    For the {route} query the following parameter is needed:
+    - cohortId: id of the cohort parent cohort
+    - specs: json list of histogram definitions, each with the parameters of the 'hist' route (without cohortId), e.g.
+      [{{"type": "dataCat", "attribute": "race"}}, {{"type": "geneScoreNum", "attribute": "relativecopynumber", "table": "copynumber", "ensg": "ENSG00000141510"}}]
+
+    There is also an optional parameter:
+    - bins: number of bins of the numeric histograms without their own bins (default {bins})
+
+    The histograms are returned in the order of the specs""".format(
+        route="histBatch", bins=HIST_BINS
+    )
+
+    try:
+        query = QueryElements()
+
+        specs_raw = request.values.get("specs")
+        if specs_raw is None:
+            raise RuntimeError(error_msg)
+        try:
+            specs = json.loads(specs_raw)
+        except ValueError:
+            raise RuntimeError(error_msg) from None
+        if not isinstance(specs, list) or not all(isinstance(spec, dict) for spec in specs):
+            raise RuntimeError(error_msg)
+
+        cohort = query.get_cohort_from_db(request.values, error_msg)  # get cohort
+
+        num_bins = query.get_hist_bins(request.values, error_msg)
+        query.prefetch_hist_stats(specs, cohort, error_msg)  # statistics of all histograms at once
+        sql_text, bins = query.get_hist_batch_sql(specs, cohort, num_bins, error_msg)
+        rows = query.execute_sql_query_as_dict(
+            sql_text, cohort.entity_database, True, config.supp_statement_timeout
+        )  # execute sql statement
+        return query.format_hist_batch(rows, bins)
+
+    except RuntimeError as error:
+        abort(400, error)
+
+
+@app.route("/cacheStats", methods=["GET", "POST"])
+@login_required
+def cache_stats():
+    # cacheStats
+    return jsonify(get_result_cache().stats())
+
+
+@app.route("/invalidateCache", methods=["GET", "POST"])
+@login_required
+def invalidate_cache():
+    # invalidateCache?cohortId=2
+    # without cohortId all cached results are removed (e.g. after the entity data was updated)
+    invalidate_results(request.values.get("cohortId"))
+    return jsonify(get_result_cache().stats())
+
+
+@app.route("/admissionStats", methods=["GET", "POST"])
+@login_required
+def admission_stats():
+    # admissionStats
+    # running, waiting and rejected requests per priority class of this worker
+    return jsonify(admission_controller.stats())
+
+
+@app.route("/poolStats", methods=["GET", "POST"])
+@login_required
+def pool_stats():
+    # poolStats
+    # state of the connection pools, engines are only created for the databases that were queried
+    return jsonify(engine_registry.status())
+
+
+@app.route("/refreshStats", methods=["GET", "POST"])
+@login_required
+def refresh_stats():
+    # refreshStats
+    # removes the statistics of the histograms (e.g. after the entity data was updated), they are computed again on the next request
+    stats_catalog.refresh()
+    score_vectors.invalidate()  # the cached gene scores are loaded again too
+    cohort_bitmaps.invalidate()  # the bitmaps of the initial cohorts are created again
+    invalidate_results()  # the cached histograms were created with the old statistics
+    return jsonify({"statistics": len(stats_catalog.summary())})
+
+
+@app.route("/refreshTreatments", methods=["GET", "POST"])
+@login_required
+def refresh_treatments():
+    # refreshTreatments?database=tdp_publicdb&schema=tissue&table=tdp_tissue
+    # builds the treatment table of the entity table (after the entity data was loaded or updated), without parameters
+    # the treatment tables of all entity tables whose treatments were filtered by this process are built
+    # until a treatment table is built, the treatment filters expand the treatment json of every entity
+    error_msg = """Paramerter missing or wrong!
+    For the {route} query the following parameters are needed:
+    - database: database of the entity table
+    - schema: schema of the entity table
+    - table: entity table with treatments
+    or no parameters to rebuild all used treatment tables""".format(
+        route="refreshTreatments"
+    )
+
+    database = request.values.get("database")
+    schema = request.values.get("schema")
+    table = request.values.get("table")
+    if database is None and (schema is not None or table is not None):
+        abort(400, error_msg)
+    if database is not None and (schema is None or ENTITY_ID_COLUMNS.get(table) is None):
+        abort(400, error_msg)
+
+    tables = treatment_tables.refresh(database, schema, table, ENTITY_ID_COLUMNS.get(table))
+    invalidate_results()  # the cached results of treatment filters were created with the old treatments
+    return jsonify({"tables": tables})
+
+
+@app.route("/cancel", methods=["GET", "POST"])
+@login_required
+def cancel():
+    # cancel?requestId=
+    # cancels the running statements of the request with the id (sent by the client as X-Request-Id header or requestId
+    # parameter), statements started later by the request are cancelled too. Only the requests of the user are cancelled.
+    request_id = request.values.get(REQUEST_ID_PARAM)
+    if request_id is None:
+        abort(400, "Parameter missing: requestId")
+    return jsonify({"requestId": request_id, "cancelled": running_queries.cancel(get_request_user(), request_id)})
+
+
 def create():
     """
     entry point of this plugin
@@ -0,0 +1,171 @@
+import asyncio
+import logging
+import threading
+import time
+from functools import wraps
+
+from flask import Response, jsonify
+
+from .settings import get_settings
+
+_log = logging.getLogger(__name__)
+
+config = get_settings()
+
+# priority classes of the routes, each class has its own concurrency limit and wait queue (admission_limits), so e.g.
+# many histograms of a wide Taskview can not take the connections needed to create a cohort
+PRIORITY_WRITE = "write"  # create cohorts, rename
+PRIORITY_SIZE = "size"  # sizes and cohort metadata
+PRIORITY_DATA = "data"  # data and scores of the entities
+PRIORITY_HIST = "hist"  # histograms
+
+# seconds between the checks of the requests of the async routes that wait for their priority class
+ASYNC_WAIT_INTERVAL = 0.01
+
+
+class AdmissionRejectedError(Exception):
+    def __init__(self, priority, reason):
+        super().__init__("{priority}: {reason}".format(priority=priority, reason=reason))
+        self.priority = priority
+        self.reason = reason
+
+
+class PriorityClass:
+    """Admission of one priority class: at most limit requests run at the same time, at most queue_size requests wait
+    for at most max_wait seconds
+    """
+
+    def __init__(self, name, limit, queue_size, max_wait):
+        self.name = name
+        self.limit = limit
+        self.queue_size = queue_size
+        self.max_wait = max_wait
+        self.running = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        with self.condition:
+            if self.running >= self.limit:
+                if self.waiting >= self.queue_size:
+                    self.rejected += 1
+                    raise AdmissionRejectedError(self.name, "wait queue is full")
+
+                self.waiting += 1
+                deadline = time.monotonic() + self.max_wait
+                try:
+                    while self.running >= self.limit:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            self.rejected += 1
+                            raise AdmissionRejectedError(self.name, "waited longer than {wait}s".format(wait=self.max_wait))
+                        self.condition.wait(remaining)
+                finally:
+                    self.waiting -= 1
+
+            self.running += 1
+            self.admitted += 1
+
+    async def acquire_async(self):
+        """acquire() for the event loop of the async routes, the request waits in the same queue without blocking a thread
+        The released slots are only noticed when the request checks again (every ASYNC_WAIT_INTERVAL seconds).
+        """
+        with self.condition:
+            if self.running < self.limit:
+                self.running += 1
+                self.admitted += 1
+                return
+            if self.waiting >= self.queue_size:
+                self.rejected += 1
+                raise AdmissionRejectedError(self.name, "wait queue is full")
+            self.waiting += 1
+
+        deadline = time.monotonic() + self.max_wait
+        try:
+            while True:
+                await asyncio.sleep(ASYNC_WAIT_INTERVAL)
+                with self.condition:
+                    if self.running < self.limit:
+                        self.running += 1
+                        self.admitted += 1
+                        return
+                    if time.monotonic() >= deadline:
+                        self.rejected += 1
+                        raise AdmissionRejectedError(self.name, "waited longer than {wait}s".format(wait=self.max_wait))
+        finally:
+            with self.condition:
+                self.waiting -= 1
+
+    def release(self):
+        with self.condition:
+            self.running -= 1
+            self.condition.notify()
+
+    def stats(self):
+        with self.condition:
+            return {
+                "limit": self.limit,
+                "running": self.running,
+                "waiting": self.waiting,
+                "queueSize": self.queue_size,
+                "maxWait": self.max_wait,
+                "admitted": self.admitted,
+                "rejected": self.rejected,
+            }
+
+
+class AdmissionController:
+    def __init__(self, limits, queue_size, max_wait):
+        # the limits are per worker process
+        self.classes = {name: PriorityClass(name, limit, queue_size, max_wait) for name, limit in limits.items()}
+
+    def acquire(self, priority):
+        self.classes[priority].acquire()
+
+    async def acquire_async(self, priority):
+        await self.classes[priority].acquire_async()
+
+    def release(self, priority):
+        self.classes[priority].release()
+
+    def stats(self):
+        return {name: priority_class.stats() for name, priority_class in self.classes.items()}
+
+
+admission_controller = AdmissionController(config.admission_limits, config.admission_queue_size, config.admission_max_wait)
+
+
+def admitted(priority):
+    """Run the route only if its priority class has capacity, otherwise wait in the queue of the class or shed the request
+    with 503 (Service Unavailable) and a Retry-After header. Streamed responses keep their slot until they are sent.
+    """
+
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            try:
+                admission_controller.acquire(priority)
+            except AdmissionRejectedError as rejected:
+                _log.warning("Request rejected: %s", rejected)
+                response = jsonify({"error": "Server is busy, please retry", "priority": rejected.priority, "reason": rejected.reason})
+                response.status_code = 503
+                response.headers["Retry-After"] = str(config.admission_retry_after)
+                return response
+
+            try:
+                response = view(*args, **kwargs)
+            except BaseException:
+                admission_controller.release(priority)
+                raise
+
+            if isinstance(response, Response) and response.is_streamed:
+                response.call_on_close(lambda: admission_controller.release(priority))
+            else:
+                admission_controller.release(priority)
+            return response
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,372 @@
+import asyncio
+import contextlib
+import json
+import logging
+import threading
+
+from fastapi import APIRouter, Depends, HTTPException, Request
+from fastapi.responses import Response
+from sqlalchemy import event, text
+from sqlalchemy.engine import make_url
+from starlette.concurrency import run_in_threadpool
+from visyn_core import manager
+
+from .settings import get_settings
+from .sql_admission import PRIORITY_DATA, PRIORITY_HIST, PRIORITY_SIZE, AdmissionRejectedError, admission_controller
+from .sql_cache import CACHED_HEADERS, fingerprint, get_result_cache
+from .sql_cohort_cache import cohort_cache
+from .sql_engines import COHORT_DATABASE, ENGINE_PRIMARY, ENGINE_SECONDARY, engine_registry
+from .sql_query_mapper import HIST_BINS, QueryElements
+from .sql_response import CONTINUATION_TOKEN_HEADER, MIMETYPE_JSON, RowDecoder, dumps_json
+from .sql_tables import Cohort
+
+try:
+    import asyncpg
+    from sqlalchemy.ext.asyncio import create_async_engine
+except ImportError:  # the async routes are only offered if asyncpg is installed
+    asyncpg = None
+
+_log = logging.getLogger(__name__)
+
+config = get_settings()
+
+# path of the async routes, they have the same names and parameters as the routes of the flask app (/api/cohortdb/db)
+ASYNC_PREFIX = "/api/cohortdb/async"
+
+# seconds between the checks if the client of a running statement disconnected
+DISCONNECT_POLL_INTERVAL = 0.5
+
+ERROR_MSG = "Paramerter missing or wrong! See the {route} route of /api/cohortdb/db for the parameters"
+
+# filtered cohorts of the sizeUse* and dataUse* routes: filter name -> QueryElements builder of the filtered cohort
+FILTER_BUILDERS = {
+    "EqulasFilter": "create_cohort_equals_filtered",
+    "NumFilter": "create_cohort_num_filtered",
+    "GeneNumFilter": "create_cohort_gene_num_filtered",
+    "GeneEqualsFilter": "create_cohort_gene_equals_filtered",
+    "DepletionScoreFilter": "create_cohort_depletion_score_filtered",
+    "PanelAnnotationFilter": "create_cohort_panel_annotation_filtered",
+}
+
+
+class AsyncEngineRegistry:
+    """Async engines (asyncpg) of the databases, created on first use with the dburl of the sync engines
+    Their pools are separate from the pools of the flask routes and limited by the same settings.
+    """
+
+    def __init__(self):
+        self.engines = {}  # (dburl, engine type) -> async engine
+        self.lock = threading.Lock()
+
+    def get_engine(self, database, engine_type=ENGINE_PRIMARY):
+        key = (engine_registry.get_dburl(database), engine_type)
+        with self.lock:
+            if key not in self.engines:
+                _log.info("create async %s engine for %s", engine_type, database)
+                self.engines[key] = self.create_engine(key[0], engine_type)
+            return self.engines[key]
+
+    def create_engine(self, dburl, engine_type):
+        statement_timeout = config.statement_timeout if engine_type == ENGINE_PRIMARY else config.supp_statement_timeout
+        engine = create_async_engine(
+            make_url(dburl).set(drivername="postgresql+asyncpg"),
+            pool_pre_ping=True,
+            connect_args={"server_settings": {"statement_timeout": str(statement_timeout)}},
+            pool_timeout=int(statement_timeout) / 1000.0,
+            max_overflow=config.connection_pool_overflow,
+            pool_size=config.connection_pool_size,
+            echo=config.engine_echo,
+        )
+        event.listen(engine.sync_engine, "connect", self.set_type_codecs)
+        return engine
+
+    async def dispose(self):
+        # the pooled connections belong to the event loop of the server, they are closed when it shuts down
+        with self.lock:
+            engines = list(self.engines.values())
+            self.engines.clear()
+        for engine in engines:
+            await engine.dispose()
+
+    def set_type_codecs(self, dbapi_connection, _connection_record):
+        # real values are decoded from their text representation like psycopg2 does (e.g. 9.99 instead of 9.990000152587891)
+        dbapi_connection.run_async(
+            lambda connection: connection.set_type_codec("float4", schema="pg_catalog", encoder=str, decoder=float, format="text")
+        )
+
+
+async_engine_registry = AsyncEngineRegistry()
+
+
+class AsyncQueryElements:
+    """Executes the statements of the QueryElements builders on the async engines
+    Like QueryElements, a request uses one connection (in one transaction) per engine until close().
+    """
+
+    def __init__(self):
+        # the builders and their bind parameters, their sync connections are only held while a statement is built (see build)
+        self.query = QueryElements()
+        self.connections = {}
+        self.transactions = {}
+
+    async def get_connection(self, database, supplemental_data=False):
+        engine = async_engine_registry.get_engine(database, ENGINE_PRIMARY if not supplemental_data else ENGINE_SECONDARY)
+        if engine not in self.connections:
+            connection = await engine.connect()
+            self.transactions[engine] = await connection.begin()
+            self.connections[engine] = connection
+        return self.connections[engine]
+
+    async def get_cohort_from_db(self, args, error_msg):
+        cohort_id = args.get("cohortId")
+        if cohort_id is None or not str(cohort_id).strip().isdigit():
+            raise RuntimeError(error_msg)
+
+        cohort_id = int(cohort_id)
+        row = cohort_cache.get(cohort_id)
+        if row is None:
+            connection = await self.get_connection(COHORT_DATABASE)
+            result = await connection.execute(Cohort.__table__.select().where(Cohort.id == cohort_id))
+            row = dict(result.one()._mapping)
+            cohort_cache.put(cohort_id, row)
+        return Cohort(**row)
+
+    async def execute_sql_query_as_dict(self, sql_text, database, supplemental_data=False, custom_statement_timeout=None):
+        connection = await self.get_connection(database, supplemental_data)
+        if custom_statement_timeout is not None:
+            await connection.execute(text(config.statement_timeout_local_query.format(custom_statement_timeout)))
+        result = await connection.execute(text(sql_text), dict(self.query.sql_params))
+        decoder = RowDecoder(result)  # the asyncpg cursor describes the columns with the postgres type oids, too
+        return decoder.decode(result.fetchall())
+
+    async def build(self, builder, *args):
+        """Return the statement of a QueryElements builder, run in the threadpool
+        The builders may read with the sync engines (e.g. the stored members of a cohort), their connections are returned
+        to the pools before the statement is executed on the async engine.
+        """
+        return await run_in_threadpool(self.build_statement, builder, *args)
+
+    def build_statement(self, builder, *args):
+        try:
+            return builder(*args)
+        finally:
+            self.query.close()
+
+    async def close(self):
+        # every connection is closed, even if the rollback of another one fails (e.g. after its statement was cancelled)
+        try:
+            for engine, connection in list(self.connections.items()):
+                try:
+                    try:
+                        await self.transactions[engine].rollback()
+                    finally:
+                        await connection.close()
+                except Exception as e:
+                    _log.error("Closing the async connection of %s failed: %s", repr(engine.url), e)
+        finally:
+            self.connections.clear()
+            self.transactions.clear()
+            await run_in_threadpool(self.query.close)
+
+
+def logged_in():
+    # the async routes require a login, like the login_required routes of the flask app
+    if manager.security.current_user is None:
+        raise HTTPException(status_code=401)
+
+
+async def request_args(request):
+    # query and form parameters, like request.values of flask
+    args = dict(request.query_params)
+    if request.method == "POST":
+        args.update(await request.form())
+    return args
+
+
+async def run_until_disconnected(request, coroutine):
+    """Await the coroutine, it is cancelled if the client disconnects (which cancels the running statement in asyncpg)"""
+    task = asyncio.ensure_future(coroutine)
+    while True:
+        done, _pending = await asyncio.wait({task}, timeout=DISCONNECT_POLL_INTERVAL)
+        if done:
+            return task.result()
+        if await request.is_disconnected():
+            _log.info("client of %s disconnected, cancel the request", request.url.path)
+            task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await task  # the connection is used by the task until it is cancelled
+            raise HTTPException(status_code=409, detail="Client disconnected")
+
+
+def json_response(content, headers=None):
+    return Response(dumps_json(content), media_type=MIMETYPE_JSON, headers=headers)
+
+
+def cached_response(route, args):
+    if not config.result_cache_enabled:
+        return None
+    cached = get_result_cache().get(fingerprint(ASYNC_PREFIX + route, {key: [value] for key, value in args.items()}, MIMETYPE_JSON))
+    if cached is None:
+        return None
+    body, status, mimetype, headers = cached
+    return Response(body, status_code=status, media_type=mimetype, headers=dict(headers))
+
+
+def cache_response(route, args, response):
+    if config.result_cache_enabled and response.status_code == 200:
+        key = fingerprint(ASYNC_PREFIX + route, {key: [value] for key, value in args.items()}, MIMETYPE_JSON)
+        headers = [(name, response.headers[name]) for name in CACHED_HEADERS if name in response.headers]
+        get_result_cache().put(key, (response.body, response.status_code, MIMETYPE_JSON, headers), len(response.body), args.get("cohortId"))
+    return response
+
+
+async def cohort_route(request, route, priority, handler):
+    """Run the handler of an async cohort route with the arguments of the request
+    The responses are cached like the ones of the flask routes, a RuntimeError of the builders is returned as 400.
+    Uncached requests are admitted in the priority class of the flask route, the async and the flask routes of a worker
+    share the limits (see sql_admission).
+    """
+    args = await request_args(request)
+    cached = cached_response(route, args)
+    if cached is not None:
+        return cached
+
+    try:
+        # a full class suspends the request while it waits in its queue
+        await admission_controller.acquire_async(priority)
+    except AdmissionRejectedError as rejected:
+        _log.warning("Request rejected: %s", rejected)
+        content = {"error": "Server is busy, please retry", "priority": rejected.priority, "reason": rejected.reason}
+        return Response(
+            dumps_json(content), status_code=503, media_type=MIMETYPE_JSON, headers={"Retry-After": str(config.admission_retry_after)}
+        )
+
+    query = AsyncQueryElements()
+    try:
+        response = await run_until_disconnected(request, handler(query, args))
+    except RuntimeError as error:
+        raise HTTPException(status_code=400, detail=str(error)) from None
+    finally:
+        try:
+            await query.close()
+        finally:
+            admission_controller.release(priority)
+    return cache_response(route, args, response)
+
+
+async def cohort_data(query, args, cohort, error_msg):
+    # the data of a cohort, a page with the token of the next one in a header if a page size (limit) is requested
+    # the builders may read the stored members of the cohort or the type of the sort column with a (sync) query
+    sql_text = await query.build(query.query.get_cohort_data_sql, args, cohort)
+    if args.get("limit") is None:
+        return json_response(await query.execute_sql_query_as_dict(sql_text, cohort.entity_database))
+
+    page_sql = await query.build(query.query.get_cohort_page_sql, args, sql_text, cohort, error_msg)
+    rows = await query.execute_sql_query_as_dict(page_sql, cohort.entity_database)
+    token = query.query.get_continuation_token(args, rows, cohort)
+    return json_response(rows, {CONTINUATION_TOKEN_HEADER: token} if token is not None else None)
+
+
+async def get_size(query, cohort):
+    if cohort.size is None:  # cohorts created before the size was stored, stored on their next access by the flask routes
+        sql_text = await query.build(query.query.get_cohort_size_sql, cohort)
+        rows = await query.execute_sql_query_as_dict(sql_text, cohort.entity_database)
+        return rows[0]["size"]
+    return cohort.size
+
+
+def add_filter_routes(router, filter_name, builder_name):
+    async def filtered_cohort(query, args, cohort, route):
+        # the builders read the stored members of the cohort (or the treatments) with a (sync) query
+        clone_args = dict(args, name="clone")  # add name element for the builder of the filtered cohort
+        builder = getattr(query.query, builder_name)
+        return clone_args, await query.build(builder, clone_args, cohort, ERROR_MSG.format(route=route))
+
+    async def size(request: Request):
+        route = "/sizeUse" + filter_name
+
+        async def handler(query, args):
+            cohort = await query.get_cohort_from_db(args, ERROR_MSG.format(route=route))
+            _clone_args, clone_cohort = await filtered_cohort(query, args, cohort, route)
+            sql_text = await query.build(query.query.get_cohort_size_sql, clone_cohort)
+            return json_response(await query.execute_sql_query_as_dict(sql_text, cohort.entity_database))
+
+        return await cohort_route(request, route, PRIORITY_SIZE, handler)
+
+    async def data(request: Request):
+        route = "/dataUse" + filter_name
+
+        async def handler(query, args):
+            cohort = await query.get_cohort_from_db(args, ERROR_MSG.format(route=route))
+            clone_args, clone_cohort = await filtered_cohort(query, args, cohort, route)
+            clone_args.pop("attribute", None)  # remove attribute element to show all data
+            return await cohort_data(query, clone_args, clone_cohort, ERROR_MSG.format(route=route))
+
+        return await cohort_route(request, route, PRIORITY_DATA, handler)
+
+    router.add_api_route("/sizeUse" + filter_name, size, methods=["GET", "POST"], dependencies=[Depends(logged_in)])
+    router.add_api_route("/dataUse" + filter_name, data, methods=["GET", "POST"], dependencies=[Depends(logged_in)])
+
+
+def create():
+    """Router of the async cohort routes, the read only routes of the flask app on asyncpg"""
+    router = APIRouter(prefix=ASYNC_PREFIX, tags=["coral"])
+    if asyncpg is None:
+        _log.warning("asyncpg is not installed, the async cohort routes (%s) are not available", ASYNC_PREFIX)
+        return router
+    router.add_event_handler("shutdown", async_engine_registry.dispose)
+
+    @router.api_route("/size", methods=["GET", "POST"], dependencies=[Depends(logged_in)])
+    async def size_cohort(request: Request):
+        # size?cohortId=2
+        async def handler(query, args):
+            cohort = await query.get_cohort_from_db(args, ERROR_MSG.format(route="size"))
+            return json_response([{"size": await get_size(query, cohort)}])
+
+        return await cohort_route(request, "/size", PRIORITY_SIZE, handler)
+
+    @router.api_route("/cohortData", methods=["GET", "POST"], dependencies=[Depends(logged_in)])
+    async def data_cohort(request: Request):
+        # cohortData?cohortId=2&attributes=gender,age&orderBy=age&limit=100
+        async def handler(query, args):
+            cohort = await query.get_cohort_from_db(args, ERROR_MSG.format(route="cohortData"))
+            return await cohort_data(query, args, cohort, ERROR_MSG.format(route="cohortData"))
+
+        return await cohort_route(request, "/cohortData", PRIORITY_DATA, handler)
+
+    @router.api_route("/hist", methods=["GET", "POST"], dependencies=[Depends(logged_in)])
+    async def hist(request: Request):
+        # hist?cohortId=2&type=dataNum&attribute=age
+        async def handler(query, args):
+            cohort = await query.get_cohort_from_db(args, ERROR_MSG.format(route="hist"))
+            # the builders compute missing statistics of the histograms with a (sync) query
+            sql_text, bins = await query.build(query.query.get_hist_sql, args, cohort, HIST_BINS, ERROR_MSG.format(route="hist"))
+            rows = await query.execute_sql_query_as_dict(sql_text, cohort.entity_database, True, config.supp_statement_timeout)
+            return json_response(query.query.format_num_hist_dict(rows, bins) if bins is not None else rows)
+
+        return await cohort_route(request, "/hist", PRIORITY_HIST, handler)
+
+    @router.api_route("/histBatch", methods=["GET", "POST"], dependencies=[Depends(logged_in)])
+    async def hist_batch(request: Request):
+        # histBatch?cohortId=2&specs=[{"type": "dataCat", "attribute": "race"}, {"type": "dataNum", "attribute": "age"}]
+        async def handler(query, args):
+            try:
+                specs = json.loads(args.get("specs", ""))
+            except ValueError:
+                raise RuntimeError(ERROR_MSG.format(route="histBatch")) from None
+            if not isinstance(specs, list) or not all(isinstance(spec, dict) for spec in specs):
+                raise RuntimeError(ERROR_MSG.format(route="histBatch"))
+
+            cohort = await query.get_cohort_from_db(args, ERROR_MSG.format(route="histBatch"))
+            num_bins = query.query.get_hist_bins(args, ERROR_MSG.format(route="histBatch"))
+            await query.build(query.query.prefetch_hist_stats, specs, cohort, ERROR_MSG.format(route="histBatch"))
+            sql_text, bins = await query.build(query.query.get_hist_batch_sql, specs, cohort, num_bins, ERROR_MSG.format(route="histBatch"))
+            rows = await query.execute_sql_query_as_dict(sql_text, cohort.entity_database, True, config.supp_statement_timeout)
+            return json_response(query.query.format_hist_batch_dict(rows, bins))
+
+        return await cohort_route(request, "/histBatch", PRIORITY_HIST, handler)
+
+    for filter_name, builder_name in FILTER_BUILDERS.items():
+        add_filter_routes(router, filter_name, builder_name)
+
+    return router
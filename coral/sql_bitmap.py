@@ -0,0 +1,194 @@
+import functools
+import logging
+import operator
+import threading
+import zlib
+
+from .settings import get_settings
+from .sql_cache import LRUResultCache
+from .sql_engines import COHORT_DATABASE
+
+_log = logging.getLogger(__name__)
+
+config = get_settings()
+
+# The members of a cohort are a bitmap over the entity dictionary of its entity table: bit n is set if the entity with
+# the dictionary position n belongs to the cohort. The bitmaps are python ints (set algebra with &, |, & ~ and
+# bit_count()), stored zlib compressed with the cohort.
+
+
+def encode_bitmap(bitmap):
+    return zlib.compress(bitmap.to_bytes((bitmap.bit_length() + 7) // 8, "little"))
+
+
+def decode_bitmap(data):
+    return int.from_bytes(zlib.decompress(data), "little")
+
+
+def bitmap_size(bitmap):
+    return bitmap.bit_count()
+
+
+def union(bitmaps):
+    return functools.reduce(operator.or_, bitmaps, 0)
+
+
+def intersection(bitmaps):
+    return functools.reduce(operator.and_, bitmaps)
+
+
+def difference(bitmap, others):
+    # the members of bitmap that are in none of the others
+    return bitmap & ~union(others)
+
+
+class EntityDictionary:
+    """Dense positions of the entity ids of one entity table, positions are assigned once and never change"""
+
+    def __init__(self, key):
+        self.key = key  # (entity database, schema, table)
+        self.positions = {}  # entity id -> position
+        self.ids = []  # position -> entity id (None for positions assigned by another worker and not loaded yet)
+        self.lock = threading.Lock()  # held while positions are added, the dictionary is read without it
+
+    def add(self, entity_id, position):
+        self.positions[entity_id] = position
+        if position >= len(self.ids):
+            self.ids.extend([None] * (position + 1 - len(self.ids)))
+        self.ids[position] = entity_id
+
+    def add_rows(self, rows):
+        # (entity id, position) pairs read from cohort.entity_dictionary
+        with self.lock:
+            for entity_id, position in rows:
+                self.add(entity_id, position)
+
+    def get_bitmap(self, entity_ids):
+        # the bits are set in a byte array, setting them one by one in the int would copy it for every entity
+        bits = bytearray((len(self.ids) + 7) // 8)
+        for entity_id in entity_ids:
+            position = self.positions[entity_id]
+            bits[position >> 3] |= 1 << (position & 7)
+        return int.from_bytes(bits, "little")
+
+    def get_entity_ids(self, bitmap):
+        # ids of the set bits, by position
+        digits = bin(bitmap)[:1:-1]  # lowest bit first
+        entity_ids = []
+        position = digits.find("1")
+        while position >= 0:
+            entity_ids.append(self.ids[position])
+            position = digits.find("1", position + 1)
+        return entity_ids
+
+
+class CohortBitmaps:
+    """Entity dictionaries of the entity tables and the decoded bitmaps of the cohorts
+    The dictionaries are stored in cohort.entity_dictionary, new entity ids get the next positions (serialized per entity
+    table with an advisory lock, so the workers can not assign the same position twice). The dictionaries are read and
+    extended with the connection of the request (query), the lock of a dictionary is only held to add the read positions.
+    """
+
+    def __init__(self, max_bytes, ttl):
+        self.dictionaries = {}  # (entity database, schema, table) -> EntityDictionary
+        self.bitmaps = LRUResultCache(max_bytes, ttl)  # cohort id -> decoded bitmap
+        self.lock = threading.Lock()  # held to add a dictionary
+
+    def get_dictionary(self, query, key, entity_ids=()):
+        """Return the dictionary of the entity table, with positions for all given entity ids"""
+        dictionary = self.dictionaries.get(key)
+        if dictionary is None:
+            rows = self.load_rows(query, key)
+            with self.lock:
+                dictionary = self.dictionaries.setdefault(key, EntityDictionary(key))
+            dictionary.add_rows(rows)
+
+        missing = [entity_id for entity_id in set(entity_ids) if entity_id not in dictionary.positions]
+        if len(missing) > 0:
+            dictionary.add_rows(self.assign_positions(query, key, missing))
+        if len(dictionary.positions) < len(dictionary.ids):
+            # positions below the new ones were assigned by other workers
+            dictionary.add_rows(self.load_rows(query, key))
+        return dictionary
+
+    def load_rows(self, query, key, entity_ids=None):
+        sql_text = (
+            "SELECT entity_id, position FROM cohort.entity_dictionary "
+            "WHERE entity_database = :dictionary_database AND entity_schema = :dictionary_schema AND entity_table = :dictionary_table"
+        )
+        params = {"dictionary_database": key[0], "dictionary_schema": key[1], "dictionary_table": key[2]}
+        if entity_ids is not None:
+            sql_text = sql_text + " AND entity_id = ANY(CAST(:dictionary_entity_ids AS varchar[]))"
+            params["dictionary_entity_ids"] = entity_ids
+        rows = query.execute_sql_query_as_dict(sql_text, COHORT_DATABASE, params=params)
+        return [(row["entity_id"], row["position"]) for row in rows]
+
+    def assign_positions(self, query, key, entity_ids):
+        # committed right away, the positions are kept even if the cohort that needs them is not
+        params = {
+            "dictionary_database": key[0],
+            "dictionary_schema": key[1],
+            "dictionary_table": key[2],
+            "dictionary_entity_ids": entity_ids,
+        }
+        query.execute_sql_query_as_dict(
+            "SELECT 1 AS locked FROM pg_advisory_xact_lock(hashtext(:lock_key))",
+            COHORT_DATABASE,
+            params={"lock_key": "coral_dictionary_" + "/".join(key)},
+        )
+        query.execute_sql_query_as_dict(
+            "INSERT INTO cohort.entity_dictionary (entity_database, entity_schema, entity_table, entity_id, position) "
+            "SELECT :dictionary_database, :dictionary_schema, :dictionary_table, n.entity_id, "
+            "(SELECT COALESCE(MAX(d.position), -1) FROM cohort.entity_dictionary d "
+            "WHERE d.entity_database = :dictionary_database AND d.entity_schema = :dictionary_schema "
+            "AND d.entity_table = :dictionary_table) "
+            "+ ROW_NUMBER() OVER (ORDER BY n.entity_id) "
+            "FROM UNNEST(CAST(:dictionary_entity_ids AS varchar[])) AS n(entity_id) "
+            "WHERE NOT EXISTS (SELECT 1 FROM cohort.entity_dictionary d WHERE d.entity_database = :dictionary_database "
+            "AND d.entity_schema = :dictionary_schema AND d.entity_table = :dictionary_table AND d.entity_id = n.entity_id) "
+            "RETURNING entity_id",
+            COHORT_DATABASE,
+            params=params,
+        )
+        query.commit_connection(COHORT_DATABASE)  # releases the advisory lock
+        _log.debug("Assigned dictionary positions to %s entities of %s", len(entity_ids), key)
+        return self.load_rows(query, key, entity_ids)
+
+    def create_bitmap(self, query, cohort, entity_ids):
+        # bitmap of the entity ids of a new cohort
+        dictionary = self.get_dictionary(query, (cohort.entity_database, cohort.entity_schema, cohort.entity_table), entity_ids)
+        return dictionary.get_bitmap(entity_ids)
+
+    def get_entity_ids(self, query, cohort, bitmap):
+        key = (cohort.entity_database, cohort.entity_schema, cohort.entity_table)
+        dictionary = self.get_dictionary(query, key)
+        if bitmap.bit_length() > len(dictionary.ids):
+            # the bitmap was created by another worker with positions that are not loaded yet
+            dictionary.add_rows(self.load_rows(query, key))
+        return dictionary.get_entity_ids(bitmap)
+
+    def get_bitmap(self, query, cohort):
+        """Return the bitmap of a stored cohort
+        Cohorts created before the bitmaps were stored get theirs on first use, initial cohorts (the whole entity table,
+        which can change) are only kept in memory.
+        """
+        bitmap = self.bitmaps.get(cohort.id)
+        if bitmap is not None:
+            return bitmap
+
+        if cohort.bitmap is not None:
+            bitmap = decode_bitmap(cohort.bitmap)
+        else:
+            bitmap = self.create_bitmap(query, cohort, query.get_cohort_members(cohort))
+            if int(cohort.is_initial) != 1:
+                query.update_cohort_bitmap(cohort, encode_bitmap(bitmap))
+
+        self.bitmaps.put(cohort.id, bitmap, (bitmap.bit_length() + 7) // 8)
+        return bitmap
+
+    def invalidate(self):
+        # e.g. after the entity data was updated, the bitmaps of the initial cohorts are created again
+        self.bitmaps.invalidate()
+
+
+cohort_bitmaps = CohortBitmaps(config.bitmap_cache_max_bytes, config.bitmap_cache_ttl)
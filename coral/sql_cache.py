@@ -0,0 +1,165 @@
+import hashlib
+import json
+import logging
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from functools import wraps
+
+from flask import Response, request
+
+from .settings import get_settings
+from .sql_cancel import REQUEST_GROUP_PARAM, REQUEST_ID_PARAM
+from .sql_response import CONTINUATION_TOKEN_HEADER, MIMETYPE_JSON, get_response_mimetype
+
+_log = logging.getLogger(__name__)
+
+config = get_settings()
+
+# request arguments that do not change the result of a route
+IGNORED_ARGS = ["_assignids", "_", REQUEST_ID_PARAM, REQUEST_GROUP_PARAM]
+# response headers that are stored with the cached results
+CACHED_HEADERS = [CONTINUATION_TOKEN_HEADER]
+
+
+def fingerprint(route, args, mimetype=MIMETYPE_JSON):
+    """Return a canonical key for a route, its arguments and the requested response format
+    args : dict of argument -> list of values (e.g. request.values.to_dict(flat=False))
+    """
+    normalized = {key: [str(v).strip() for v in values] for key, values in args.items() if key not in IGNORED_ARGS}
+    canonical = json.dumps([route, normalized, mimetype], sort_keys=True, separators=(",", ":"))
+    return hashlib.sha1(canonical.encode("utf-8")).hexdigest()
+
+
+class ResultCache(ABC):
+    """Interface of the result cache, set another implementation with set_result_cache()"""
+
+    @abstractmethod
+    def get(self, key):
+        pass
+
+    @abstractmethod
+    def put(self, key, value, size, cohort_id=None):
+        pass
+
+    @abstractmethod
+    def invalidate(self, cohort_id=None):
+        pass
+
+    @abstractmethod
+    def stats(self):
+        pass
+
+
+class LRUResultCache(ResultCache):
+    """In-process LRU cache limited by the summed size (in bytes) of its values, entries expire after ttl seconds"""
+
+    def __init__(self, max_bytes, ttl):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.entries = OrderedDict()  # key -> (expires, size, cohort_id, value)
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] < time.monotonic():
+                self._remove(key)
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[3]
+
+    def put(self, key, value, size, cohort_id=None):
+        if size > self.max_bytes:
+            return  # would evict everything else
+
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+
+            self.entries[key] = (time.monotonic() + self.ttl, size, cohort_id, value)
+            self.current_bytes += size
+            while self.current_bytes > self.max_bytes:
+                self._remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    def invalidate(self, cohort_id=None):
+        # removes the results of one cohort or all results (e.g. after the entity data was updated)
+        with self.lock:
+            if cohort_id is None:
+                self.entries.clear()
+                self.current_bytes = 0
+            else:
+                for key in [key for key, entry in self.entries.items() if entry[2] == str(cohort_id)]:
+                    self._remove(key)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "bytes": self.current_bytes,
+                "maxBytes": self.max_bytes,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+    def _remove(self, key):
+        entry = self.entries.pop(key)
+        self.current_bytes -= entry[1]
+
+
+_result_cache = LRUResultCache(config.result_cache_max_bytes, config.result_cache_ttl)
+
+
+def get_result_cache():
+    return _result_cache
+
+
+def set_result_cache(cache):
+    global _result_cache
+    _result_cache = cache
+
+
+def invalidate_results(cohort_id=None):
+    get_result_cache().invalidate(cohort_id)
+
+
+def cached_result(view):
+    """Cache the successful responses of a read route by its path and arguments
+    The routes have to be pure functions of the cohort (which never changes) and the request arguments.
+    """
+
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if not config.result_cache_enabled:
+            return view(*args, **kwargs)
+
+        cache = get_result_cache()
+        key = fingerprint(request.path, request.values.to_dict(flat=False), get_response_mimetype())
+        cached = cache.get(key)
+        if cached is not None:
+            body, status, mimetype, headers = cached
+            return Response(body, status=status, mimetype=mimetype, headers=headers)
+
+        response = view(*args, **kwargs)
+        if isinstance(response, Response) and response.status_code == 200 and not response.is_streamed:
+            body = response.get_data()
+            headers = [(name, value) for name, value in response.headers.items() if name in CACHED_HEADERS]
+            cache.put(key, (body, response.status_code, response.mimetype, headers), len(body), request.values.get("cohortId"))
+
+        return response
+
+    return wrapper
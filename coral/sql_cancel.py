@@ -0,0 +1,147 @@
+import logging
+import threading
+import time
+
+from flask import has_request_context, request
+from visyn_core import manager
+
+from .sql_engines import connect_unpooled
+
+_log = logging.getLogger(__name__)
+
+# client supplied id of a request, the running statements of the request can be cancelled with /cancel?requestId=
+# the ids and groups are chosen by the clients, they only identify a request together with the user who sent it
+REQUEST_ID_HEADER = "X-Request-Id"
+REQUEST_ID_PARAM = "requestId"
+# requests of the same group supersede each other (e.g. the size requests of one filter slider), a new request of a group
+# cancels the statements still running for the previous request of the group
+REQUEST_GROUP_HEADER = "X-Request-Group"
+REQUEST_GROUP_PARAM = "requestGroup"
+
+# seconds a cancellation is kept for a request whose statements did not start yet
+CANCELLED_MAX_AGE = 60
+
+
+class QueryCancelledError(Exception):
+    def __init__(self, request_id):
+        super().__init__("Request {request_id} was cancelled".format(request_id=request_id))
+        self.request_id = request_id
+
+
+def get_request_user():
+    # id of the user of the current request
+    user = manager.security.current_user
+    return user.id if user is not None else None
+
+
+def get_request_ids():
+    # (user, request id, request group) of the current request, the ids are None if they are not sent by the client
+    if not has_request_context():
+        return None, None, None
+    request_id = request.headers.get(REQUEST_ID_HEADER, request.values.get(REQUEST_ID_PARAM))
+    request_group = request.headers.get(REQUEST_GROUP_HEADER, request.values.get(REQUEST_GROUP_PARAM))
+    if request_id is None:
+        return None, None, None
+    return get_request_user(), request_id, request_group
+
+
+class RunningStatement:
+    """Statement that runs on the backend pid of a connection of engine"""
+
+    def __init__(self, engine, backend_pid):
+        self.engine = engine
+        self.backend_pid = backend_pid
+        self.active = True
+        # held while the statement is cancelled, so the connection can not return to the pool (and run the statement of
+        # another request) before pg_cancel_backend is sent
+        self.lock = threading.Lock()
+
+
+class RunningQueries:
+    """Statements of the requests with a client supplied request id, by user and request id
+    Cancelling a request sends pg_cancel_backend for its running statements on a dedicated connection (not one of the
+    pool, which could be exhausted by the statements to cancel). Users can only cancel (or supersede) their own requests.
+    The statements and cancellations are kept in the memory of the process: with several workers, /cancel only reaches
+    the requests of the worker that serves it. The client has to send it to the same worker (e.g. with sticky sessions).
+    """
+
+    def __init__(self):
+        self.statements = {}  # (user, request id) -> running statements
+        self.groups = {}  # (user, request group) -> id of the latest request of the group
+        self.cancelled = {}  # (user, request id) -> time of the cancellation
+        self.lock = threading.Lock()
+
+    def start(self, user, request_id, request_group, engine, backend_pid):
+        """Register the statement of a request, raises QueryCancelledError if the request is already cancelled"""
+        superseded = None
+        statement = RunningStatement(engine, backend_pid)
+        with self.lock:
+            if (user, request_id) in self.cancelled:
+                raise QueryCancelledError(request_id)
+            self.statements.setdefault((user, request_id), []).append(statement)
+            if request_group is not None:
+                superseded = self.groups.get((user, request_group))
+                self.groups[(user, request_group)] = request_id
+
+        if superseded is not None and superseded != request_id:
+            _log.debug("request %s supersedes %s", request_id, superseded)
+            self.cancel(user, superseded)
+        return statement
+
+    def finish(self, user, request_id, statement):
+        with statement.lock:
+            statement.active = False
+        with self.lock:
+            statements = self.statements.get((user, request_id), [])
+            if statement in statements:
+                statements.remove(statement)
+            if len(statements) == 0:
+                self.statements.pop((user, request_id), None)
+
+    def end_request(self, user, request_id, request_group):
+        # forget the request at its end
+        with self.lock:
+            self.cancelled.pop((user, request_id), None)
+            if request_group is not None and self.groups.get((user, request_group)) == request_id:
+                del self.groups[(user, request_group)]
+
+    def is_cancelled(self, user, request_id):
+        with self.lock:
+            return (user, request_id) in self.cancelled
+
+    def cancel(self, user, request_id):
+        """Cancel the running statements of a request of the user and the ones it starts later, returns the number of
+        cancelled statements
+        """
+        now = time.monotonic()
+        with self.lock:
+            for cancelled_key, cancelled_at in list(self.cancelled.items()):
+                if now - cancelled_at > CANCELLED_MAX_AGE:
+                    del self.cancelled[cancelled_key]
+            self.cancelled[(user, request_id)] = now
+            statements = list(self.statements.get((user, request_id), []))
+
+        cancelled = 0
+        for statement in statements:
+            with statement.lock:
+                if statement.active and self.cancel_backend(statement.engine, statement.backend_pid):
+                    cancelled += 1
+        _log.info("cancelled %s statements of request %s", cancelled, request_id)
+        return cancelled
+
+    def cancel_backend(self, engine, backend_pid):
+        connection = None
+        try:
+            connection = connect_unpooled(engine)
+            cursor = connection.cursor()
+            cursor.execute("SELECT pg_cancel_backend(%s)", (backend_pid,))
+            return cursor.fetchone()[0]
+        except Exception as e:
+            _log.error("Cancelling the statement of backend %s failed: %s", backend_pid, e)
+            return False
+        finally:
+            if connection is not None:
+                connection.close()
+
+
+running_queries = RunningQueries()
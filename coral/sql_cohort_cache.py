@@ -0,0 +1,86 @@
+import logging
+import select
+import threading
+import time
+from collections import OrderedDict
+
+from .settings import get_settings
+from .sql_engines import COHORT_DATABASE, connect_unpooled, get_engine
+
+_log = logging.getLogger(__name__)
+
+config = get_settings()
+
+# postgres channel of the invalidations, the payload is the id of the changed cohort
+NOTIFY_CHANNEL = "coral_cohort"
+
+
+class CohortCache:
+    """In-process LRU cache of the cohort rows (as dict of column -> value), limited by the number of cohorts
+    Cohorts are immutable except for their name and size, the routes that change them invalidate the entry. With
+    cohort_cache_notify the invalidations are sent to the other workers with postgres NOTIFY.
+    """
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()  # cohort id -> row
+        self.lock = threading.Lock()
+        self.listener = None
+
+    def get(self, cohort_id):
+        with self.lock:
+            row = self.entries.get(cohort_id)
+            if row is not None:
+                self.entries.move_to_end(cohort_id)
+            return row
+
+    def put(self, cohort_id, row):
+        if config.cohort_cache_notify:
+            self.start_listener()
+
+        with self.lock:
+            self.entries[cohort_id] = row
+            self.entries.move_to_end(cohort_id)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, cohort_id=None):
+        with self.lock:
+            if cohort_id is None:
+                self.entries.clear()
+            else:
+                self.entries.pop(cohort_id, None)
+
+    def start_listener(self):
+        with self.lock:
+            if self.listener is None:
+                self.listener = threading.Thread(target=self.listen, name="coral-cohort-cache", daemon=True)
+                self.listener.start()
+
+    def listen(self):
+        # invalidate the cohorts changed by other workers, on a dedicated connection (not one of the pool)
+        engine = get_engine(COHORT_DATABASE)
+        while True:
+            connection = None
+            try:
+                connection = connect_unpooled(engine)
+                connection.cursor().execute("LISTEN {channel}".format(channel=NOTIFY_CHANNEL))
+                self.invalidate()  # notifications could have been missed while there was no connection
+
+                while True:
+                    if select.select([connection], [], [], 60) == ([], [], []):
+                        continue
+                    connection.poll()
+                    while connection.notifies:
+                        notify = connection.notifies.pop(0)
+                        _log.debug("invalidate cohort %s", notify.payload)
+                        self.invalidate(int(notify.payload))
+            except Exception as e:
+                _log.error("Listening for cohort invalidations failed: %s", e)
+                time.sleep(5)
+            finally:
+                if connection is not None:
+                    connection.close()
+
+
+cohort_cache = CohortCache(config.cohort_cache_max_entries)
@@ -0,0 +1,99 @@
+import logging
+import threading
+
+from sqlalchemy import create_engine
+from visyn_core import manager
+
+from .settings import get_settings
+
+_log = logging.getLogger(__name__)
+
+config = get_settings()
+
+# the database of the cohorts
+COHORT_DATABASE = "cohort"
+# databases of the entities (cohort.entity_database), their dburl is read from the settings of the same name
+ENTITY_DATABASES = ["tdp_publicdb", "tdp_student", "tdp_covid19"]
+
+ENGINE_PRIMARY = "primary"
+ENGINE_SECONDARY = "secondary"  # supplemental data (e.g. histograms) with a shorter statement timeout
+
+
+class EngineRegistry:
+    """Engines of the databases, created on first use per (database, engine type)
+    The pool of an engine is shared by all databases with the same dburl, so no pools are created for databases that are
+    never queried and none twice for the same server.
+    """
+
+    def __init__(self):
+        self.engines = {}  # (dburl, engine type) -> engine
+        self.databases = {}  # (dburl, engine type) -> names of the databases that use the engine
+        self.lock = threading.Lock()
+
+    def get_dburl(self, database):
+        if database == COHORT_DATABASE:
+            return config.dburl
+        if database in ENTITY_DATABASES:
+            dburl = manager.settings.get_nested(database, {}).get("dburl")
+            if dburl is not None:
+                return dburl
+
+        _log.error("Unknown db connector: %s", database)
+        raise Exception("Unknown db connector")
+
+    def get_engine(self, database, engine_type=ENGINE_PRIMARY):
+        key = (self.get_dburl(database), engine_type)
+        with self.lock:
+            if key not in self.engines:
+                _log.info("create %s engine for %s", engine_type, database)
+                self.engines[key] = self.create_engine(key[0], engine_type)
+                self.databases[key] = []
+            if database not in self.databases[key]:
+                self.databases[key].append(database)
+            return self.engines[key]
+
+    def create_engine(self, dburl, engine_type):
+        # create engine also creates QueuePool for connections
+        # pool_pre_ping tests if the connection is still working: https://docs.sqlalchemy.org/en/13/core/pooling.html#disconnect-handling-pessimistic
+        statement_timeout = config.statement_timeout if engine_type == ENGINE_PRIMARY else config.supp_statement_timeout
+        return create_engine(
+            dburl,
+            pool_pre_ping=True,
+            connect_args={"options": "-c statement_timeout={}".format(statement_timeout)},
+            pool_timeout=int(statement_timeout) / 1000.0,
+            max_overflow=config.connection_pool_overflow,
+            pool_size=config.connection_pool_size,
+            echo=config.engine_echo,
+            echo_pool=config.engine_echo,
+        )
+
+    def status(self):
+        # state of the pools of all created engines
+        with self.lock:
+            return [
+                {
+                    "databases": list(self.databases[key]),
+                    "type": key[1],
+                    "url": repr(engine.url),  # without password
+                    "size": engine.pool.size(),
+                    "checkedIn": engine.pool.checkedin(),
+                    "checkedOut": engine.pool.checkedout(),
+                    "overflow": engine.pool.overflow(),
+                }
+                for key, engine in self.engines.items()
+            ]
+
+
+engine_registry = EngineRegistry()
+
+
+def get_engine(database, engine_type=ENGINE_PRIMARY):
+    return engine_registry.get_engine(database, engine_type)
+
+
+def connect_unpooled(engine):
+    # dbapi connection to the database of engine that is not taken from (and not counted in) its pool, in autocommit mode
+    cargs, cparams = engine.dialect.create_connect_args(engine.url)
+    connection = engine.dialect.connect(*cargs, **cparams)
+    connection.autocommit = True
+    return connection
@@ -0,0 +1,212 @@
+import json
+import logging
+
+_log = logging.getLogger(__name__)
+
+# predicate types of a cohort filter
+FILTER_EQUALS = "equals"
+FILTER_NUM = "num"
+FILTER_TREATMENT = "treatment"
+FILTER_GENE_EQUALS = "geneEquals"
+FILTER_GENE_NUM = "geneNum"
+FILTER_DEPLETION_NUM = "depletionNum"
+FILTER_PANEL = "panel"
+
+# filters that can be previewed: the request parameters of the predicate and the parameter with the candidate values or ranges
+PREVIEW_PARAMETERS = {
+    FILTER_EQUALS: (["attribute", "numeric"], "values"),
+    FILTER_NUM: (["attribute"], "ranges"),
+    FILTER_GENE_EQUALS: (["table", "attribute", "ensg", "numeric"], "values"),
+    FILTER_GENE_NUM: (["table", "attribute", "ensg"], "ranges"),
+    FILTER_DEPLETION_NUM: (["table", "attribute", "ensg", "depletionscreen"], "ranges"),
+    FILTER_PANEL: (["panel"], "values"),
+}
+
+
+class CohortFilter:
+    """Structured filter of a cohort: the entity table and the list of predicates (in the order they were applied)
+    A predicate is a dict with a 'type' and the request parameters of the filter, e.g.
+    {"type": "num", "attribute": "age", "ranges": "gt_2%lte_5;gte_10"}
+    The entity database is not part of the json, it is taken from the cohort.
+    """
+
+    def __init__(self, entity_schema, entity_table, predicates=None, entity_database=None):
+        self.entity_schema = entity_schema
+        self.entity_table = entity_table
+        self.predicates = predicates if predicates is not None else []
+        self.entity_database = entity_database
+
+    def add_predicate(self, predicate):
+        # filters are immutable like the cohorts they belong to
+        return CohortFilter(self.entity_schema, self.entity_table, self.predicates + [predicate], self.entity_database)
+
+    def to_json(self):
+        return json.dumps({"schema": self.entity_schema, "table": self.entity_table, "predicates": self.predicates}, sort_keys=True)
+
+    @classmethod
+    def from_json(cls, value, entity_database=None):
+        definition = json.loads(value)
+        return cls(definition["schema"], definition["table"], definition["predicates"], entity_database)
+
+    def __repr__(self):
+        return "<CohortFilter (entity_schema='%s', entity_table='%s', predicates='%s')>" % (
+            self.entity_schema,
+            self.entity_table,
+            self.predicates,
+        )
+
+
+class FilterCompiler:
+    """Compiles a CohortFilter into one flat sql statement:
+    SELECT base.* FROM schema.table base LEFT OUTER JOIN (score) j0 ON ... WHERE (pred1) AND (pred2) ...
+    Predicates on the same score (e.g. two filters on the copy number of TP53) share one join.
+    The sql of the single predicates is created by the filter statements of the QueryElements.
+    Statements that are stored with a cohort (stored) do not use the derived tables of the entity database (the treatment
+    tables), which can be missing or rebuilt when the statement runs.
+    """
+
+    def __init__(self, query, entity_id_col, error_msg, stored=False):
+        self.query = query
+        self.entity_id_col = entity_id_col
+        self.error_msg = error_msg
+        self.stored = stored
+
+    def compile(self, cohort_filter, columns="base.*", restriction=None):
+        """Return the statement of the entities that match all predicates of the filter
+        restriction : sql condition on base that the entities have to match first (e.g. the stored members of a parent
+          cohort, whose predicates are then not compiled again)
+        """
+        joins, conditions = self.compile_predicates(cohort_filter, cohort_filter.predicates)
+        if restriction is not None:
+            conditions.insert(0, restriction)
+
+        sql_text = "SELECT {columns} FROM {schema}.{table} base".format(
+            columns=columns, schema=cohort_filter.entity_schema, table=cohort_filter.entity_table
+        )
+        sql_text = self.add_joins(sql_text, joins)
+        if len(conditions) > 0:
+            sql_text = sql_text + " WHERE " + " AND ".join(conditions)
+
+        return sql_text
+
+    def compile_counts(self, cohort_filter, entities_sql, predicates):
+        """Return one statement that counts the entities matching each of the predicates in a single scan:
+        SELECT COUNT(*) FILTER (WHERE pred0) AS size_0, COUNT(*) FILTER (WHERE pred1) AS size_1 ... FROM (entities) base ...
+        """
+        joins, conditions = self.compile_predicates(cohort_filter, predicates)
+
+        counts = [
+            "COUNT(*) FILTER (WHERE {condition}) AS size_{index}".format(condition=condition, index=index)
+            for index, condition in enumerate(conditions)
+        ]
+        sql_text = "SELECT {counts} FROM ({entities_sql}) base".format(counts=", ".join(counts), entities_sql=entities_sql)
+        return self.add_joins(sql_text, joins)
+
+    def add_joins(self, sql_text, joins):
+        for _alias, join_sql in joins.values():
+            sql_text = sql_text + " " + join_sql
+        return sql_text
+
+    def compile_predicates(self, cohort_filter, predicates):
+        """Return the (deduplicated) joins as dict of join key -> (alias, sql) and the where conditions of the predicates"""
+        joins = {}
+        conditions = []
+        for predicate in predicates:
+            conditions.append("({condition})".format(condition=self.compile_predicate(cohort_filter, predicate, joins)))
+
+        return joins, conditions
+
+    def compile_predicate(self, cohort_filter, predicate, joins):
+        filter_type = predicate.get("type")
+        if filter_type == FILTER_EQUALS:
+            column = "base.{attribute}".format(attribute=predicate["attribute"])
+            return self.query.equals_filter_clause(column, predicate["values"], predicate["numeric"])
+        elif filter_type == FILTER_NUM:
+            column = "base.{attribute}".format(attribute=predicate["attribute"])
+            return self.query.num_filter_clause(predicate["ranges"], column, self.error_msg)
+        elif filter_type == FILTER_TREATMENT:
+            sql_refiend = self.query.treatment_filter_statement(
+                predicate.get("agent"),
+                predicate.get("regimen"),
+                predicate["baseAgent"],
+                cohort_filter.entity_schema,
+                cohort_filter.entity_table,
+                self.get_entity_id_col(),
+                cohort_filter.entity_database if not self.stored else None,
+            )
+            return "base.{entity_id_col} IN (SELECT refined.{entity_id_col} FROM ({sql_refiend}) refined)".format(
+                entity_id_col=self.get_entity_id_col(), sql_refiend=sql_refiend
+            )
+        elif filter_type == FILTER_GENE_EQUALS:
+            alias = self.add_gene_score_join(cohort_filter, predicate, joins)
+            column = "{alias}.score".format(alias=alias)
+            return self.query.equals_filter_clause(column, predicate["values"], predicate["numeric"])
+        elif filter_type == FILTER_GENE_NUM:
+            alias = self.add_gene_score_join(cohort_filter, predicate, joins)
+            column = "{alias}.score".format(alias=alias)
+            return self.query.num_filter_clause(predicate["ranges"], column, self.error_msg)
+        elif filter_type == FILTER_DEPLETION_NUM:
+            alias = self.add_depletion_score_join(predicate, joins)
+            column = "{alias}.score".format(alias=alias)
+            return self.query.num_filter_clause(predicate["ranges"], column, self.error_msg)
+        elif filter_type == FILTER_PANEL:
+            alias = self.add_panel_join(cohort_filter, predicate, joins)
+            column = "COALESCE({alias}.score, FALSE)".format(alias=alias)
+            return self.query.equals_filter_clause(column, predicate["values"], "true")
+
+        _log.error("Unknown filter type: %s", filter_type)
+        raise RuntimeError(self.error_msg)
+
+    def get_entity_id_col(self):
+        if self.entity_id_col is None:
+            raise RuntimeError(self.error_msg)
+        return self.entity_id_col
+
+    def add_join(self, joins, key, score_sql):
+        # returns the alias of the join, the same score is only joined once
+        if key not in joins:
+            alias = "j{index}".format(index=len(joins))
+            join_sql = "LEFT OUTER JOIN ({score_sql}) {alias} ON base.{entity_id_col} = {alias}.{entity_id_col}".format(
+                score_sql=score_sql, alias=alias, entity_id_col=self.get_entity_id_col()
+            )
+            joins[key] = (alias, join_sql)
+        return joins[key][0]
+
+    def add_gene_score_join(self, cohort_filter, predicate, joins):
+        key = ("geneScore", predicate["table"], predicate["attribute"], predicate["ensg"])
+        score_sql = (
+            "SELECT attr.{entity_id_col}, attr.{attribute} AS score FROM {schema}.tdp_{table} attr "
+            "INNER JOIN public.tdp_gene gene ON attr.ensg = gene.ensg "
+            "WHERE gene.species = {species} AND attr.ensg = '{ensg}'".format(
+                entity_id_col=self.get_entity_id_col(),
+                attribute=predicate["attribute"],
+                schema=cohort_filter.entity_schema,
+                table=predicate["table"],
+                species="'human'",
+                ensg=predicate["ensg"],
+            )
+        )
+        return self.add_join(joins, key, score_sql)
+
+    def add_depletion_score_join(self, predicate, joins):
+        key = ("depletionScore", predicate["table"], predicate["attribute"], predicate["ensg"], predicate["depletionscreen"])
+        score_sql = (
+            "SELECT attr.celllinename, attr.{attribute} AS score FROM cellline.tdp_{table} attr "
+            "INNER JOIN public.tdp_gene gene ON attr.ensg = gene.ensg "
+            "WHERE gene.species = {species} AND attr.ensg = '{ensg}' AND attr.depletionscreen = '{screen}'".format(
+                attribute=predicate["attribute"],
+                table=predicate["table"],
+                species="'human'",
+                ensg=predicate["ensg"],
+                screen=predicate["depletionscreen"],
+            )
+        )
+        return self.add_join(joins, key, score_sql)
+
+    def add_panel_join(self, cohort_filter, predicate, joins):
+        key = ("panel", predicate["panel"])
+        panel_table = "tdp_geneassignment" if cohort_filter.entity_table == "tdp_gene" else "tdp_panelassignment"
+        score_sql = "SELECT a.{entity_id_col}, TRUE as score FROM {schema}.{panel_table} a WHERE panel = '{panel}'".format(
+            entity_id_col=self.get_entity_id_col(), schema=cohort_filter.entity_schema, panel_table=panel_table, panel=predicate["panel"]
+        )
+        return self.add_join(joins, key, score_sql)
@@ -0,0 +1,56 @@
+import logging
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from .settings import get_settings
+
+_log = logging.getLogger(__name__)
+
+config = get_settings()
+
+
+class ParallelExecutor:
+    """Runs independent tasks of the requests (e.g. the sizes of several cohorts) on a bounded thread pool
+    The pool is shared by all requests of the worker, a request runs at most request_limit of its tasks at the same time,
+    so one request can not take all connections of a pool.
+    """
+
+    def __init__(self, max_workers, request_limit):
+        self.pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="coral-parallel")
+        self.request_limit = request_limit
+
+    def map(self, function, items, limit=None):
+        """Return [function(item) for item in items], computed concurrently with at most limit (default request_limit)
+        running tasks. The first error of a task is raised, the tasks that did not start yet are cancelled.
+        """
+        items = list(items)
+        limit = min(limit or self.request_limit, len(items))
+        if limit <= 1:
+            return [function(item) for item in items]
+
+        results = [None] * len(items)
+        remaining = iter(enumerate(items))
+        running = {}  # future -> index of its item
+
+        def submit_next():
+            for index, item in remaining:
+                running[self.pool.submit(function, item)] = index
+                return
+
+        for _ in range(limit):
+            submit_next()
+
+        try:
+            while running:
+                done, _not_done = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    results[running.pop(future)] = future.result()
+                    submit_next()
+        except BaseException:
+            for future in running:
+                future.cancel()
+            raise
+
+        return results
+
+
+parallel_executor = ParallelExecutor(config.parallel_workers, config.parallel_request_limit)
@@ -1,16 +1,36 @@
-import decimal
+import base64
 import logging
 import os
 import sys
 
-from flask import jsonify
-from sqlalchemy import create_engine, exc, inspect, text
+from flask import Response, g, has_request_context, json, jsonify, stream_with_context
+from sqlalchemy import exc, inspect, text
 from sqlalchemy.exc import NoInspectionAvailable
 from sqlalchemy.orm import sessionmaker
-from visyn_core import manager
 
 from .settings import get_settings
+from .sql_bitmap import bitmap_size, cohort_bitmaps, difference, encode_bitmap, intersection, union
+from .sql_cancel import QueryCancelledError, get_request_ids, running_queries
+from .sql_cohort_cache import NOTIFY_CHANNEL, cohort_cache
+from .sql_engines import COHORT_DATABASE, ENGINE_PRIMARY, ENGINE_SECONDARY, engine_registry, get_engine
+from .sql_filter import (
+    FILTER_DEPLETION_NUM,
+    FILTER_EQUALS,
+    FILTER_GENE_EQUALS,
+    FILTER_GENE_NUM,
+    FILTER_NUM,
+    FILTER_PANEL,
+    FILTER_TREATMENT,
+    PREVIEW_PARAMETERS,
+    CohortFilter,
+    FilterCompiler,
+)
+from .sql_parallel import parallel_executor
+from .sql_response import MIMETYPE_ARROW, MIMETYPE_NDJSON, RowDecoder, arrow_stream, dumps_json, json_response
+from .sql_score_cache import score_vectors
+from .sql_stats import stats_catalog
 from .sql_tables import Cohort
+from .sql_treatment import treatment_rows_sql, treatment_tables
 
 _log = logging.getLogger(__name__)
 logging.getLogger("sqlalchemy").setLevel(logging.INFO)
@@ -19,61 +39,80 @@ file_dir = os.path.dirname(__file__)
 sys.path.append(file_dir)
 
 config = get_settings()
-config_ordino = manager.settings.get_nested("tdp_publicdb", {})
-config_student = manager.settings.get_nested("tdp_student", {})
-config_covid19 = manager.settings.get_nested("tdp_covid19", {})
 
 COLUMN_LABEL_SCORE = "score"
 COLUMN_LABEL_ID = "id"
 VALUE_LIST_DELIMITER = "&#x2e31;"
 
+# bins of the numeric histograms (parameters bins and binning)
+HIST_BINS = 10
+HIST_MAX_BINS = 200
+HIST_BINNING_EQUAL = "equal"  # bins of the same width between the min and max of the entity table
+HIST_BINNING_QUANTILE = "quantile"  # bins with the same number of entities of the cohort
+HIST_BINNINGS = [HIST_BINNING_EQUAL, HIST_BINNING_QUANTILE]
+
+# column of the page statements with the sort value of the rows as text (see get_cohort_page_sql)
+PAGE_SORT_VALUE_COLUMN = "coral_sort_value"
+
+# set operations of the cohorts -> sql operator of the ids
+SET_OPERATION_UNION = "union"
+SET_OPERATION_INTERSECTION = "intersection"
+SET_OPERATION_DIFFERENCE = "difference"
+SET_OPERATIONS = {SET_OPERATION_UNION: "UNION", SET_OPERATION_INTERSECTION: "INTERSECT", SET_OPERATION_DIFFERENCE: "EXCEPT"}
+
+# identifier column of the entity tables, used to store the cohort membership in cohort.cohort_entity
+ENTITY_ID_COLUMNS = {
+    "tdp_tissue": "tissuename",
+    "tdp_tissue_2": "tissuename",
+    "tdp_cellline": "celllinename",
+    "tdp_gene": "ensg",
+    "student_view_anonym": "id",
+    "korea": "id",
+}
+# entity tables of the samples, only they have treatments and gene scores
+SAMPLE_TABLES = ("tdp_tissue", "tdp_tissue_2", "tdp_cellline")
+# table with the panel assignments of the entity tables
+PANEL_TABLES = {
+    "tdp_tissue": "tdp_panelassignment",
+    "tdp_tissue_2": "tdp_panelassignment",
+    "tdp_cellline": "tdp_panelassignment",
+    "tdp_gene": "tdp_geneassignment",
+}
+
 
-# create engine also creates QueuePool for connections
-# pool_pre_ping tests if the connection is still working: https://docs.sqlalchemy.org/en/13/core/pooling.html#disconnect-handling-pessimistic
 _log.info("statement_timeout: %s", config.statement_timeout)
 _log.info("connection_pool_overflow: %s", config.connection_pool_overflow)
 _log.info("connection_pool_size: %s", config.connection_pool_size)
 
 
-def create_engines(dburl):
-    primary_connection_config = {"options": "-c statement_timeout={}".format(config.statement_timeout)}
-    secondary_connection_config = {"options": "-c statement_timeout={}".format(config.supp_statement_timeout)}
-    return {
-        "primary": create_engine(
-            dburl,
-            pool_pre_ping=True,
-            connect_args=primary_connection_config,
-            pool_timeout=int(config.statement_timeout) / 1000.0,
-            max_overflow=config.connection_pool_overflow,
-            pool_size=config.connection_pool_size,
-            echo=True,
-            echo_pool=True,
-        ),
-        "secondary": create_engine(
-            dburl,
-            pool_pre_ping=True,
-            connect_args=secondary_connection_config,
-            pool_timeout=int(config.supp_statement_timeout) / 1000.0,
-            max_overflow=config.connection_pool_overflow,
-            pool_size=config.connection_pool_size,
-        ),
-    }
-
-
-engine = create_engines(config.dburl)["primary"]
-if config_ordino.get("dburl") is not None:
-    engine_ordino = create_engines(config_ordino.get("dburl"))
-if config_student.get("dburl") is not None:
-    engine_student = create_engines(config_student.get("dburl"))
-if config_covid19.get("dburl") is not None:
-    engine_covid19 = create_engines(config_covid19.get("dburl"))
-
-
 class QueryElements:
-    def __init__(self):
+    def __init__(self, parent=None):
 
-        self.engine = engine
+        self.engine = get_engine(COHORT_DATABASE)
         self.session = self.init_session()
+        # connections of this request per engine (see get_connection) and the statement timeout set in their transaction
+        self.connections = {}
+        self.statement_timeouts = {}
+        # user and client supplied id of the request (and group of superseding requests), the running statements can be cancelled
+        self.request_user, self.request_id, self.request_group = get_request_ids()
+        # queries run by execute_parallel for a request (parent) are cancelled with it and use the same bind parameters
+        self.parent = parent
+        if parent is not None:
+            self.request_user, self.request_id, self.request_group = parent.request_user, parent.request_id, None
+        if has_request_context() and parent is None:
+            # the connections are returned to the pools at the end of the request
+            g.setdefault("coral_queries", []).append(self)
+        # bind parameters (e.g. the entity ids of a cohort) that are referenced by the generated sql statements
+        self.sql_params = {}
+        # cohorts whose entities are already evaluated in a common table expression of the statement (cohort id -> name)
+        self.shared_entities = {}
+        # stored membership of the cohorts, read once per request (cohort id -> entity ids, cohort id -> membership is stored)
+        self.cohort_entity_ids = {}
+        self.stored_memberships = {}
+        if parent is not None:
+            self.sql_params.update(parent.sql_params)
+            self.cohort_entity_ids = parent.cohort_entity_ids
+            self.stored_memberships = parent.stored_memberships
 
     def init_session(self):
         session = None
@@ -100,12 +139,32 @@ class QueryElements:
             result[COLUMN_LABEL_ID] = row[1]
             return result
 
-    def add_cohort_to_db(self, cohort):
+    def add_cohort_to_db(self, cohort, entity_ids=None):
         result = []
 
+        # resolve the entities of the new cohort before the transaction on the cohort db is opened, if they are not known
+        if entity_ids is None:
+            entity_ids = self.resolve_cohort_entity_ids(cohort)
+
+        if entity_ids is not None:
+            cohort.size = len(entity_ids)  # the size of a cohort does not change, store it with the cohort
+            cohort.bitmap = encode_bitmap(cohort_bitmaps.create_bitmap(self, cohort, entity_ids))
+
         try:
             # define the sql statement
             self.session.add(cohort)
+            self.session.flush()  # assigns the id of the new cohort
+
+            if entity_ids is not None:
+                # store the membership of the cohort in the same transaction
+                self.session.execute(
+                    text(
+                        "INSERT INTO cohort.cohort_entity (cohort_id, entity_id) "
+                        "SELECT :cohort_id, UNNEST(CAST(:entity_ids AS varchar[]))"
+                    ),
+                    {"cohort_id": cohort.id, "entity_ids": entity_ids},
+                )
+
             self.session.commit()
 
             _log.info("Created cohort %s", cohort.id)
@@ -129,6 +188,149 @@ class QueryElements:
 
         return jsonify(result)
 
+    def get_entity_id_col(self, entity_table):
+        return ENTITY_ID_COLUMNS.get(entity_table)
+
+    def get_sample_id_col(self, entity_table, error_msg):
+        if entity_table not in SAMPLE_TABLES:
+            raise RuntimeError(error_msg)
+        return ENTITY_ID_COLUMNS[entity_table]
+
+    def get_panel_columns(self, entity_table, error_msg):
+        """Return the id column and the panel assignment table of the entity table"""
+        if entity_table not in PANEL_TABLES:
+            raise RuntimeError(error_msg)
+        return ENTITY_ID_COLUMNS[entity_table], PANEL_TABLES[entity_table]
+
+    def resolve_cohort_entity_ids(self, cohort):
+        """Return the ids of the entities that belong to the new cohort by executing its statement (or only its new predicate
+        on the stored ids of its parent, see get_refinement) once
+        Initial cohorts contain the whole entity table and are not materialized (None is returned).
+        """
+        entity_id_col = self.get_entity_id_col(cohort.entity_table)
+        if int(cohort.is_initial) == 1 or entity_id_col is None:
+            return None
+
+        sql_text = "SELECT DISTINCT p.{entity_id_col}::varchar AS entity_id FROM ({entities}) p".format(
+            entity_id_col=entity_id_col, entities=self.get_cohort_entities_sql(cohort, [entity_id_col])
+        )
+        rows = self.execute_sql_query_as_dict(sql_text, cohort.entity_database)
+        return [row["entity_id"] for row in rows if row["entity_id"] is not None]
+
+    def get_cohort_entity_ids(self, cohort):
+        # the stored ids of a cohort, read once per request
+        if cohort.id not in self.cohort_entity_ids:
+            sql_text = "SELECT entity_id FROM cohort.cohort_entity WHERE cohort_id = :cohort_id"
+            rows = self.execute_sql_query_as_dict(sql_text, "cohort", params={"cohort_id": cohort.id})
+            self.cohort_entity_ids[cohort.id] = [row["entity_id"] for row in rows]
+        return self.cohort_entity_ids[cohort.id]
+
+    def is_membership_stored(self, cohort):
+        """Return if the membership of a stored cohort is in cohort.cohort_entity, checked once per request
+        Initial cohorts and cohorts created before the membership was stored are evaluated with their statement.
+        """
+        if cohort.id is None or int(cohort.is_initial) == 1 or self.get_entity_id_col(cohort.entity_table) is None:
+            return False
+
+        if cohort.id not in self.stored_memberships:
+            if cohort.size == 0:
+                stored = True  # nothing to store
+            elif cohort.id in self.cohort_entity_ids or not self.is_cohort_database(cohort.entity_database):
+                stored = len(self.get_cohort_entity_ids(cohort)) > 0  # the ids are bound to the statements anyway
+            else:
+                sql_text = "SELECT EXISTS (SELECT 1 FROM cohort.cohort_entity WHERE cohort_id = :cohort_id) AS stored"
+                stored = self.execute_sql_query_as_dict(sql_text, "cohort", params={"cohort_id": cohort.id})[0]["stored"]
+            self.stored_memberships[cohort.id] = stored
+        return self.stored_memberships[cohort.id]
+
+    def is_cohort_database(self, database):
+        # the cohorts are stored in the entity database, so cohort.cohort_entity can be joined in its statements
+        return engine_registry.get_dburl(database) == engine_registry.get_dburl(COHORT_DATABASE)
+
+    def get_membership_condition(self, cohort, column):
+        """Return the sql condition that restricts the entity id column to the stored members of a cohort, None if the
+        membership of the cohort is not stored
+        If the cohorts are stored in the entity database, cohort.cohort_entity is joined in the statement, otherwise its
+        ids are bound as array parameter.
+        """
+        if not self.is_membership_stored(cohort):
+            return None
+
+        if self.is_cohort_database(cohort.entity_database):
+            return "{column}::varchar IN (SELECT ce.entity_id FROM cohort.cohort_entity ce WHERE ce.cohort_id = {cohort_id})".format(
+                column=column, cohort_id=int(cohort.id)
+            )
+
+        param_name = self.cohort_ids_param(cohort)
+        self.sql_params[param_name] = self.get_cohort_entity_ids(cohort)
+        return "{column}::varchar = ANY(:{param_name})".format(column=column, param_name=param_name)
+
+    def get_cohort_members(self, cohort):
+        # ids of all entities of a stored cohort, from the stored membership or by executing the statement
+        entity_id_col = self.get_entity_id_col(cohort.entity_table)
+        if self.is_membership_stored(cohort):
+            return self.get_cohort_entity_ids(cohort)
+
+        sql_text = "SELECT DISTINCT p.{entity_id_col}::varchar AS entity_id FROM ({entities}) p".format(
+            entity_id_col=entity_id_col, entities=self.get_cohort_entities_sql(cohort, [entity_id_col])
+        )
+        rows = self.execute_sql_query_as_dict(sql_text, cohort.entity_database)
+        return [row["entity_id"] for row in rows if row["entity_id"] is not None]
+
+    def get_cohort_entities_sql(self, cohort, columns=None):
+        """Return the sql statement for the entities of a stored cohort
+        If the membership of the cohort is stored in cohort.cohort_entity, the entity table is filtered by these ids
+        instead of executing the (nested) statement of the cohort and all its predecessors.
+        columns : list of the columns to select (None for all columns), the projection is pushed into the scan of the
+          entity table wherever the statement is created here
+        """
+        if cohort.id in self.shared_entities:
+            return "SELECT {columns} FROM {name}".format(columns=self.column_list(None, columns), name=self.shared_entities[cohort.id])
+
+        entity_id_col = self.get_entity_id_col(cohort.entity_table)
+        refinement = getattr(cohort, "refinement", None)
+        if cohort.id is None and refinement is not None:
+            # refined cohort that is not stored (yet), only its new predicate is evaluated on the members of the parent
+            parent_condition, cohort_filter = refinement
+            compiler = FilterCompiler(self, entity_id_col, "Filters of the cohort can not be compiled")
+            return compiler.compile(cohort_filter, self.column_list("base", columns), parent_condition)
+
+        condition = self.get_membership_condition(cohort, "e.{entity_id_col}".format(entity_id_col=entity_id_col))
+        if condition is None:
+            return self.project_statement(cohort, columns)
+
+        return "SELECT {columns} FROM {schema}.{table} e WHERE {condition}".format(
+            columns=self.column_list("e", columns), schema=cohort.entity_schema, table=cohort.entity_table, condition=condition
+        )
+
+    def cohort_ids_param(self, cohort):
+        # name of the bind parameter with the ids of a stored cohort (see get_membership_condition)
+        return "cohort_ids_{id}".format(id=cohort.id)
+
+    def project_statement(self, cohort, columns):
+        # select the columns from the statement of the cohort, compiled from its filters if they are known
+        if columns is None:
+            return cohort.statement
+
+        cohort_filter = self.get_cohort_filter(cohort)
+        if cohort_filter is not None:
+            compiler = FilterCompiler(self, self.get_entity_id_col(cohort.entity_table), "Filters of the cohort can not be compiled")
+            return compiler.compile(cohort_filter, self.column_list("base", columns))
+
+        return "SELECT {columns} FROM ({statement}) p".format(columns=self.column_list("p", columns), statement=cohort.statement)
+
+    def column_list(self, prefix, columns):
+        prefix = "" if prefix is None else prefix + "."
+        if columns is None:
+            return prefix + "*"
+        return ", ".join(prefix + column for column in columns)
+
+    def add_sql_param(self, name, value):
+        """Register a bind parameter for the generated sql statements and return its unique name"""
+        param_name = "{name}_{index}".format(name=name, index=len(self.sql_params))
+        self.sql_params[param_name] = value
+        return param_name
+
     def get_cohorts_by_id_sql(self, args, error_msg):
         # print('in function "get_cohorts_by_id_sql"')
         str_values = ""  # for the equal values
@@ -147,7 +349,7 @@ class QueryElements:
 
         str_values = str_values[:-2] if cnt > 0 else "-1"  # returns no cohorts -> ids are only positiv
 
-        sql_text = "SELECT id, name, is_initial, previous_cohort, entity_database, entity_schema, entity_table FROM cohort.cohort c WHERE c.id IN ({str_values})".format(
+        sql_text = "SELECT id, name, is_initial, previous_cohort, entity_database, entity_schema, entity_table, size FROM cohort.cohort c WHERE c.id IN ({str_values})".format(
             str_values=str_values
         )
         # print('sql_text', sql_text)
@@ -157,8 +359,9 @@ class QueryElements:
         # print('in function "update_cohort_name_sql"')
         result = []
         cohort_id = args.get("cohortId")
-        if cohort_id is None:
+        if cohort_id is None or not str(cohort_id).strip().isdigit():
             raise RuntimeError(error_msg)
+        cohort_id = int(cohort_id)
 
         name = args.get("name")
         if name is None:
@@ -166,9 +369,10 @@ class QueryElements:
 
         try:
             # create session for the data
-            session_data = sessionmaker(bind=engine)()
+            session_data = sessionmaker(bind=self.engine)()
 
             session_data.query(Cohort).filter(Cohort.id == cohort_id).update({Cohort.name: name}, synchronize_session=False)
+            self.notify_cohort_changed(session_data, cohort_id)
             # synchronize_session
             # False - don`t synchronize the session. This option is the most efficient and is reliable once the session is expired,
             # which typically occurs after a commit(), or explicitly using expire_all(). Before the expiration,
@@ -176,9 +380,10 @@ class QueryElements:
 
             # commit update
             session_data.commit()
+            cohort_cache.invalidate(cohort_id)
 
             # get updated cohort
-            sql_text = "SELECT id, name, is_initial, previous_cohort, entity_database, entity_schema, entity_table FROM cohort.cohort c WHERE c.id = {cohortId}".format(
+            sql_text = "SELECT id, name, is_initial, previous_cohort, entity_database, entity_schema, entity_table, size FROM cohort.cohort c WHERE c.id = {cohortId}".format(
                 cohortId=cohort_id
             )
             result = self.execute_sql_query_as_dict(sql_text, "cohort")
@@ -198,19 +403,35 @@ class QueryElements:
         if cohort_id is None:
             raise RuntimeError(error_msg)
 
+        cache_key = int(cohort_id) if str(cohort_id).strip().isdigit() else None
+        row = cohort_cache.get(cache_key) if cache_key is not None else None
+        if row is not None:
+            return Cohort(**row)  # every request gets its own Cohort object
+
+        connection = self.get_connection("cohort")
         try:
-            # get cohort
-            cohort = self.session.query(Cohort).filter(text("id=:id_no")).params(id_no=cohort_id).one()
+            # get cohort, with a core query on the connection of the request
+            row = dict(connection.execute(Cohort.__table__.select().where(Cohort.id == cohort_id)).one())
 
-            result = cohort
+            result = Cohort(**row)
         except exc.SQLAlchemyError as e:
-            _log.error("SQLAlchemy Error: ", e)
+            _log.error("SQLAlchemy Error: %s", e)
+            self.discard_connection(connection)
             raise
-        finally:
-            self.session.close()
+
+        if cache_key is not None:
+            cohort_cache.put(cache_key, row)
         return result
 
-    def execute_sql_query_as_dict(self, sql_text, db_connector, supplemental_data=False, custom_statement_timeout=None):
+    def notify_cohort_changed(self, session, cohort_id):
+        """Notify the other workers of the change of the cohort (in the transaction of the session that changes it)
+        With cohort_cache_notify they invalidate its cached row when the transaction is committed. The row cached by this
+        worker has to be invalidated after the commit, before it a concurrent request could cache the old row again.
+        """
+        if config.cohort_cache_notify:
+            session.execute(text("SELECT pg_notify(:channel, :payload)"), {"channel": NOTIFY_CHANNEL, "payload": str(cohort_id)})
+
+    def execute_sql_query_as_dict(self, sql_text, db_connector, supplemental_data=False, custom_statement_timeout=None, params=None):
         """Return query result as dict
         sql_text : string
           the sql query
@@ -218,65 +439,198 @@ class QueryElements:
           which db to use
         custom_statement_timeout : Integer in millis
           pass a custom timeout (if None, the statement_timeout from config is used)
+        params : dict
+          additional bind parameters, the ones collected in sql_params are always used
         """
         result = []
 
-        # define the right engine to use for the data
-        engine_data = None
-        session_data = None
-        engine_type = "primary" if not supplemental_data else "secondary"
-
-        if db_connector == "tdp_publicdb":
-            engine_data = engine_ordino[engine_type]
-        elif db_connector == "tdp_student":
-            engine_data = engine_student[engine_type]
-        elif db_connector == "tdp_covid19":
-            engine_data = engine_covid19[engine_type]
-        elif db_connector == "cohort":
-            engine_data = engine
-        else:
-            _log.error("Unknown db connector: %s", db_connector)
-            raise Exception("Unknown db connector")
+        # the connection of this request to the database
+        connection = self.get_connection(db_connector, supplemental_data)
 
         try:
-            # create session for the data
-            session_data = sessionmaker(bind=engine_data)()
-
             # create sql query from text
             statement = text(sql_text)
 
-            # set statement timeout if given
-            if custom_statement_timeout is not None:
-                _log.info("set statement_timeout to {}".format(custom_statement_timeout))
-                session_data.execute(config.statement_timeout_query.format(custom_statement_timeout))
+            # set statement timeout for the transaction of this request
+            self.set_statement_timeout(connection, custom_statement_timeout)
 
             # execute statement
-            rows = session_data.execute(statement).fetchall()
-
-            # transform row into a dictionary
-            for row in rows:
-                # create dictionary of row
-                row_dict = dict(row)
-                # iterate over all key:value pairs
-                for key in row_dict:
-                    if isinstance(row_dict[key], decimal.Decimal):
-                        # cast decimal to float
-                        row_dict[key] = float(row_dict[key])
-
-                result.append(row_dict)
+            bind_params = dict(self.sql_params)
+            if params is not None:
+                bind_params.update(params)
+            running = self.start_statement(connection)
+            try:
+                query_result = connection.execute(statement, bind_params)
+                decoder = RowDecoder(query_result)  # before the rows are fetched, which closes the cursor
+                rows = query_result.fetchall()
+            finally:
+                self.finish_statement(running)
+            self.check_cancelled()
+
+            # transform the rows into dictionaries
+            result = decoder.decode(rows)
 
         except exc.SQLAlchemyError as e:
+            self.discard_connection(connection)  # the transaction is aborted
+            if self.request_id is not None and running_queries.is_cancelled(self.request_user, self.request_id):
+                _log.info("Request %s was cancelled", self.request_id)
+                raise QueryCancelledError(self.request_id) from e
             _log.error("SQLAlchemy Error: %s", e)
             raise
         finally:
             self.session.close()
-            session_data.close()
 
         return result
 
-    def execute_sql_query(self, sql_text, database, supplemental_data=False, custom_statement_timeout=None):
-        result = self.execute_sql_query_as_dict(sql_text, database, supplemental_data, custom_statement_timeout)
-        return jsonify(result)
+    def start_statement(self, connection):
+        # register the statement of a request with id, so pg_cancel_backend can be sent for its connection
+        # raises QueryCancelledError before the statement is executed if the request is already cancelled
+        if self.request_id is None:
+            return None
+        backend_pid = connection.connection.get_backend_pid()
+        return running_queries.start(self.request_user, self.request_id, self.request_group, connection.engine, backend_pid)
+
+    def finish_statement(self, running):
+        if running is not None:
+            running_queries.finish(self.request_user, self.request_id, running)
+
+    def check_cancelled(self):
+        # a request cancelled while its statement ran to the end (or between its statements) does not return the rows
+        if self.request_id is not None and running_queries.is_cancelled(self.request_user, self.request_id):
+            _log.info("Request %s was cancelled", self.request_id)
+            raise QueryCancelledError(self.request_id)
+
+    def get_connection(self, db_connector, supplemental_data=False):
+        """Return the connection of this request for the database
+        The connection is checked out once per engine and kept (in one transaction) until close(), so the cohort lookup and
+        the data queries of a request share it if the cohorts and the entities are in the same database.
+        """
+        engine_data = self.get_data_engine(db_connector, supplemental_data)
+        if engine_data not in self.connections:
+            connection = engine_data.connect()
+            connection.begin()
+            self.connections[engine_data] = connection
+            self.statement_timeouts[engine_data] = None
+        return self.connections[engine_data]
+
+    def commit_connection(self, db_connector):
+        """Commit the transaction of the connection of this request to the database and start a new one, e.g. after a write
+        that is kept even if the request fails
+        """
+        connection = self.get_connection(db_connector)
+        try:
+            connection.get_transaction().commit()
+        except exc.SQLAlchemyError as e:
+            _log.error("SQLAlchemy Error: %s", e)
+            self.discard_connection(connection)
+            raise
+        connection.begin()
+        self.statement_timeouts[connection.engine] = None  # SET LOCAL ended with the transaction
+
+    def set_statement_timeout(self, connection, custom_statement_timeout):
+        # SET LOCAL only lasts until the end of the transaction, the pooled connection keeps the timeout of its engine
+        engine_data = connection.engine
+        if self.statement_timeouts.get(engine_data) == custom_statement_timeout:
+            return
+
+        if custom_statement_timeout is not None:
+            _log.info("set statement_timeout to {}".format(custom_statement_timeout))
+            connection.execute(text(config.statement_timeout_local_query.format(custom_statement_timeout)))
+        else:
+            connection.execute(text(config.statement_timeout_local_query.format("DEFAULT")))
+        self.statement_timeouts[engine_data] = custom_statement_timeout
+
+    def discard_connection(self, connection):
+        self.connections.pop(connection.engine, None)
+        self.statement_timeouts.pop(connection.engine, None)
+        connection.close()
+
+    def close(self):
+        # returns the connections of this request to their pools
+        for connection in list(self.connections.values()):
+            self.discard_connection(connection)
+        self.session.close()
+        if self.request_id is not None and self.parent is None:
+            running_queries.end_request(self.request_user, self.request_id, self.request_group)
+
+    def execute_parallel(self, function, items):
+        """Return [function(query, item) for item in items], run concurrently (see sql_parallel)
+        The items have to be independent, every function call gets its own QueryElements (with its own connections).
+        """
+
+        def run(item):
+            query = QueryElements(parent=self)
+            try:
+                return function(query, item)
+            finally:
+                query.close()
+
+        return parallel_executor.map(run, items)
+
+    def execute_sql_query(self, sql_text, database, supplemental_data=False, custom_statement_timeout=None, params=None):
+        result = self.execute_sql_query_as_dict(sql_text, database, supplemental_data, custom_statement_timeout, params)
+        return json_response(result)
+
+    def stream_sql_query(
+        self, sql_text, database, supplemental_data=False, custom_statement_timeout=None, params=None, mimetype=MIMETYPE_NDJSON
+    ):
+        """Return the query result as streamed response of newline delimited json (one row per line) or as arrow ipc stream
+        The rows are fetched from a server side cursor in chunks of stream_fetch_size rows, so the memory stays flat
+        and the first rows are sent before the query is completely read.
+        """
+        engine_data = self.get_data_engine(database, supplemental_data)
+        bind_params = dict(self.sql_params)
+        if params is not None:
+            bind_params.update(params)
+
+        # execute the statement before the response starts, so errors are raised in the route
+        # the stream has its own connection and transaction, the timeout is set with SET LOCAL and ends with it
+        connection = engine_data.connect()
+        connection.begin()
+        running = None
+        try:
+            if custom_statement_timeout is not None:
+                _log.info("set statement_timeout to {}".format(custom_statement_timeout))
+                connection.execute(text(config.statement_timeout_local_query.format(custom_statement_timeout)))
+
+            # the statement can be cancelled (see sql_cancel) until the last row is fetched
+            running = self.start_statement(connection)
+            # stream_results uses a named (server side) cursor
+            result = connection.execution_options(stream_results=True).execute(text(sql_text), bind_params)
+            self.check_cancelled()
+        except (exc.SQLAlchemyError, QueryCancelledError) as e:
+            self.finish_statement(running)
+            connection.close()
+            if self.request_id is not None and running_queries.is_cancelled(self.request_user, self.request_id):
+                _log.info("Request %s was cancelled", self.request_id)
+                raise QueryCancelledError(self.request_id) from e
+            _log.error("SQLAlchemy Error: %s", e)
+            raise
+        finally:
+            self.session.close()
+
+        def generate():
+            try:
+                if mimetype == MIMETYPE_ARROW:
+                    yield from arrow_stream(result, config.stream_fetch_size)
+                    return
+
+                decoder = RowDecoder(result)
+                while True:
+                    rows = result.fetchmany(config.stream_fetch_size)
+                    if len(rows) == 0:
+                        break
+                    yield b"".join(dumps_json(row) + b"\n" for row in decoder.decode(rows))
+            finally:
+                # the statement is finished before the connection returns to the pool, so it can not be cancelled there
+                self.finish_statement(running)
+                connection.close()
+
+        return Response(stream_with_context(generate()), mimetype=mimetype)
+
+    def get_data_engine(self, db_connector, supplemental_data=False):
+        # supplemental data (e.g. histograms) is queried with the secondary engine
+        return get_engine(db_connector, ENGINE_PRIMARY if not supplemental_data else ENGINE_SECONDARY)
 
     def create_cohort(self, args, error_msg):
         # check all parameters
@@ -315,11 +669,66 @@ class QueryElements:
             entity_schema=entity_schema,
             entity_table=entity_table,
             statement=statement,
+            filters=CohortFilter(entity_schema, entity_table).to_json(),
         )
 
         return new_cohort
 
+    def get_cohort_filter(self, cohort):
+        # returns the structured filter of the cohort, None for cohorts that were created before the filters were stored
+        if cohort.filters is not None:
+            return CohortFilter.from_json(cohort.filters, cohort.entity_database)
+        if int(cohort.is_initial) == 1:
+            return CohortFilter(cohort.entity_schema, cohort.entity_table, entity_database=cohort.entity_database)
+        return None
+
+    def compile_filter_sql(self, cohort_filter, error_msg):
+        # the statement stored with the cohort
+        compiler = FilterCompiler(self, self.get_entity_id_col(cohort_filter.entity_table), error_msg, stored=True)
+        return compiler.compile(cohort_filter)
+
+    def create_filtered_cohort(self, name, cohort, predicate, nested_sql_text, error_msg):
+        """Return a new cohort that refines the given cohort with the predicate
+        The statement is compiled flat from the entity table and the predicates of the whole lineage.
+        Only if the filters of the parent cohort are unknown, its statement is wrapped (nested_sql_text).
+        """
+        statement = nested_sql_text
+        filters = None
+        cohort_filter = self.get_cohort_filter(cohort)
+        if cohort_filter is not None:
+            cohort_filter = cohort_filter.add_predicate(predicate)
+            statement = self.compile_filter_sql(cohort_filter, error_msg)
+            filters = cohort_filter.to_json()
+
+        new_cohort = Cohort(
+            name=name,
+            previous_cohort=cohort.id,
+            is_initial=0,
+            entity_database=cohort.entity_database,
+            entity_schema=cohort.entity_schema,
+            entity_table=cohort.entity_table,
+            statement=statement,
+            filters=filters,
+        )
+        # the stored statement is self-contained, the size, data and membership of the new cohort are evaluated on the
+        # entities of the parent
+        new_cohort.refinement = self.get_refinement(cohort, predicate)
+        return new_cohort
+
+    def get_refinement(self, cohort, predicate):
+        """Return the condition on the stored members of the parent cohort and the filter with the new predicate of a
+        refined cohort, None if the members of the parent are not stored (see is_membership_stored)
+        """
+        entity_id_col = self.get_entity_id_col(cohort.entity_table)
+        parent_condition = self.get_membership_condition(cohort, "base.{entity_id_col}".format(entity_id_col=entity_id_col))
+        if parent_condition is None:
+            return None
+        return parent_condition, CohortFilter(cohort.entity_schema, cohort.entity_table, [predicate], cohort.entity_database)
+
     def equals_filter_statement(self, prefix, attribute, values, numeric):
+        return self.equals_filter_clause("{prefix}.{attribute}".format(prefix=prefix, attribute=attribute), values, numeric)
+
+    def equals_filter_clause(self, column, values, numeric):
         values_split = values.split(VALUE_LIST_DELIMITER)
         str_values = ""  # for the equal values
         str_not_values = ""  # for the NOT equals values
@@ -353,15 +762,12 @@ class QueryElements:
         str_values_query = ""
 
         if add_equals_value and add_equals_not_value:  # both equals and not equals values are defined
-            str_values_query = "({prefix}.{attribute} IN ({str_values}) AND {prefix}.{attribute} NOT IN ({str_not_values}))".format(
-                prefix=prefix, attribute=attribute, str_values=str_values, str_not_values=str_not_values
+            str_values_query = "({column} IN ({str_values}) AND {column} NOT IN ({str_not_values}))".format(
+                column=column, str_values=str_values, str_not_values=str_not_values
             )
             if add_equals_null:
-                str_values_query = (
-                    "({prefix}.{attribute} IN ({str_values}) AND {prefix}.{attribute} NOT IN ({str_not_values})) "
-                    "OR {prefix}.{attribute} IS NULL".format(
-                        prefix=prefix, attribute=attribute, str_values=str_values, str_not_values=str_not_values
-                    )
+                str_values_query = "({column} IN ({str_values}) AND {column} NOT IN ({str_not_values})) OR {column} IS NULL".format(
+                    column=column, str_values=str_values, str_not_values=str_not_values
                 )
         else:
             # add VALUES
@@ -373,8 +779,8 @@ class QueryElements:
                     str_not_values_prefix = "NOT "
                     values = str_not_values
 
-                str_values_query = "{prefix}.{attribute} {str_not_values_prefix}IN ({values})".format(
-                    prefix=prefix, attribute=attribute, str_not_values_prefix=str_not_values_prefix, values=values
+                str_values_query = "{column} {str_not_values_prefix}IN ({values})".format(
+                    column=column, str_not_values_prefix=str_not_values_prefix, values=values
                 )
 
             # add NULL
@@ -390,8 +796,8 @@ class QueryElements:
                 if not add_equals_value and not add_equals_not_value:
                     str_concat = ""  # if there is no WHERE for values than set concat string to ''
 
-                str_null_value = "{str_concat}{prefix}.{attribute} IS {str_not_null}NULL".format(
-                    str_concat=str_concat, prefix=prefix, attribute=attribute, str_not_null=str_not_null
+                str_null_value = "{str_concat}{column} IS {str_not_null}NULL".format(
+                    str_concat=str_concat, column=column, str_not_null=str_not_null
                 )
                 str_values_query = str_values_query + str_null_value
 
@@ -420,16 +826,8 @@ class QueryElements:
             entities=cohort.statement, attribute=attribute, str_values=str_values
         )
 
-        new_cohort = Cohort(
-            name=name,
-            previous_cohort=cohort.id,
-            is_initial=0,
-            entity_database=cohort.entity_database,
-            entity_schema=cohort.entity_schema,
-            entity_table=cohort.entity_table,
-            statement=sql_text,
-        )
-        return new_cohort
+        predicate = {"type": FILTER_EQUALS, "attribute": attribute, "values": values, "numeric": numeric}
+        return self.create_filtered_cohort(name, cohort, predicate, sql_text, error_msg)
 
     def create_cohort_treatment_filtered(self, args, cohort, error_msg):
         name = args.get("name")
@@ -445,18 +843,33 @@ class QueryElements:
         if base_agent is None:
             raise RuntimeError(error_msg)
 
-        array_operation = "="
-        array_operation = "@>" if base_agent in ["true"] else "="
+        entity_id_col = self.get_sample_id_col(cohort.entity_table, error_msg)
 
-        entity_id_col = ""
-        if cohort.entity_table == "tdp_tissue":
-            entity_id_col = "tissuename"
-        elif cohort.entity_table == "tdp_tissue_2":
-            entity_id_col = "tissuename"
-        elif cohort.entity_table == "tdp_cellline":
-            entity_id_col = "celllinename"
-        else:
-            raise RuntimeError(error_msg)
+        # get the sql query for the entities with the treatment, without the treatment table (the statement is stored)
+        sql_refiend = self.treatment_filter_statement(agent, regimen, base_agent, cohort.entity_schema, cohort.entity_table, entity_id_col)
+
+        # complete SQL statement that filters the data based on the given cohort
+        new_sql_text = """SELECT cohort.* FROM ({entities}) cohort
+                      JOIN
+                      ({sql_refiend}) refined
+                      ON cohort.{entity_id_col} = refined.{entity_id_col}""".format(
+            entities=cohort.statement, sql_refiend=sql_refiend, entity_id_col=entity_id_col
+        )
+
+        predicate = {"type": FILTER_TREATMENT, "agent": agent, "regimen": regimen, "baseAgent": base_agent}
+        return self.create_filtered_cohort(name, cohort, predicate, new_sql_text, error_msg)
+
+    def treatment_filter_statement(self, agent, regimen, base_agent, entity_schema, entity_table, entity_id_col, entity_database=None):
+        # returns the sql query for the ids of all entities that match the treatment filter
+        # the treatment rows (entity_id, regimen_number, sorted agents) are read from the indexed treatment table of the
+        # entity table if the database is given and the table exists, otherwise the treatment json of all entities is
+        # expanded (statements stored with a cohort are created without the database, they must not depend on the table)
+        treatment_table = None
+        if entity_database is not None:
+            treatment_table = treatment_tables.get_table(self, entity_database, entity_schema, entity_table, entity_id_col)
+        if treatment_table is None:
+            treatment_table = "({rows_sql})".format(rows_sql=treatment_rows_sql(entity_schema, entity_table, entity_id_col))
+        array_operation = "@>" if base_agent in ["true"] else "="
 
         # define statement
         agent_equals_null = False
@@ -484,10 +897,10 @@ class QueryElements:
                         agents_string = agents_string + ("'{val}', ".format(val=ag))
 
                     agents_string = agents_string[:-2]  # remove the last ', ' from the value list
-                    # agents_sql = ("tmp.ag = ARRAY[{val}]::text[] ").format(val=agents_string)
-                    agents_sql = (
-                        "array(SELECT UNNEST(tmp.ag) AS val ORDER BY val) {array_operation} array(SELECT UNNEST(ARRAY[{val}]::text[]) AS val ORDER BY val) "
-                    ).format(array_operation=array_operation, val=agents_string)
+                    # the sorted agents are compared like the agents of the treatment rows (gin index for @>, btree for =)
+                    agents_sql = ("tmp.agents {array_operation} array(SELECT UNNEST(ARRAY[{val}]::text[]) AS val ORDER BY val) ").format(
+                        array_operation=array_operation, val=agents_string
+                    )
                     sql_where = sql_where + ("{agents_sql} OR ").format(agents_sql=agents_sql)
 
             sql_where = sql_where[:-4]
@@ -495,7 +908,7 @@ class QueryElements:
 
         # regimen is defined
         if regimen is not None:
-            reg_sql = ("tmp.rn::int = {val}").format(val=regimen)
+            reg_sql = ("tmp.regimen_number = {val}").format(val=regimen)
             sql_where = sql_where + " AND " + reg_sql if agent is not None else reg_sql
 
         # SQL with the combined filter (actual agent values, null values)
@@ -503,13 +916,10 @@ class QueryElements:
 
         # SQL to filter for actual agent values
         if agent_exists:
-            sql_agent = """(SELECT tmp.{entity_id_col} FROM (
-                        SELECT {entity_id_col}, treatment, array_agg(elem->>'AGENT') as ag, elem->>'REGIMEN_NUMBER' AS rn FROM {base_schema}.{base_table},
-                        jsonb_array_elements(treatment:: jsonb) elem
-                        GROUP BY {entity_id_col}, treatment, elem->>'REGIMEN_NUMBER') tmp
+            sql_agent = """(SELECT tmp.entity_id AS {entity_id_col} FROM {treatment_table} tmp
                       WHERE {sql_where}
-                      GROUP BY tmp.{entity_id_col})""".format(
-                entity_id_col=entity_id_col, base_schema=cohort.entity_schema, base_table=cohort.entity_table, sql_where=sql_where
+                      GROUP BY tmp.entity_id)""".format(
+                entity_id_col=entity_id_col, treatment_table=treatment_table, sql_where=sql_where
             )
             sql_refiend = sql_refiend + sql_agent
 
@@ -519,48 +929,24 @@ class QueryElements:
             if regimen is not None:
                 regimen_number = regimen  # use the speficied regimen number
 
-            null_check = "NOT NULL"  # deafult NOT NULL -> if both 'null' and 'not null' exist, 'null' is the stronger one
+            null_check = "EXISTS"  # deafult NOT NULL -> if both 'null' and 'not null' exist, 'null' is the stronger one
             if agent_equals_null:
-                null_check = "NULL"
+                null_check = "NOT EXISTS"
 
             sql_null = """(SELECT base.{entity_id_col} FROM {base_schema}.{base_table} base
-                    LEFT OUTER JOIN
-                    (SELECT tmp.{entity_id_col} FROM (
-                      SELECT {entity_id_col}, treatment, array_agg(elem->>'AGENT') as ag, elem->>'REGIMEN_NUMBER' AS rn FROM {base_schema}.{base_table},
-                      jsonb_array_elements(treatment:: jsonb) elem
-                      GROUP BY {entity_id_col}, treatment, elem->>'REGIMEN_NUMBER') tmp
-                    WHERE tmp.rn::int = {regimen_number}
-                    GROUP BY tmp.{entity_id_col}) nnt
-                    ON base.{entity_id_col} = nnt.{entity_id_col}
-                    WHERE nnt.{entity_id_col} IS {null_check})""".format(
+                    WHERE {null_check} (SELECT 1 FROM {treatment_table} tmp
+                    WHERE tmp.entity_id = base.{entity_id_col} AND tmp.regimen_number = {regimen_number}))""".format(
                 entity_id_col=entity_id_col,
                 null_check=null_check,
                 regimen_number=regimen_number,
-                base_schema=cohort.entity_schema,
-                base_table=cohort.entity_table,
+                base_schema=entity_schema,
+                base_table=entity_table,
+                treatment_table=treatment_table,
             )
 
             sql_refiend = sql_refiend + " UNION " + sql_null if agent_exists else sql_refiend + sql_null
 
-        # complete SQL statement that filters the data based on the given cohort
-        new_sql_text = """SELECT cohort.* FROM ({entities}) cohort
-                      JOIN
-                      ({sql_refiend}) refined
-                      ON cohort.{entity_id_col} = refined.{entity_id_col}""".format(
-            entities=cohort.statement, sql_refiend=sql_refiend, entity_id_col=entity_id_col
-        )
-
-        # print('combiened_sql_statement: ', new_sql_text)
-        new_cohort = Cohort(
-            name=name,
-            previous_cohort=cohort.id,
-            is_initial=0,
-            entity_database=cohort.entity_database,
-            entity_schema=cohort.entity_schema,
-            entity_table=cohort.entity_table,
-            statement=new_sql_text,
-        )
-        return new_cohort
+        return sql_refiend
 
     def operator_resolution(self, operator, error_msg):
         opt_res = None
@@ -578,6 +964,9 @@ class QueryElements:
         return opt_res
 
     def num_filter_statement(self, ranges, prefix, attribute, error_msg):
+        return self.num_filter_clause(ranges, "{prefix}.{attribute}".format(prefix=prefix, attribute=attribute), error_msg)
+
+    def num_filter_clause(self, ranges, column, error_msg):
         ranges_split = ranges.split(";")  # split into ranges: gt_2%lte_5 ; gte_10
 
         add_equals_null = False
@@ -595,15 +984,13 @@ class QueryElements:
                         add_equals_null = True
                     else:
                         operator = self.operator_resolution(vp_split[0], error_msg)
-                        limit = "{prefix}.{attribute} {operator} {value} AND ".format(
-                            prefix=prefix, attribute=attribute, operator=operator, value=vp_split[1]
-                        )
+                        limit = "{column} {operator} {value} AND ".format(column=column, operator=operator, value=vp_split[1])
                         limits = limits + limit
                 else:
                     raise RuntimeError(error_msg)
 
             if add_equals_null:  # check if a null value was used in the current range, and set SQL statement accordingly
-                limits = "{prefix}.{attribute} IS NULL".format(prefix=prefix, attribute=attribute)
+                limits = "{column} IS NULL".format(column=column)
                 str_ranges.append(limits)
             else:
                 limits = limits[:-5]  # sql satement for one range, remove the last ' AND '
@@ -632,16 +1019,8 @@ class QueryElements:
         sql_ranges = self.num_filter_statement(ranges, "p", attribute, error_msg)
         sql_text = "SELECT p.* FROM ({entities}) p WHERE {ranges}".format(entities=cohort.statement, ranges=sql_ranges)
 
-        new_cohort = Cohort(
-            name=name,
-            previous_cohort=cohort.id,
-            is_initial=0,
-            entity_database=cohort.entity_database,
-            entity_schema=cohort.entity_schema,
-            entity_table=cohort.entity_table,
-            statement=sql_text,
-        )
-        return new_cohort
+        predicate = {"type": FILTER_NUM, "attribute": attribute, "ranges": ranges}
+        return self.create_filtered_cohort(name, cohort, predicate, sql_text, error_msg)
 
     def create_cohort_gene_num_filtered(self, args, cohort, error_msg):
         name = args.get("name")
@@ -665,15 +1044,7 @@ class QueryElements:
         if ensg_raw is None:
             raise RuntimeError(error_msg)
 
-        entity_id_col = ""
-        if cohort.entity_table == "tdp_tissue":
-            entity_id_col = "tissuename"
-        elif cohort.entity_table == "tdp_tissue_2":
-            entity_id_col = "tissuename"
-        elif cohort.entity_table == "tdp_cellline":
-            entity_id_col = "celllinename"
-        else:
-            raise RuntimeError(error_msg)
+        entity_id_col = self.get_sample_id_col(cohort.entity_table, error_msg)
 
         sql_ranges = self.num_filter_statement(ranges, "cohort_score", "score", error_msg)
 
@@ -694,16 +1065,8 @@ class QueryElements:
             )
         )
 
-        new_cohort = Cohort(
-            name=name,
-            previous_cohort=cohort.id,
-            is_initial=0,
-            entity_database=cohort.entity_database,
-            entity_schema=cohort.entity_schema,
-            entity_table=cohort.entity_table,
-            statement=sql_text,
-        )
-        return new_cohort
+        predicate = {"type": FILTER_GENE_NUM, "table": table, "attribute": attribute, "ensg": ensg_raw, "ranges": ranges}
+        return self.create_filtered_cohort(name, cohort, predicate, sql_text, error_msg)
 
     def create_cohort_gene_equals_filtered(self, args, cohort, error_msg):
         name = args.get("name")
@@ -731,15 +1094,7 @@ class QueryElements:
         if values is None:
             raise RuntimeError(error_msg)
 
-        entity_id_col = ""
-        if cohort.entity_table == "tdp_tissue":
-            entity_id_col = "tissuename"
-        elif cohort.entity_table == "tdp_tissue_2":
-            entity_id_col = "tissuename"
-        elif cohort.entity_table == "tdp_cellline":
-            entity_id_col = "celllinename"
-        else:
-            raise RuntimeError(error_msg)
+        entity_id_col = self.get_sample_id_col(cohort.entity_table, error_msg)
 
         str_values = self.equals_filter_statement("cohort_score", "score", values, numeric)  # get formated sql query for equals filter
 
@@ -760,46 +1115,272 @@ class QueryElements:
             )
         )
 
-        new_cohort = Cohort(
-            name=name,
-            previous_cohort=cohort.id,
-            is_initial=0,
-            entity_database=cohort.entity_database,
-            entity_schema=cohort.entity_schema,
-            entity_table=cohort.entity_table,
-            statement=sql_text,
-        )
-        return new_cohort
+        predicate = {
+            "type": FILTER_GENE_EQUALS,
+            "table": table,
+            "attribute": attribute,
+            "ensg": ensg_raw,
+            "values": values,
+            "numeric": numeric,
+        }
+        return self.create_filtered_cohort(name, cohort, predicate, sql_text, error_msg)
 
     def get_cohort_data_sql(self, args, cohort):
         attribute = args.get("attribute")
-
-        entity_id_col = ""
-        if cohort.entity_table == "tdp_tissue":
-            entity_id_col = "tissuename"
-        elif cohort.entity_table == "tdp_tissue_2":
-            entity_id_col = "tissuename"
-        elif cohort.entity_table == "tdp_cellline":
-            entity_id_col = "celllinename"
-        elif cohort.entity_table == "student_view_anonym":
-            entity_id_col = "id"
-        elif cohort.entity_table == "korea":
-            entity_id_col = "id"
+        attributes = args.get("attributes")
 
         # define statement
-        sql_text = cohort.statement  # all attributes
-        if attribute is not None:
+        columns = None  # all attributes
+        if attributes is not None:
+            # the listed attributes, separator ','
+            columns = [attr.strip() for attr in attributes.split(",") if attr.strip() != ""]
+        elif attribute is not None:
             # only one attribute
-            sql_text = "SELECT p.{entity_id_col}, p.{attribute} FROM ({entities}) p".format(
-                entity_id_col=entity_id_col, attribute=attribute, entities=cohort.statement
-            )
+            columns = [attribute]
+
+        order_by = args.get("orderBy")
+        if columns is not None and order_by is not None and order_by not in columns:
+            # the sort column is needed for the order and the continuation token of the pages
+            columns.append(order_by)
+
+        entity_id_col = self.get_entity_id_col(cohort.entity_table)
+        if columns is not None and entity_id_col is not None:
+            # the entity id is always part of the result
+            columns = [entity_id_col] + [column for column in columns if column != entity_id_col]
+
+        return self.get_cohort_entities_sql(cohort, columns)
+
+    def get_cohort_page_sql(self, args, sql_text, cohort, error_msg):
+        """Return one page of the data statement with a stable order on (orderBy, entity id)
+        The page starts after the entity of the continuation token ('after'), so no OFFSET scan is needed.
+        NULL values of the sort column are sorted last. The sort value of every row is also selected as text (column
+        PAGE_SORT_VALUE_COLUMN, removed by get_continuation_token), the token keeps it exactly and it is cast back to the
+        type of the column, so e.g. real, numeric and date values are compared without a loss of precision.
+        """
+        entity_id_col = self.get_entity_id_col(cohort.entity_table)
+        if entity_id_col is None:
+            raise RuntimeError(error_msg)
 
-        return sql_text
+        try:
+            limit = int(args.get("limit"))
+        except (TypeError, ValueError):
+            raise RuntimeError(error_msg) from None
+        if limit <= 0:
+            raise RuntimeError(error_msg)
+
+        order_by = args.get("orderBy")
+        direction = args.get("direction", "asc").lower()
+        if direction not in ["asc", "desc"]:
+            raise RuntimeError(error_msg)
+
+        conditions = []
+        after = args.get("after")
+        if after is not None:
+            after_value, after_id = self.decode_continuation_token(after, error_msg)
+            after_id_param = self.add_sql_param("after_id", after_id)
+            if order_by is None:
+                conditions.append("p.{id} > :{after_id}".format(id=entity_id_col, after_id=after_id_param))
+            elif after_value is None:
+                conditions.append(
+                    "p.{col} IS NULL AND p.{id} > :{after_id}".format(col=order_by, id=entity_id_col, after_id=after_id_param)
+                )
+            else:
+                column_type = stats_catalog.get_attribute_type(self, cohort, order_by)
+                if column_type is None:
+                    raise RuntimeError(error_msg)
+                # the parameter is declared as text for drivers that do not convert the values, like asyncpg
+                after_value_sql = "CAST(CAST(:{after_value} AS text) AS {type})".format(
+                    after_value=self.add_sql_param("after_value", str(after_value)), type=column_type
+                )
+                conditions.append(
+                    "(p.{col} {operator} {after_value} OR (p.{col} = {after_value} AND p.{id} > :{after_id}) OR p.{col} IS NULL)".format(
+                        col=order_by,
+                        id=entity_id_col,
+                        operator=">" if direction == "asc" else "<",
+                        after_value=after_value_sql,
+                        after_id=after_id_param,
+                    )
+                )
+
+        order = ["p.{id}".format(id=entity_id_col)]
+        columns = "p.*"
+        if order_by is not None:
+            order.insert(0, "p.{col} {direction} NULLS LAST".format(col=order_by, direction=direction.upper()))
+            columns = "p.*, p.{col}::text AS {sort_value}".format(col=order_by, sort_value=PAGE_SORT_VALUE_COLUMN)
+
+        page_sql = "SELECT {columns} FROM ({sql_text}) p".format(columns=columns, sql_text=sql_text)
+        if len(conditions) > 0:
+            page_sql = page_sql + " WHERE " + " AND ".join(conditions)
+        return page_sql + " ORDER BY {order} LIMIT :{limit}".format(order=", ".join(order), limit=self.add_sql_param("limit", limit))
+
+    def get_continuation_token(self, args, rows, cohort):
+        """Return the token of the last row of a full page, None if there are no more pages
+        The sort values (see get_cohort_page_sql) are removed from the rows.
+        """
+        sort_values = [row.pop(PAGE_SORT_VALUE_COLUMN, None) for row in rows]
+        if len(rows) == 0 or len(rows) < int(args.get("limit")):
+            return None
+
+        token = json.dumps([sort_values[-1], rows[-1][self.get_entity_id_col(cohort.entity_table)]], default=str)
+        return base64.urlsafe_b64encode(token.encode("utf-8")).decode("ascii")
+
+    def decode_continuation_token(self, token, error_msg):
+        try:
+            after_value, after_id = json.loads(base64.urlsafe_b64decode(token.encode("ascii")))
+        except (TypeError, ValueError):
+            raise RuntimeError(error_msg) from None
+        return after_value, after_id
 
     def get_cohort_size_sql(self, cohort):
-        sql_text = "SELECT COUNT(p.*) as size FROM ({entities}) p".format(entities=cohort.statement)
+        sql_text = "SELECT COUNT(p.*) as size FROM ({entities}) p".format(entities=self.get_cohort_entities_sql(cohort))
         return sql_text
 
+    def get_size_preview_sql(self, args, candidates, cohort, error_msg):
+        """Return one statement with the size of the cohort refined by each candidate (columns size_0, size_1, ...)
+        args : the parameters of the filter without its values or ranges, the type is one of PREVIEW_PARAMETERS
+        candidates : list of values or ranges of the filter, in the format of the create routes
+        """
+        filter_type = args.get("type")
+        if filter_type not in PREVIEW_PARAMETERS or len(candidates) == 0:
+            raise RuntimeError(error_msg)
+
+        parameters, candidate_parameter = PREVIEW_PARAMETERS[filter_type]
+        predicate = {"type": filter_type}
+        for parameter in parameters:
+            if args.get(parameter) is None:
+                raise RuntimeError(error_msg)
+            predicate[parameter] = args.get(parameter)
+
+        predicates = []
+        for candidate in candidates:
+            if not isinstance(candidate, str):
+                raise RuntimeError(error_msg)
+            predicates.append(dict(predicate, **{candidate_parameter: candidate}))
+
+        compiler = FilterCompiler(self, self.get_entity_id_col(cohort.entity_table), error_msg)
+        return compiler.compile_counts(
+            CohortFilter(cohort.entity_schema, cohort.entity_table, entity_database=cohort.entity_database),
+            self.get_cohort_entities_sql(cohort),
+            predicates,
+        )
+
+    def get_cohort_size(self, cohort):
+        # the size is stored with the cohort, cohorts created before the size was stored get it on first access
+        if cohort.size is None:
+            sql_text = self.get_cohort_size_sql(cohort)
+            cohort.size = self.execute_sql_query_as_dict(sql_text, cohort.entity_database)[0]["size"]
+            self.update_cohort_size(cohort.id, cohort.size)
+
+        return cohort.size
+
+    def update_cohort_size(self, cohort_id, size):
+        try:
+            self.session.query(Cohort).filter(Cohort.id == cohort_id).update({Cohort.size: size}, synchronize_session=False)
+            self.notify_cohort_changed(self.session, cohort_id)
+            self.session.commit()
+            cohort_cache.invalidate(cohort_id)
+        except exc.SQLAlchemyError as e:
+            _log.error("SQLAlchemy Error: %s", e)
+            raise
+        finally:
+            self.session.close()
+
+    def update_cohort_bitmap(self, cohort, bitmap):
+        try:
+            self.session.query(Cohort).filter(Cohort.id == cohort.id).update({Cohort.bitmap: bitmap}, synchronize_session=False)
+            self.notify_cohort_changed(self.session, cohort.id)
+            self.session.commit()
+            cohort_cache.invalidate(cohort.id)
+        except exc.SQLAlchemyError as e:
+            _log.error("SQLAlchemy Error: %s", e)
+            raise
+        finally:
+            self.session.close()
+
+    def get_cohort_bitmaps(self, args, error_msg, min_cohorts=1):
+        """Return the cohorts of the cohortIds parameter and their bitmaps, the cohorts have to share the entity table
+        The ids are checked before any cohort is read (and any missing bitmap is created): at least min_cohorts, no duplicates.
+        """
+        values = args.get("cohortIds")
+        if values is None:
+            raise RuntimeError(error_msg)
+
+        cohort_ids = values.split(VALUE_LIST_DELIMITER)
+        if len(cohort_ids) < min_cohorts or not all(cohort_id.strip().isdigit() for cohort_id in cohort_ids):
+            raise RuntimeError(error_msg)
+        if len({int(cohort_id) for cohort_id in cohort_ids}) != len(cohort_ids):
+            raise RuntimeError(error_msg)
+
+        cohorts = [self.get_cohort_from_db({"cohortId": cohort_id}, error_msg) for cohort_id in cohort_ids]
+        tables = {(cohort.entity_database, cohort.entity_schema, cohort.entity_table) for cohort in cohorts}
+        if len(tables) != 1 or self.get_entity_id_col(cohorts[0].entity_table) is None:
+            raise RuntimeError(error_msg)
+
+        return cohorts, [cohort_bitmaps.get_bitmap(self, cohort) for cohort in cohorts]
+
+    def create_cohort_set_operation(self, args, operation, error_msg):
+        """Return a new cohort combined from the cohorts of the cohortIds parameter (at least two with the same entity
+        table) and the ids of its entities, which are computed from the bitmaps of the cohorts
+        operation : one of SET_OPERATIONS, a difference removes the entities of the other cohorts from the first one
+        The new cohort has no filters (its members are no conjunction of predicates on the entity table), the statements of
+        the cohorts refined from it wrap its statement. Their sizes and data are evaluated on its stored members.
+        """
+        name = args.get("name")
+        if name is None:
+            raise RuntimeError(error_msg)
+
+        cohorts, bitmaps = self.get_cohort_bitmaps(args, error_msg, min_cohorts=2)
+
+        if operation == SET_OPERATION_UNION:
+            bitmap = union(bitmaps)
+        elif operation == SET_OPERATION_INTERSECTION:
+            bitmap = intersection(bitmaps)
+        else:
+            bitmap = difference(bitmaps[0], bitmaps[1:])
+
+        # the stored statement combines the ids of the statements of the cohorts
+        entity_id_col = self.get_entity_id_col(cohorts[0].entity_table)
+        ids_sql = " {operator} ".format(operator=SET_OPERATIONS[operation]).join(
+            "SELECT c{index}.{entity_id_col} FROM ({statement}) c{index}".format(
+                index=index, entity_id_col=entity_id_col, statement=cohort.statement
+            )
+            for index, cohort in enumerate(cohorts)
+        )
+        statement = "SELECT base.* FROM {schema}.{table} base WHERE base.{entity_id_col} IN ({ids_sql})".format(
+            schema=cohorts[0].entity_schema, table=cohorts[0].entity_table, entity_id_col=entity_id_col, ids_sql=ids_sql
+        )
+
+        new_cohort = Cohort(
+            name=name,
+            previous_cohort=cohorts[0].id,
+            is_initial=0,
+            entity_database=cohorts[0].entity_database,
+            entity_schema=cohorts[0].entity_schema,
+            entity_table=cohorts[0].entity_table,
+            statement=statement,
+        )
+        return new_cohort, cohort_bitmaps.get_entity_ids(self, cohorts[0], bitmap)
+
+    def get_cohort_overlaps(self, args, error_msg):
+        # size of the overlap of every pair of the cohorts, computed from their bitmaps
+        cohorts, bitmaps = self.get_cohort_bitmaps(args, error_msg)
+        overlaps = []
+        for index, (cohort, bitmap) in enumerate(zip(cohorts, bitmaps, strict=True)):
+            for other_cohort, other_bitmap in zip(cohorts[index + 1 :], bitmaps[index + 1 :], strict=True):
+                overlaps.append({"cohortIds": [cohort.id, other_cohort.id], "size": bitmap_size(bitmap & other_bitmap)})
+        return overlaps
+
+    def add_missing_cohort_sizes(self, cohorts, error_msg):
+        # backfill the size of cohorts (as dicts from get_cohorts_by_id_sql) that do not have a stored size yet
+        def get_size(query, row):
+            return query.get_cohort_size(query.get_cohort_from_db({"cohortId": row["id"]}, error_msg))
+
+        missing = [row for row in cohorts if row["size"] is None]
+        for row, size in zip(missing, self.execute_parallel(get_size, missing), strict=True):
+            row["size"] = size
+
+        return cohorts
+
     def get_gene_score_sql(self, args, cohort, error_msg):
         table = args.get("table")
         if table is None:
@@ -810,36 +1391,59 @@ class QueryElements:
             raise RuntimeError(error_msg)
 
         ensg_raw = args.get("ensg")
-        ensg = "'{name}'".format(name=ensg_raw)
         if ensg_raw is None:
             raise RuntimeError(error_msg)
 
-        entity_id_col = ""
-        if cohort.entity_table == "tdp_tissue":
-            entity_id_col = "tissuename"
-        elif cohort.entity_table == "tdp_tissue_2":
-            entity_id_col = "tissuename"
-        elif cohort.entity_table == "tdp_cellline":
-            entity_id_col = "celllinename"
-        else:
-            raise RuntimeError(error_msg)
+        entity_id_col = self.get_sample_id_col(cohort.entity_table, error_msg)
 
+        entities = self.get_cohort_entities_sql(cohort)
         sql_text = (
             "SELECT cohort.{entity_id_col}, cohort_score.score AS score FROM ({entities}) cohort LEFT OUTER JOIN "
-            "(SELECT attr.{entity_id_col}, attr.{attribute} AS score FROM {schema}.tdp_{table} attr "
-            "INNER JOIN public.tdp_gene gene ON attr.ensg = gene.ensg "
-            "WHERE gene.species = {species} AND attr.ensg = {ensg}) cohort_score ON cohort.{entity_id_col} = cohort_score.{entity_id_col}".format(
-                attribute=attribute,
-                table=table,
+            "({score_sql}) cohort_score ON cohort.{entity_id_col} = cohort_score.{entity_id_col}".format(
                 entity_id_col=entity_id_col,
-                schema=cohort.entity_schema,
-                entities=cohort.statement,
-                species="'human'",
-                ensg=ensg,
+                entities=entities,
+                score_sql=self.get_gene_score_values_sql(cohort, entity_id_col, cohort.entity_schema, table, attribute, ensg_raw),
             )
         )
         return sql_text
 
+    def get_gene_score_values_sql(self, cohort, entity_id_col, schema, table, attribute, ensg_raw, depletionscreen_raw=None):
+        """Return the statement of the scores of a gene (entity id, score) for the cohort, get_cohort_entities_sql has to
+        be called for the cohort before. The scores are taken from the cached score vector of the gene, restricted to the
+        ids of the cohort if they are stored, the score table is only joined if there is no vector.
+        """
+        vector = score_vectors.get(self, cohort.entity_database, schema, table, entity_id_col, attribute, ensg_raw, depletionscreen_raw)
+        if vector is None:
+            screen_sql = ""
+            if depletionscreen_raw is not None:
+                screen_sql = " AND attr.depletionscreen = '{name}'".format(name=depletionscreen_raw)
+            return (
+                "SELECT attr.{entity_id_col}, attr.{attribute} AS score FROM {schema}.tdp_{table} attr "
+                "INNER JOIN public.tdp_gene gene ON attr.ensg = gene.ensg "
+                "WHERE gene.species = {species} AND attr.ensg = '{ensg}'{screen_sql}".format(
+                    entity_id_col=entity_id_col,
+                    attribute=attribute,
+                    schema=schema,
+                    table=table,
+                    species="'human'",
+                    ensg=ensg_raw,
+                    screen_sql=screen_sql,
+                )
+            )
+
+        cohort_ids = self.cohort_entity_ids.get(cohort.id)  # if they were read for this request
+        if cohort_ids is not None:
+            vector = vector.intersect(cohort_ids)
+        ids_literal, scores_literal = vector.array_literals()
+        ids = self.add_sql_param("score_ids", ids_literal)
+        scores = self.add_sql_param("scores", scores_literal)
+        return (
+            "SELECT s.entity_id AS {entity_id_col}, CAST(s.score AS {score_type}) AS score "
+            "FROM UNNEST(CAST(CAST(:{ids} AS text) AS varchar[]), CAST(CAST(:{scores} AS text) AS text[])) AS s(entity_id, score)".format(
+                entity_id_col=entity_id_col, score_type=vector.score_type, ids=ids, scores=scores
+            )
+        )
+
     def get_gene_score_depletion_sql(self, args, cohort, error_msg):
         table = args.get("table")
         if table is None:
@@ -850,21 +1454,19 @@ class QueryElements:
             raise RuntimeError(error_msg)
 
         ensg_raw = args.get("ensg")
-        ensg = "'{name}'".format(name=ensg_raw)
         if ensg_raw is None:
             raise RuntimeError(error_msg)
 
         depletion_raw = args.get("depletionscreen")
-        depletionscreen = "'{name}'".format(name=depletion_raw)
         if depletion_raw is None:
             raise RuntimeError(error_msg)
 
+        entities = self.get_cohort_entities_sql(cohort)
         sql_text = (
             "SELECT cohort.celllinename, cohort_score.score AS score FROM ({entities}) cohort LEFT OUTER JOIN "
-            "(SELECT attr.celllinename, attr.{attribute} AS score FROM cellline.tdp_{table} attr "
-            "INNER JOIN public.tdp_gene gene ON attr.ensg = gene.ensg "
-            "WHERE gene.species = {species} AND attr.ensg = {ensg} AND attr.depletionscreen = {screen}) cohort_score ON cohort.celllinename = cohort_score.celllinename".format(
-                attribute=attribute, table=table, entities=cohort.statement, species="'human'", ensg=ensg, screen=depletionscreen
+            "({score_sql}) cohort_score ON cohort.celllinename = cohort_score.celllinename".format(
+                entities=entities,
+                score_sql=self.get_gene_score_values_sql(cohort, "celllinename", "cellline", table, attribute, ensg_raw, depletion_raw),
             )
         )
         return sql_text
@@ -918,16 +1520,15 @@ class QueryElements:
             )
         )
 
-        new_cohort = Cohort(
-            name=name,
-            previous_cohort=cohort.id,
-            is_initial=0,
-            entity_database=cohort.entity_database,
-            entity_schema=cohort.entity_schema,
-            entity_table=cohort.entity_table,
-            statement=sql_text,
-        )
-        return new_cohort
+        predicate = {
+            "type": FILTER_DEPLETION_NUM,
+            "table": table,
+            "attribute": attribute,
+            "ensg": ensg_raw,
+            "depletionscreen": depletion_raw,
+            "ranges": ranges,
+        }
+        return self.create_filtered_cohort(name, cohort, predicate, sql_text, error_msg)
 
     def get_panel_annotation_sql(self, args, cohort, error_msg):
         panel_raw = args.get("panel")
@@ -935,22 +1536,7 @@ class QueryElements:
         if panel_raw is None:
             raise RuntimeError(error_msg)
 
-        entity_id_col = ""
-        panel_table = ""
-        if cohort.entity_table == "tdp_tissue":
-            entity_id_col = "tissuename"
-            panel_table = "tdp_panelassignment"
-        elif cohort.entity_table == "tdp_tissue_2":
-            entity_id_col = "tissuename"
-            panel_table = "tdp_panelassignment"
-        elif cohort.entity_table == "tdp_cellline":
-            entity_id_col = "celllinename"
-            panel_table = "tdp_panelassignment"
-        elif cohort.entity_table == "tdp_gene":
-            entity_id_col = "ensg"
-            panel_table = "tdp_geneassignment"
-        else:
-            raise RuntimeError(error_msg)
+        entity_id_col, panel_table = self.get_panel_columns(cohort.entity_table, error_msg)
 
         sql_text = (
             "SELECT a.{entity_id_col}, COALESCE(d.score, FALSE) AS score "
@@ -958,7 +1544,11 @@ class QueryElements:
             "LEFT OUTER JOIN "
             "(SELECT a.{entity_id_col}, TRUE as score FROM {schema}.{panel_table} a WHERE panel = {panel}) d "
             "ON a.{entity_id_col} = d.{entity_id_col}".format(
-                entity_id_col=entity_id_col, entities=cohort.statement, schema=cohort.entity_schema, panel_table=panel_table, panel=panel
+                entity_id_col=entity_id_col,
+                entities=self.get_cohort_entities_sql(cohort),
+                schema=cohort.entity_schema,
+                panel_table=panel_table,
+                panel=panel,
             )
         )
         return sql_text
@@ -977,22 +1567,7 @@ class QueryElements:
         if values is None:
             raise RuntimeError(error_msg)
 
-        entity_id_col = ""
-        panel_table = ""
-        if cohort.entity_table == "tdp_tissue":
-            entity_id_col = "tissuename"
-            panel_table = "tdp_panelassignment"
-        elif cohort.entity_table == "tdp_tissue_2":
-            entity_id_col = "tissuename"
-            panel_table = "tdp_panelassignment"
-        elif cohort.entity_table == "tdp_cellline":
-            entity_id_col = "celllinename"
-            panel_table = "tdp_panelassignment"
-        elif cohort.entity_table == "tdp_gene":
-            entity_id_col = "ensg"
-            panel_table = "tdp_geneassignment"
-        else:
-            raise RuntimeError(error_msg)
+        entity_id_col, panel_table = self.get_panel_columns(cohort.entity_table, error_msg)
 
         str_values = self.equals_filter_statement("x", "score", values, "true")  # get formated sql query for equals filter
 
@@ -1016,27 +1591,22 @@ class QueryElements:
             )
         )
 
-        new_cohort = Cohort(
-            name=name,
-            previous_cohort=cohort.id,
-            is_initial=0,
-            entity_database=cohort.entity_database,
-            entity_schema=cohort.entity_schema,
-            entity_table=cohort.entity_table,
-            statement=sql_text,
-        )
-        return new_cohort
+        predicate = {"type": FILTER_PANEL, "panel": panel_raw, "values": values}
+        return self.create_filtered_cohort(name, cohort, predicate, sql_text, error_msg)
 
     def get_hist_cat_sql(self, args, cohort, error_msg):
         attribute = args.get("attribute")
         if attribute is None:
             raise RuntimeError(error_msg)
 
+        # the categories of the whole entity table come from the statistics catalog
+        stats = self.get_hist_stats("dataCat", args, cohort, error_msg)
+        categories = self.add_sql_param("categories", stats["categories"])
+
         # define statement
         sql_text = (
             "WITH categories AS ("
-            "SELECT DISTINCT COALESCE(p.{attribute}::varchar,{null_value}) AS cat "
-            "FROM (SELECT * FROM {schema}.{table}) p"
+            "SELECT UNNEST(CAST(:{categories} AS varchar[])) AS cat"
             ")"
             "SELECT categories.cat AS bin, COALESCE(c.count,0) AS count FROM categories "
             "LEFT OUTER JOIN "
@@ -1044,7 +1614,10 @@ class QueryElements:
             "FROM ({entities}) p "
             "GROUP BY p.{attribute}) c "
             "ON categories.cat = c.attr".format(
-                attribute=attribute, null_value="'null'", schema=cohort.entity_schema, table=cohort.entity_table, entities=cohort.statement
+                categories=categories,
+                attribute=attribute,
+                null_value="'null'",
+                entities=self.get_cohort_entities_sql(cohort),
             )
         )
 
@@ -1059,124 +1632,163 @@ class QueryElements:
             return n
 
     def format_num_hist(self, hist_dict, num_bins):
-        # print('----- current Hist from DB:  ', hist_dict)
-        max_list = []
-        min_list = []
-        # last_bin is the num_bins+1 because the underling sql statement
-        # does not include the max value in the num_bins-th bin, but
-        # creates an additional one that includes the max values.
-        last_bin = None
+        return jsonify(self.format_num_hist_dict(hist_dict, num_bins))
+
+    def format_num_hist_dict(self, hist_dict, num_bins):
+        """Return the bins of a numeric histogram with their labels, including the empty bins and the null bin
+        The rows of the statement are bins of get_num_hist_sql: equal binning has the min and max of the range, quantile
+        binning the edges of the bins. The rows are read in two passes, without searching the bins.
+        """
+        if any("edges" in b for b in hist_dict):
+            return self.format_quantile_hist_dict(hist_dict)
+
         null_bin = None
-        # get min and max value
+        min_val = None
+        max_val = None
         for b in hist_dict:
-            if b.get("max") is not None:
-                max_list.append(b.get("max"))
             if b.get("min") is not None:
-                min_list.append(b.get("min"))
-            if b.get("bin") == (num_bins + 1):
-                last_bin = b
+                min_val = b["min"] if min_val is None else min(min_val, b["min"])
+            if b.get("max") is not None:
+                max_val = b["max"] if max_val is None else max(max_val, b["max"])
             if b.get("bin") is None:
-                null_bin = b
-            del b["min"]  # remove min property from dict
-            del b["max"]  # remove max property from dict
+                null_bin = {"bin": None, "count": b["count"], "index": None}
 
-        max_val = None
-        min_val = None
+        if min_val is None or max_val is None:
+            return [null_bin] if null_bin is not None else []
 
-        if len(max_list) > 0:
-            max_val = max(max_list)
-        if len(min_list) > 0:
-            min_val = min(min_list)
+        bin_width = (max_val - min_val) / num_bins
 
-        # p_str = 'min: {min_val} | max: {max_val} | last_bin: {last_bin} | null_bin: {null_bin}'.format(max_val=max_val, min_val=min_val, last_bin=last_bin, null_bin=null_bin)
-        # print('----- ' + p_str)
+        def bound(index):
+            return self.format_number(min_val + index * bin_width)
+
+        # the bins of the statement keep their order (by bin index, the null bin last), the empty bins follow
+        hist = []
+        bins = {}  # bin index -> bin of hist
+        last_count = None
+        for b in hist_dict:
+            index = b.get("bin")
+            if index is None:
+                hist.append(null_bin)
+            elif index == num_bins + 1:
+                # width_bucket does not include the max value in the num_bins-th bin, but creates the bin num_bins + 1 for it
+                last_count = b["count"]
+            else:
+                label = "[{lb}, {ub}]" if index == num_bins else "[{lb}, {ub})"
+                bins[index] = {"bin": label.format(lb=bound(index - 1), ub=bound(index)), "count": b["count"], "index": index}
+                hist.append(bins[index])
+
+        for index in range(1, num_bins + 1):
+            if index not in bins:
+                bins[index] = {"bin": "[{lb}, {ub})".format(lb=bound(index - 1), ub=bound(index)), "count": 0, "index": index}
+                hist.append(bins[index])
+
+        # the last bin is closed, it includes the max value (and the values of the bin num_bins + 1)
+        if last_count is not None:
+            bins[num_bins]["bin"] = "[{lb}, {ub}]".format(lb=bound(num_bins - 1), ub=self.format_number(max_val))
+            bins[num_bins]["count"] += last_count
+
+        if null_bin is None:
+            hist.append({"bin": None, "count": 0, "index": None})
+        return hist
+
+    def format_quantile_hist_dict(self, hist_dict):
+        # bins of quantile binning, the rows contain the edges of all bins (the percentiles of the values)
+        counts = {}  # bin index -> count
+        null_bin = None
+        edges = None
+        for b in hist_dict:
+            if b.get("edges") is not None:
+                edges = b["edges"]
+            if b.get("bin") is None:
+                null_bin = {"bin": None, "count": b["count"], "index": None}
+            else:
+                counts[b["bin"]] = b["count"]
 
-        # define the bin width
-        bin_width = 0
-        if max_val is not None and min_val is not None:
-            bin_width = (max_val - min_val) / num_bins
+        if edges is None:  # no values
+            return [null_bin] if null_bin is not None else []
 
-        # bins existing in the response
-        bin_exist = [sub["bin"] for sub in hist_dict]
-        # print('----- bins in the respose:  ', bin_exist)
+        edges = [self.format_number(edge) for edge in edges]
+        num_bins = len(edges) - 1
+        hist = []
+        for index in range(1, num_bins + 1):
+            label = "[{lb}, {ub}]" if index == num_bins else "[{lb}, {ub})"
+            hist.append({"bin": label.format(lb=edges[index - 1], ub=edges[index]), "count": counts.get(index, 0), "index": index})
 
-        bin_numbers = range(1, num_bins + 1)
-        # print('----- myBins in the respose:  ', bin_numbers)
+        hist.append(null_bin if null_bin is not None else {"bin": None, "count": 0, "index": None})
+        return hist
 
-        # format all existing bins
-        for b in hist_dict:
-            if b.get("bin") is not None:
-                b_idx = b.get("bin")
-                lb = self.format_number(min_val + (b_idx - 1) * bin_width)
-                ub = self.format_number(min_val + b_idx * bin_width)
-                if b_idx == num_bins:
-                    b["bin"] = "[{lb}, {ub}]".format(lb=lb, ub=ub)
-                else:
-                    b["bin"] = "[{lb}, {ub})".format(lb=lb, ub=ub)
-                b["index"] = b_idx
-            else:
-                b["bin"] = None
-                b["index"] = None
-
-        if max_val is not None and min_val is not None:
-            # create new bins that do not exist
-            for bin_n in bin_numbers:
-                if bin_n not in bin_exist:
-                    new_bin = {}
-                    lb = self.format_number(min_val + (bin_n - 1) * bin_width)
-                    ub = self.format_number(min_val + bin_n * bin_width)
-                    new_bin["index"] = bin_n
-                    new_bin["bin"] = "[{lb}, {ub})".format(lb=lb, ub=ub)
-                    new_bin["count"] = 0
-                    hist_dict.append(new_bin)
-
-            # merge the last bin and the bin with the highest number
-            if last_bin is not None:
-                for b in hist_dict:
-                    if b.get("index") == num_bins:
-                        lb = self.format_number(min_val + (num_bins - 1) * bin_width)
-                        ub = self.format_number(max_val)
-                        b["bin"] = "[{lb}, {ub}]".format(lb=lb, ub=ub)
-                        b["count"] = b.get("count") + last_bin.get("count")
-                hist_dict.remove(last_bin)  # remove the last bin
-
-            # add null bin if it does not exist
-            if null_bin is None:
-                new_bin = {}
-                new_bin["bin"] = None
-                new_bin["index"] = None
-                new_bin["count"] = 0
-                hist_dict.append(new_bin)
-
-        # print('----- formated Hist from DB:  ')
-        # print(*hist_dict, sep='\n')
-
-        return jsonify(hist_dict)
+    def get_hist_bins(self, args, error_msg, num_bins=HIST_BINS):
+        # number of bins of a numeric histogram, parameter bins (default num_bins)
+        bins = args.get("bins")
+        if bins is None:
+            return num_bins
+        if not str(bins).strip().isdigit() or not 1 <= int(bins) <= HIST_MAX_BINS:
+            raise RuntimeError(error_msg)
+        return int(bins)
 
-    def get_hist_num_sql(self, args, cohort, num_bins, error_msg):
-        attribute = args.get("attribute")
-        if attribute is None:
+    def get_hist_binning(self, args, error_msg):
+        binning = args.get("binning", HIST_BINNING_EQUAL)
+        if binning not in HIST_BINNINGS:
             raise RuntimeError(error_msg)
+        return binning
 
-        # define statement
-        sql_text = (
+    def get_num_hist_sql(self, values_sql, column, stats, num_bins, binning):
+        """Return the statement of the bins of a numeric histogram over the column of values_sql
+        equal : num_bins bins of the same width between the min and max of stats (from the statistics catalog)
+        quantile : num_bins bins with the same number of values, the edges are the percentiles of the values (stats are
+          not needed), computed in the same statement with percentile_cont
+        """
+        if binning == HIST_BINNING_QUANTILE:
+            # the values are cast via numeric, so real values are not extended (e.g. 20.2 instead of 20.200000762939453)
+            fractions = ", ".join(repr(i / num_bins) for i in range(num_bins + 1))
+            return (
+                "WITH c_values AS ({values_sql}), "
+                "c_edges AS ("
+                "SELECT percentile_cont(ARRAY[{fractions}]::double precision[]) WITHIN GROUP (ORDER BY CAST(CAST(v.{column} AS numeric) AS double precision)) AS edges "
+                "FROM c_values v"
+                ")"
+                "SELECT width_bucket(CAST(CAST(p.{column} AS numeric) AS double precision), c_edges.edges[1:{num_bins}]) AS bin, c_edges.edges AS edges, "
+                "COUNT(*) "
+                "FROM c_values p, c_edges "
+                "GROUP BY bin, c_edges.edges "
+                "ORDER BY bin".format(values_sql=values_sql, column=column, fractions=fractions, num_bins=num_bins)
+            )
+
+        return (
             "WITH c_stats AS ("
-            "SELECT MIN(c.{attribute}) as min, "
-            "MAX(c.{attribute}) as max "
-            "FROM {schema}.{table} c "
+            "{range_constants}"
             ")"
-            "SELECT width_bucket(p.{attribute}, c_stats.min, c_stats.max, {num_bins}) AS bin, "
+            "SELECT width_bucket(p.{column}, c_stats.min, c_stats.max, {num_bins}) AS bin, "
             "MIN(c_stats.min), MAX(c_stats.max), "
             "COUNT(*) "
-            "FROM ({entities}) p, c_stats "
+            "FROM ({values_sql}) p, c_stats "
             "GROUP BY bin "
             "ORDER BY bin".format(
-                attribute=attribute, schema=cohort.entity_schema, table=cohort.entity_table, entities=cohort.statement, num_bins=num_bins
+                range_constants=self.get_range_constants_sql(stats), column=column, values_sql=values_sql, num_bins=num_bins
             )
         )
 
+    def get_hist_num_sql(self, args, cohort, num_bins, error_msg):
+        attribute = args.get("attribute")
+        if attribute is None:
+            raise RuntimeError(error_msg)
+        binning = self.get_hist_binning(args, error_msg)
+
+        # the min and max of the whole entity table come from the statistics catalog
+        stats = self.get_hist_stats("dataNum", args, cohort, error_msg)
+
+        # define statement
+        sql_text = self.get_num_hist_sql(self.get_cohort_entities_sql(cohort), attribute, stats, num_bins, binning)
+
         return sql_text
 
+    def get_range_constants_sql(self, stats):
+        # min and max are passed as text and cast to the type of the column, so width_bucket gets the exact values
+        # (the parameter is declared as text for drivers that do not convert the values, like asyncpg)
+        return "SELECT CAST(CAST(:{min} AS text) AS {type}) AS min, CAST(CAST(:{max} AS text) AS {type}) AS max".format(
+            min=self.add_sql_param("min", stats["min"]), max=self.add_sql_param("max", stats["max"]), type=stats["type"]
+        )
+
     def get_hist_gene_cat_sql(self, args, cohort, error_msg):
         table = args.get("table")
         if table is None:
@@ -1187,47 +1799,32 @@ class QueryElements:
             raise RuntimeError(error_msg)
 
         ensg_raw = args.get("ensg")
-        ensg = "'{name}'".format(name=ensg_raw)
         if ensg_raw is None:
             raise RuntimeError(error_msg)
 
-        entity_id_col = ""
-        if cohort.entity_table == "tdp_tissue":
-            entity_id_col = "tissuename"
-        elif cohort.entity_table == "tdp_tissue_2":
-            entity_id_col = "tissuename"
-        elif cohort.entity_table == "tdp_cellline":
-            entity_id_col = "celllinename"
-        else:
-            raise RuntimeError(error_msg)
+        entity_id_col = self.get_sample_id_col(cohort.entity_table, error_msg)
+
+        stats = self.get_hist_stats("geneScoreCat", args, cohort, error_msg)
+        categories = self.add_sql_param("categories", stats["categories"])
+        entities = self.get_cohort_entities_sql(cohort)
 
         # define statement
         sql_text = (
             "WITH categories AS ("
-            "SELECT DISTINCT  COALESCE(cohort_score.score::varchar,{null_value}) AS cat FROM "
-            "(SELECT * FROM {schema}.{base_table}) cohort LEFT OUTER JOIN "
-            "(SELECT attr.{entity_id_col}, attr.{attribute} AS score FROM {schema}.tdp_{table} attr "
-            "INNER JOIN public.tdp_gene gene ON attr.ensg = gene.ensg "
-            "WHERE gene.species = {species} AND attr.ensg = {ensg}) cohort_score "
-            "ON cohort.{entity_id_col} = cohort_score.{entity_id_col}"
+            "SELECT UNNEST(CAST(:{categories} AS varchar[])) AS cat"
             ") "
             "SELECT categories.cat AS bin, COALESCE(c.count,0) AS count FROM categories "
             "LEFT OUTER JOIN "
             "(SELECT p.score AS attr, COUNT(*) AS count FROM (SELECT cohort.{entity_id_col}, COALESCE(cohort_score.score::varchar,{null_value}) AS score FROM ({entities}) cohort LEFT OUTER JOIN "
-            "(SELECT attr.{entity_id_col}, COALESCE(attr.{attribute}::varchar,{null_value}) AS score FROM {schema}.tdp_{table} attr "
-            "INNER JOIN public.tdp_gene gene ON attr.ensg = gene.ensg "
-            "WHERE gene.species = {species} AND attr.ensg = {ensg}) cohort_score ON cohort.{entity_id_col} = cohort_score.{entity_id_col}) p "
+            "(SELECT v.{entity_id_col}, COALESCE(v.score::varchar,{null_value}) AS score FROM ({score_sql}) v) "
+            "cohort_score ON cohort.{entity_id_col} = cohort_score.{entity_id_col}) p "
             "GROUP BY p.score) c "
             "ON categories.cat = c.attr".format(
-                attribute=attribute,
-                table=table,
+                categories=categories,
                 null_value="'null'",
                 entity_id_col=entity_id_col,
-                schema=cohort.entity_schema,
-                base_table=cohort.entity_table,
-                entities=cohort.statement,
-                species="'human'",
-                ensg=ensg,
+                entities=entities,
+                score_sql=self.get_gene_score_values_sql(cohort, entity_id_col, cohort.entity_schema, table, attribute, ensg_raw),
             )
         )
 
@@ -1243,50 +1840,27 @@ class QueryElements:
             raise RuntimeError(error_msg)
 
         ensg_raw = args.get("ensg")
-        ensg = "'{name}'".format(name=ensg_raw)
         if ensg_raw is None:
             raise RuntimeError(error_msg)
 
-        entity_id_col = ""
-        if cohort.entity_table == "tdp_tissue":
-            entity_id_col = "tissuename"
-        elif cohort.entity_table == "tdp_tissue_2":
-            entity_id_col = "tissuename"
-        elif cohort.entity_table == "tdp_cellline":
-            entity_id_col = "celllinename"
-        else:
-            raise RuntimeError(error_msg)
+        entity_id_col = self.get_sample_id_col(cohort.entity_table, error_msg)
+
+        binning = self.get_hist_binning(args, error_msg)
+        stats = self.get_hist_stats("geneScoreNum", args, cohort, error_msg)
 
         # define statement
-        sql_text = (
-            "WITH c_stats AS ("
-            "SELECT MIN(c.score) as min, "
-            "MAX(c.score) as max "
-            "FROM (SELECT attr.{entity_id_col}, attr.{attribute} AS score FROM {schema}.tdp_{table} attr "
-            "INNER JOIN public.tdp_gene gene ON attr.ensg = gene.ensg "
-            "WHERE gene.species = {species} AND attr.ensg = {ensg}) c "
-            ")"
-            "SELECT width_bucket(p.score, c_stats.min, c_stats.max, {num_bins}) AS bin, "
-            "MIN(c_stats.min), MAX(c_stats.max), "
-            "COUNT(*) "
-            "FROM (SELECT cohort.{entity_id_col}, cohort_score.score AS score FROM "
+        entities = self.get_cohort_entities_sql(cohort)
+        scores_sql = (
+            "SELECT cohort.{entity_id_col}, cohort_score.score AS score FROM "
             "({entities}) cohort "
             "LEFT OUTER JOIN "
-            "(SELECT attr.{entity_id_col}, attr.{attribute} AS score FROM {schema}.tdp_{table} attr "
-            "INNER JOIN public.tdp_gene gene ON attr.ensg = gene.ensg "
-            "WHERE gene.species = {species} AND attr.ensg = {ensg}) cohort_score ON cohort.{entity_id_col} = cohort_score.{entity_id_col}) p, c_stats "
-            "GROUP BY bin "
-            "ORDER BY bin".format(
-                attribute=attribute,
-                schema=cohort.entity_schema,
-                table=table,
+            "({score_sql}) cohort_score ON cohort.{entity_id_col} = cohort_score.{entity_id_col}".format(
                 entity_id_col=entity_id_col,
-                entities=cohort.statement,
-                species="'human'",
-                ensg=ensg,
-                num_bins=num_bins,
+                entities=entities,
+                score_sql=self.get_gene_score_values_sql(cohort, entity_id_col, cohort.entity_schema, table, attribute, ensg_raw),
             )
         )
+        sql_text = self.get_num_hist_sql(scores_sql, "score", stats, num_bins, binning)
 
         return sql_text
 
@@ -1300,42 +1874,26 @@ class QueryElements:
             raise RuntimeError(error_msg)
 
         ensg_raw = args.get("ensg")
-        ensg = "'{name}'".format(name=ensg_raw)
         if ensg_raw is None:
             raise RuntimeError(error_msg)
 
         depletion_raw = args.get("depletionscreen")
-        depletionscreen = "'{name}'".format(name=depletion_raw)
         if depletion_raw is None:
             raise RuntimeError(error_msg)
 
+        binning = self.get_hist_binning(args, error_msg)
+        stats = self.get_hist_stats("depletionScore", args, cohort, error_msg)
+
         # define statement
-        sql_text = (
-            "WITH c_stats AS ("
-            "SELECT MIN(c.score) as min, "
-            "MAX(c.score) as max "
-            "FROM (SELECT attr.celllinename, attr.{attribute} AS score FROM cellline.tdp_{table} attr "
-            "INNER JOIN public.tdp_gene gene ON attr.ensg = gene.ensg "
-            "WHERE gene.species = {species} AND attr.ensg = {ensg} AND attr.depletionscreen = {screen}) c "
-            ")"
-            "SELECT width_bucket(p.score, c_stats.min, c_stats.max, {num_bins}) AS bin, "
-            "MIN(c_stats.min), MAX(c_stats.max), "
-            "COUNT(*) "
-            "FROM (SELECT cohort.celllinename, cohort_score.score AS score FROM ({entities}) cohort LEFT OUTER JOIN "
-            "(SELECT attr.celllinename, attr.{attribute} AS score FROM cellline.tdp_{table} attr "
-            "INNER JOIN public.tdp_gene gene ON attr.ensg = gene.ensg "
-            "WHERE gene.species = {species} AND attr.ensg = {ensg} AND attr.depletionscreen = {screen}) cohort_score ON cohort.celllinename = cohort_score.celllinename) p, c_stats "
-            "GROUP BY bin "
-            "ORDER BY bin".format(
-                attribute=attribute,
-                table=table,
-                entities=cohort.statement,
-                species="'human'",
-                ensg=ensg,
-                screen=depletionscreen,
-                num_bins=num_bins,
+        entities = self.get_cohort_entities_sql(cohort)
+        scores_sql = (
+            "SELECT cohort.celllinename, cohort_score.score AS score FROM ({entities}) cohort LEFT OUTER JOIN "
+            "({score_sql}) cohort_score ON cohort.celllinename = cohort_score.celllinename".format(
+                entities=entities,
+                score_sql=self.get_gene_score_values_sql(cohort, "celllinename", "cellline", table, attribute, ensg_raw, depletion_raw),
             )
         )
+        sql_text = self.get_num_hist_sql(scores_sql, "score", stats, num_bins, binning)
 
         return sql_text
 
@@ -1345,32 +1903,15 @@ class QueryElements:
         if panel_raw is None:
             raise RuntimeError(error_msg)
 
-        entity_id_col = ""
-        panel_table = ""
-        if cohort.entity_table == "tdp_tissue":
-            entity_id_col = "tissuename"
-            panel_table = "tdp_panelassignment"
-        elif cohort.entity_table == "tdp_tissue_2":
-            entity_id_col = "tissuename"
-            panel_table = "tdp_panelassignment"
-        elif cohort.entity_table == "tdp_cellline":
-            entity_id_col = "celllinename"
-            panel_table = "tdp_panelassignment"
-        elif cohort.entity_table == "tdp_gene":
-            entity_id_col = "ensg"
-            panel_table = "tdp_geneassignment"
-        else:
-            raise RuntimeError(error_msg)
+        entity_id_col, panel_table = self.get_panel_columns(cohort.entity_table, error_msg)
+
+        stats = self.get_hist_stats("panelAnnotation", args, cohort, error_msg)
+        categories = self.add_sql_param("categories", stats["categories"])
 
         # define statement
         sql_text = (
-            "WITH categories AS ("  # noqa: F522
-            "SELECT DISTINCT p.score AS cat "
-            "FROM (SELECT a.{entity_id_col}, COALESCE(d.score, FALSE) AS score "
-            "FROM (SELECT * FROM {schema}.{base_table}) a "
-            "LEFT OUTER JOIN "
-            "(SELECT a.{entity_id_col}, TRUE as score FROM {schema}.{panel_table} a WHERE panel = {panel}) d "
-            "ON a.{entity_id_col} = d.{entity_id_col}) p"
+            "WITH categories AS ("
+            "SELECT UNNEST(CAST(:{categories} AS boolean[])) AS cat"
             ")"
             "SELECT categories.cat AS bin, COALESCE(c.count,0) AS count FROM categories "
             "LEFT OUTER JOIN "
@@ -1382,14 +1923,122 @@ class QueryElements:
             "ON a.{entity_id_col} = d.{entity_id_col}) p "
             "GROUP BY p.score) c "
             "ON categories.cat = c.attr".format(
+                categories=categories,
                 entity_id_col=entity_id_col,
                 panel_table=panel_table,
                 panel=panel,
                 schema=cohort.entity_schema,
-                base_table=cohort.entity_table,
-                table=cohort.entity_table,
-                entities=cohort.statement,
+                entities=self.get_cohort_entities_sql(cohort),
             )
         )
 
         return sql_text
+
+    def get_hist_sql(self, args, cohort, num_bins, error_msg):
+        """Return the sql statement of a histogram and the number of bins to format it with format_num_hist (None for
+        categorical histograms), the bins parameter of args takes precedence over num_bins
+        """
+        hist_type = args.get("type")
+        if hist_type in ["dataNum", "geneScoreNum", "depletionScore"]:
+            num_bins = self.get_hist_bins(args, error_msg, num_bins)
+
+        if hist_type == "dataCat":
+            return self.get_hist_cat_sql(args, cohort, error_msg), None
+        elif hist_type == "dataNum":
+            return self.get_hist_num_sql(args, cohort, num_bins, error_msg), num_bins
+        elif hist_type == "geneScoreCat":
+            return self.get_hist_gene_cat_sql(args, cohort, error_msg), None
+        elif hist_type == "geneScoreNum":
+            return self.get_hist_gene_num_sql(args, cohort, num_bins, error_msg), num_bins
+        elif hist_type == "depletionScore":
+            return self.get_hist_depletion_sql(args, cohort, num_bins, error_msg), num_bins
+        elif hist_type == "panelAnnotation":
+            return self.get_hist_panel_sql(args, cohort, error_msg), None
+
+        raise RuntimeError(error_msg)
+
+    def get_hist_stats(self, hist_type, args, cohort, error_msg):
+        """Return the statistics of the whole entity table that the histogram of args needs (see sql_stats), None for
+        quantile bins. Statistics that are not in the catalog yet are computed.
+        """
+
+        def get_arg(name):
+            value = args.get(name)
+            if value is None:
+                raise RuntimeError(error_msg)
+            return value
+
+        if hist_type in ["dataNum", "geneScoreNum", "depletionScore"] and self.get_hist_binning(args, error_msg) != HIST_BINNING_EQUAL:
+            return None
+
+        if hist_type == "dataCat":
+            return stats_catalog.get_attribute_categories(self, cohort, get_arg("attribute"))
+        elif hist_type == "dataNum":
+            return stats_catalog.get_attribute_range(self, cohort, get_arg("attribute"))
+        elif hist_type in ["geneScoreCat", "geneScoreNum"]:
+            table, attribute, ensg = get_arg("table"), get_arg("attribute"), "'{name}'".format(name=get_arg("ensg"))
+            entity_id_col = self.get_sample_id_col(cohort.entity_table, error_msg)
+            if hist_type == "geneScoreCat":
+                return stats_catalog.get_gene_score_categories(self, cohort, entity_id_col, table, attribute, ensg)
+            return stats_catalog.get_gene_score_range(self, cohort, entity_id_col, table, attribute, ensg)
+        elif hist_type == "depletionScore":
+            ensg, depletionscreen = "'{name}'".format(name=get_arg("ensg")), "'{name}'".format(name=get_arg("depletionscreen"))
+            return stats_catalog.get_depletion_score_range(self, cohort, get_arg("table"), get_arg("attribute"), ensg, depletionscreen)
+        elif hist_type == "panelAnnotation":
+            entity_id_col, panel_table = self.get_panel_columns(cohort.entity_table, error_msg)
+            panel = "'{name}'".format(name=get_arg("panel"))
+            return stats_catalog.get_panel_categories(self, cohort, entity_id_col, panel_table, panel)
+
+        raise RuntimeError(error_msg)
+
+    def prefetch_hist_stats(self, specs, cohort, error_msg):
+        """Compute the statistics of the histograms that are not in the catalog yet, get_hist_batch_sql then finds all of
+        them in the catalog. Only the statistics queries run, the statements of the histograms are not built.
+        They run concurrently if this request holds no connection yet, otherwise one after the other on its connection (the
+        queries of execute_parallel would wait for connections of the pool, while this request holds one).
+        """
+        if len(self.connections) > 0:
+            for spec in specs:
+                self.get_hist_stats(spec.get("type"), spec, cohort, error_msg)
+            return
+        self.execute_parallel(lambda query, spec: query.get_hist_stats(spec.get("type"), spec, cohort, error_msg), specs)
+
+    def get_hist_batch_sql(self, specs, cohort, num_bins, error_msg):
+        """Return one sql statement for the histograms of all specs and the number of bins of every spec (see get_hist_sql)
+        The entities of the cohort are evaluated once in the common table expression 'cohort_entities', which all
+        histograms use (a CTE that is referenced more than once is materialized by postgres).
+        Every histogram is aggregated to one json array, the result has one row per spec ordered by the spec index.
+        """
+        if len(specs) == 0:
+            raise RuntimeError(error_msg)
+
+        entities = self.get_cohort_entities_sql(cohort)
+        self.shared_entities[cohort.id] = "cohort_entities"
+        try:
+            hist_statements = []
+            bins = []
+            for index, spec in enumerate(specs):
+                hist_sql, spec_bins = self.get_hist_sql(spec, cohort, num_bins, error_msg)
+                hist_statements.append(
+                    "SELECT {index} AS spec, (SELECT json_agg(h) FROM ({hist_sql}) h) AS hist".format(index=index, hist_sql=hist_sql)
+                )
+                bins.append(spec_bins)
+        finally:
+            del self.shared_entities[cohort.id]
+
+        sql_text = "WITH cohort_entities AS ({entities}) {hist_statements} ORDER BY spec".format(
+            entities=entities, hist_statements=" UNION ALL ".join(hist_statements)
+        )
+        return sql_text, bins
+
+    def format_hist_batch(self, rows, bins):
+        return jsonify(self.format_hist_batch_dict(rows, bins))
+
+    def format_hist_batch_dict(self, rows, bins):
+        hists = []
+        for row in rows:
+            hist_dict = row["hist"] if row["hist"] is not None else []
+            if bins[row["spec"]] is not None:
+                hist_dict = self.format_num_hist_dict(hist_dict, bins[row["spec"]])
+            hists.append(hist_dict)
+        return hists
@@ -0,0 +1,138 @@
+import datetime
+import decimal
+import io
+import json
+import logging
+
+from flask import Response, request
+
+try:
+    import pyarrow as pa
+except ImportError:  # the arrow format is only offered if pyarrow is installed
+    pa = None
+
+try:
+    import orjson
+except ImportError:  # without orjson the responses are encoded with the json module
+    orjson = None
+
+_log = logging.getLogger(__name__)
+
+# response formats of the data routes, json is the default
+MIMETYPE_JSON = "application/json"
+MIMETYPE_NDJSON = "application/x-ndjson"  # newline delimited json, one entity per line, streamed
+MIMETYPE_ARROW = "application/vnd.apache.arrow.stream"  # arrow ipc stream of record batches, streamed
+RESPONSE_MIMETYPES = [MIMETYPE_JSON, MIMETYPE_NDJSON] + ([MIMETYPE_ARROW] if pa is not None else [])
+
+# header with the continuation token ('after' parameter) of the next page of the data routes
+CONTINUATION_TOKEN_HEADER = "X-Continuation-Token"
+
+# postgres type oids of the cursor description -> arrow type (and the conversion of the values)
+ARROW_TYPES = (
+    {
+        16: (pa.bool_(), None),  # bool
+        20: (pa.int64(), None),  # int8
+        21: (pa.int16(), None),  # int2
+        23: (pa.int32(), None),  # int4
+        700: (pa.float32(), None),  # float4
+        701: (pa.float64(), None),  # float8
+        1700: (pa.float64(), float),  # numeric, like the json responses the values are sent as floats
+        25: (pa.string(), None),  # text
+        1042: (pa.string(), None),  # bpchar
+        1043: (pa.string(), None),  # varchar
+        1082: (pa.date32(), None),  # date
+        1114: (pa.timestamp("us"), None),  # timestamp
+        114: (pa.string(), json.dumps),  # json
+        3802: (pa.string(), json.dumps),  # jsonb
+    }
+    if pa is not None
+    else {}
+)
+
+
+# postgres type oids of the cursor description -> conversion of the values for the json responses, the other values are
+# sent as returned by the driver (dates and timestamps are encoded in ISO 8601 by dumps_json)
+JSON_CONVERTERS = {
+    1700: float,  # numeric, e.g. the results of SUM and AVG
+}
+
+
+class RowDecoder:
+    """Decodes the rows of a query result to dicts
+    The conversion of every column is decided once from the cursor description and applied to whole columns of a batch
+    of rows, instead of checking the type of every value.
+    """
+
+    def __init__(self, result):
+        self.keys = list(result.keys())
+        self.converters = [
+            (index, JSON_CONVERTERS[column[1]]) for index, column in enumerate(result.cursor.description) if column[1] in JSON_CONVERTERS
+        ]
+
+    def decode(self, rows):
+        if len(self.converters) == 0 or len(rows) == 0:
+            return [dict(zip(self.keys, row, strict=True)) for row in rows]
+
+        columns = list(zip(*rows, strict=True))
+        for index, convert in self.converters:
+            columns[index] = [convert(value) if value is not None else None for value in columns[index]]
+        return [dict(zip(self.keys, values, strict=True)) for values in zip(*columns, strict=True)]
+
+
+def json_default(value):
+    # values the json module can not encode
+    if isinstance(value, (datetime.date, datetime.time)):
+        return value.isoformat()
+    if isinstance(value, decimal.Decimal):
+        return float(value)
+    raise TypeError("Object of type {type} is not JSON serializable".format(type=type(value).__name__))
+
+
+def dumps_json(content):
+    """Encode content as json bytes, with orjson if it is installed"""
+    if orjson is not None:
+        return orjson.dumps(content, default=json_default)
+    return json.dumps(content, default=json_default, separators=(",", ":")).encode("utf-8")
+
+
+def json_response(content):
+    # the encoded bytes are the body of the response, without the json provider of flask
+    return Response(dumps_json(content), mimetype=MIMETYPE_JSON)
+
+
+def get_response_mimetype():
+    # the format requested with the Accept header, json if the client accepts anything (or sends no Accept header)
+    return request.accept_mimetypes.best_match(RESPONSE_MIMETYPES, default=MIMETYPE_JSON)
+
+
+def arrow_stream(result, fetch_size):
+    """Generate an arrow ipc stream from a query result, one record batch per fetch of fetch_size rows
+    The column types are taken from the cursor description, columns of other types are sent as strings.
+    """
+    columns = []
+    for column in result.cursor.description:
+        arrow_type, convert = ARROW_TYPES.get(column[1], (pa.string(), str))
+        columns.append((column[0], arrow_type, convert))
+    schema = pa.schema([(name, arrow_type) for name, arrow_type, _convert in columns])
+
+    sink = io.BytesIO()
+    writer = pa.ipc.new_stream(sink, schema)
+    while True:
+        rows = result.fetchmany(fetch_size)
+        if len(rows) == 0:
+            break
+
+        arrays = []
+        for index, (_name, arrow_type, convert) in enumerate(columns):
+            values = [row[index] for row in rows]
+            if convert is not None:
+                values = [convert(value) if value is not None else None for value in values]
+            arrays.append(pa.array(values, type=arrow_type))
+        writer.write_batch(pa.record_batch(arrays, schema=schema))
+
+        yield sink.getvalue()
+        sink.seek(0)
+        sink.truncate()
+
+    writer.close()
+    yield sink.getvalue()
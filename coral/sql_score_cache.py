@@ -0,0 +1,117 @@
+import bisect
+import logging
+import sys
+
+from .settings import get_settings
+from .sql_cache import LRUResultCache
+
+_log = logging.getLogger(__name__)
+
+config = get_settings()
+
+
+def array_literal(values):
+    # postgres array literal of text values, one bind parameter is parsed much faster than a parameter per element
+    elements = ("NULL" if value is None else '"' + value.replace("\\", "\\\\").replace('"', '\\"') + '"' for value in values)
+    return "{" + ",".join(elements) + "}"
+
+
+class ScoreVector:
+    """Scores of one gene (and depletion screen) for all entities of a score table, sorted by entity id
+    The scores are kept as text and cast to the type of the score column (score_type) in the statements, so they are
+    exactly the values of the table.
+    """
+
+    def __init__(self, entity_ids, scores, score_type):
+        self.entity_ids = entity_ids
+        self.scores = scores
+        self.score_type = score_type
+        self.literals = None
+
+    def array_literals(self):
+        # (entity ids, scores) as array literals, created once per vector
+        if self.literals is None:
+            self.literals = (array_literal(self.entity_ids), array_literal(self.scores))
+        return self.literals
+
+    def intersect(self, entity_ids):
+        # returns the vector of the scores of the given entities
+        ids = []
+        scores = []
+        for entity_id in sorted(set(entity_ids)):
+            start = bisect.bisect_left(self.entity_ids, entity_id)
+            end = bisect.bisect_right(self.entity_ids, entity_id, start)
+            ids.extend(self.entity_ids[start:end])
+            scores.extend(self.scores[start:end])
+        return ScoreVector(ids, scores, self.score_type)
+
+    def size(self):
+        # approximate memory of the vector (and its array literals) in bytes
+        return 2 * (
+            sys.getsizeof(self.entity_ids)
+            + sys.getsizeof(self.scores)
+            + sum(sys.getsizeof(entity_id) for entity_id in self.entity_ids)
+            + sum(sys.getsizeof(score) for score in self.scores if score is not None)
+        )
+
+
+class ScoreVectorCache:
+    """Memory bounded cache of the score vectors of the genes, by database, score table, attribute, gene and screen
+    The gene scores and their histograms are computed from the cached vector of the gene (and the ids of the cohort)
+    instead of joining the score table every time the same gene is shown.
+    """
+
+    def __init__(self, max_bytes, ttl):
+        self.vectors = LRUResultCache(max_bytes, ttl)
+
+    def get(self, query, database, schema, table, entity_id_col, attribute, ensg, depletionscreen=None):
+        """Return the score vector, loaded with the connection of the query if it is not cached yet
+        None is returned if the cache is disabled or the type of the score column is unknown.
+        """
+        if not config.score_cache_enabled:
+            return None
+
+        key = (database, schema, table, attribute, ensg, depletionscreen)
+        vector = self.vectors.get(key)
+        if vector is None:
+            vector = self.load(query, database, schema, table, entity_id_col, attribute, ensg, depletionscreen)
+            if vector is None:
+                return None
+            self.vectors.put(key, vector, vector.size())
+        return vector
+
+    def load(self, query, database, schema, table, entity_id_col, attribute, ensg, depletionscreen):
+        type_rows = query.execute_sql_query_as_dict(
+            "SELECT format_type(a.atttypid, a.atttypmod) AS score_type FROM pg_attribute a "
+            "WHERE a.attrelid = to_regclass(:score_table) AND a.attname = :score_attribute AND NOT a.attisdropped",
+            database,
+            params={"score_table": "{schema}.tdp_{table}".format(schema=schema, table=table), "score_attribute": attribute},
+        )
+        if len(type_rows) == 0:
+            return None
+
+        params = {"score_ensg": ensg}
+        sql_text = (
+            "SELECT attr.{entity_id_col}::varchar AS entity_id, attr.{attribute}::text AS score FROM {schema}.tdp_{table} attr "
+            "INNER JOIN public.tdp_gene gene ON attr.ensg = gene.ensg "
+            "WHERE gene.species = {species} AND attr.ensg = :score_ensg".format(
+                entity_id_col=entity_id_col, attribute=attribute, schema=schema, table=table, species="'human'"
+            )
+        )
+        if depletionscreen is not None:
+            params["score_screen"] = depletionscreen
+            sql_text = sql_text + " AND attr.depletionscreen = :score_screen"
+
+        rows = query.execute_sql_query_as_dict(sql_text, database, params=params)
+        rows = sorted((row for row in rows if row["entity_id"] is not None), key=lambda row: row["entity_id"])
+        _log.debug("Loaded %s scores of %s.tdp_%s.%s for %s", len(rows), schema, table, attribute, ensg)
+        return ScoreVector([row["entity_id"] for row in rows], [row["score"] for row in rows], type_rows[0]["score_type"])
+
+    def invalidate(self):
+        self.vectors.invalidate()
+
+    def stats(self):
+        return self.vectors.stats()
+
+
+score_vectors = ScoreVectorCache(config.score_cache_max_bytes, config.score_cache_ttl)
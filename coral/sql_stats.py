@@ -0,0 +1,155 @@
+import logging
+import threading
+import time
+
+from .settings import get_settings
+
+_log = logging.getLogger(__name__)
+
+config = get_settings()
+
+
+class StatisticsCatalog:
+    """Statistics of the entity tables and score tables used by the histograms
+    For every attribute (or gene score, depletion score, panel) the category domain or the range (min, max, type) and the
+    number of NULL values are computed once over the whole table. Entries are recomputed on demand (refresh) or when they
+    are older than stats_catalog_max_age seconds.
+    """
+
+    def __init__(self, max_age):
+        self.max_age = max_age
+        self.entries = {}  # key -> (computed, stats)
+        self.lock = threading.Lock()
+
+    def get_attribute_categories(self, query, cohort, attribute):
+        key = ("categories", cohort.entity_database, cohort.entity_schema, cohort.entity_table, attribute)
+        sql_text = (
+            "SELECT COALESCE(p.{attribute}::varchar,{null_value}) AS cat, COUNT(*) AS count "
+            "FROM {schema}.{table} p "
+            "GROUP BY 1".format(attribute=attribute, null_value="'null'", schema=cohort.entity_schema, table=cohort.entity_table)
+        )
+        return self.get_stats(key, query, cohort.entity_database, sql_text, self.to_categories)
+
+    def get_attribute_range(self, query, cohort, attribute):
+        key = ("range", cohort.entity_database, cohort.entity_schema, cohort.entity_table, attribute)
+        sql_text = self.range_sql("SELECT c.{attribute} AS score FROM {schema}.{table} c").format(
+            attribute=attribute, schema=cohort.entity_schema, table=cohort.entity_table
+        )
+        return self.get_stats(key, query, cohort.entity_database, sql_text, self.to_range)
+
+    def get_attribute_type(self, query, cohort, attribute):
+        # sql type of a column of the entity table (None if there is no such column), e.g. to cast values sent as text
+        key = ("type", cohort.entity_database, cohort.entity_schema, cohort.entity_table, attribute)
+        sql_text = (
+            "SELECT format_type(a.atttypid, a.atttypmod) AS type FROM pg_attribute a "
+            "WHERE a.attrelid = to_regclass('{schema}.{table}') AND a.attname = '{attribute}' AND NOT a.attisdropped".format(
+                schema=cohort.entity_schema, table=cohort.entity_table, attribute=attribute.replace("'", "''")
+            )
+        )
+        return self.get_stats(key, query, cohort.entity_database, sql_text, self.to_type)
+
+    def get_gene_score_categories(self, query, cohort, entity_id_col, table, attribute, ensg):
+        key = ("geneCategories", cohort.entity_database, cohort.entity_schema, cohort.entity_table, table, attribute, ensg)
+        sql_text = (
+            "SELECT COALESCE(cohort_score.score::varchar,{null_value}) AS cat, COUNT(*) AS count FROM "
+            "{schema}.{base_table} cohort LEFT OUTER JOIN "
+            "({score_sql}) cohort_score "
+            "ON cohort.{entity_id_col} = cohort_score.{entity_id_col} "
+            "GROUP BY 1".format(
+                null_value="'null'",
+                schema=cohort.entity_schema,
+                base_table=cohort.entity_table,
+                score_sql=self.gene_score_sql(cohort, entity_id_col, table, attribute, ensg),
+                entity_id_col=entity_id_col,
+            )
+        )
+        return self.get_stats(key, query, cohort.entity_database, sql_text, self.to_categories)
+
+    def get_gene_score_range(self, query, cohort, entity_id_col, table, attribute, ensg):
+        key = ("geneRange", cohort.entity_database, cohort.entity_schema, table, attribute, ensg)
+        sql_text = self.range_sql(self.gene_score_sql(cohort, entity_id_col, table, attribute, ensg))
+        return self.get_stats(key, query, cohort.entity_database, sql_text, self.to_range)
+
+    def get_depletion_score_range(self, query, cohort, table, attribute, ensg, depletionscreen):
+        key = ("depletionRange", cohort.entity_database, table, attribute, ensg, depletionscreen)
+        score_sql = (
+            "SELECT attr.celllinename, attr.{attribute} AS score FROM cellline.tdp_{table} attr "
+            "INNER JOIN public.tdp_gene gene ON attr.ensg = gene.ensg "
+            "WHERE gene.species = {species} AND attr.ensg = {ensg} AND attr.depletionscreen = {screen}".format(
+                attribute=attribute, table=table, species="'human'", ensg=ensg, screen=depletionscreen
+            )
+        )
+        return self.get_stats(key, query, cohort.entity_database, self.range_sql(score_sql), self.to_range)
+
+    def get_panel_categories(self, query, cohort, entity_id_col, panel_table, panel):
+        key = ("panelCategories", cohort.entity_database, cohort.entity_schema, cohort.entity_table, panel)
+        sql_text = (
+            "SELECT COALESCE(d.score, FALSE) AS cat, COUNT(*) AS count "
+            "FROM {schema}.{base_table} a "
+            "LEFT OUTER JOIN "
+            "(SELECT a.{entity_id_col}, TRUE as score FROM {schema}.{panel_table} a WHERE panel = {panel}) d "
+            "ON a.{entity_id_col} = d.{entity_id_col} "
+            "GROUP BY 1".format(
+                entity_id_col=entity_id_col,
+                schema=cohort.entity_schema,
+                base_table=cohort.entity_table,
+                panel_table=panel_table,
+                panel=panel,
+            )
+        )
+        return self.get_stats(key, query, cohort.entity_database, sql_text, self.to_categories)
+
+    def gene_score_sql(self, cohort, entity_id_col, table, attribute, ensg):
+        return (
+            "SELECT attr.{entity_id_col}, attr.{attribute} AS score FROM {schema}.tdp_{table} attr "
+            "INNER JOIN public.tdp_gene gene ON attr.ensg = gene.ensg "
+            "WHERE gene.species = {species} AND attr.ensg = {ensg}".format(
+                entity_id_col=entity_id_col, attribute=attribute, schema=cohort.entity_schema, table=table, species="'human'", ensg=ensg
+            )
+        )
+
+    def range_sql(self, score_sql):
+        # min and max as text and their type, so that the histogram can use the exact same values as constants
+        return (
+            "SELECT MIN(c.score)::text AS min, MAX(c.score)::text AS max, pg_typeof(MIN(c.score))::text AS type, "
+            "COUNT(*) - COUNT(c.score) AS nulls "
+            "FROM ({score_sql}) c".format(score_sql=score_sql)
+        )
+
+    def to_categories(self, rows):
+        categories = [row["cat"] for row in rows]
+        nulls = sum(row["count"] for row in rows if row["cat"] in ["null"])
+        return {"categories": categories, "nulls": nulls}
+
+    def to_range(self, rows):
+        return rows[0]
+
+    def to_type(self, rows):
+        return rows[0]["type"] if len(rows) > 0 else None
+
+    def get_stats(self, key, query, database, sql_text, parse):
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry is not None and entry[0] + self.max_age > time.monotonic():
+            return entry[1]
+
+        _log.info("Compute statistics for %s", key)
+        rows = query.execute_sql_query_as_dict(sql_text, database, True, config.supp_statement_timeout)
+        stats = parse(rows)
+        with self.lock:
+            self.entries[key] = (time.monotonic(), stats)
+        return stats
+
+    def refresh(self):
+        # removes all statistics, they are computed again on the next request
+        with self.lock:
+            self.entries.clear()
+
+    def summary(self):
+        with self.lock:
+            return [
+                {"key": list(key), "age": time.monotonic() - computed, "stats": stats} for key, (computed, stats) in self.entries.items()
+            ]
+
+
+stats_catalog = StatisticsCatalog(config.stats_catalog_max_age)
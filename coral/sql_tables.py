@@ -1,6 +1,6 @@
 import logging
 
-from sqlalchemy import Column, ForeignKey, Integer, Sequence, String
+from sqlalchemy import Column, ForeignKey, Integer, LargeBinary, Sequence, String
 from sqlalchemy.ext.declarative import declarative_base
 
 Base = declarative_base()
@@ -44,10 +44,13 @@ class Cohort(Base):
     entity_schema = Column(String, nullable=False)
     entity_table = Column(String, nullable=False)
     statement = Column(String)
+    filters = Column(String)  # json of the CohortFilter (entity table and predicates) the statement is compiled from
+    size = Column(Integer)
+    bitmap = Column(LargeBinary)  # compressed bitmap of the members over the entity dictionary (see sql_bitmap)
 
     def __repr__(self):
         return (
-            "<Cohort (id='%s', name='%s', is_initial='%s', previous_cohort='%s', entity_database='%s', entity_schema='%s', entity_table='%s', statement='%s')>"
+            "<Cohort (id='%s', name='%s', is_initial='%s', previous_cohort='%s', entity_database='%s', entity_schema='%s', entity_table='%s', statement='%s', filters='%s', size='%s')>"
             % (
                 self.id,
                 self.name,
@@ -57,6 +60,8 @@ class Cohort(Base):
                 self.entity_schema,
                 self.entity_table,
                 self.statement,
+                self.filters,
+                self.size,
             )
         )
 
@@ -64,8 +69,21 @@ class Cohort(Base):
 class CohortEntity(Base):
     __tablename__ = "cohort_entity"
     __table_args__ = {"schema": "cohort"}
-    cohort_id = Column(Integer, ForeignKey("cohort.cohort.id"), nullable=False, primary_key=True)
+    cohort_id = Column(Integer, ForeignKey("cohort.cohort.id", ondelete="CASCADE"), nullable=False, primary_key=True)
     entity_id = Column(String, nullable=False, primary_key=True)
 
     def __repr__(self):
         return "<CohortEntity (cohort_id='%s', entity_id='%s')>" % (self.cohort_id, self.entity_id)
+
+
+class EntityDictionary(Base):
+    __tablename__ = "entity_dictionary"
+    __table_args__ = {"schema": "cohort"}
+    entity_database = Column(String, nullable=False, primary_key=True)
+    entity_schema = Column(String, nullable=False, primary_key=True)
+    entity_table = Column(String, nullable=False, primary_key=True)
+    entity_id = Column(String, nullable=False, primary_key=True)
+    position = Column(Integer, nullable=False)
+
+    def __repr__(self):
+        return "<EntityDictionary (entity_table='%s', entity_id='%s', position='%s')>" % (self.entity_table, self.entity_id, self.position)
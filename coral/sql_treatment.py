@@ -0,0 +1,111 @@
+import logging
+import threading
+import time
+
+from sqlalchemy import text
+
+from .sql_engines import get_engine
+
+_log = logging.getLogger(__name__)
+
+# derived table of the treatments of an entity table, in the schema of the entity table, and the table that replaces it
+TREATMENT_TABLE = "{schema}.coral_{table}_treatment"
+TREATMENT_TABLE_NEW = "{schema}.coral_{table}_treatment_new"
+# seconds until a missing treatment table is looked up again
+TREATMENT_TABLE_RECHECK = 60
+
+
+def treatment_rows_sql(schema, table, entity_id_col):
+    """Return the statement of the treatment rows of an entity table: one row per entity and regimen number with the
+    sorted agents of the regimen (entity_id, regimen_number, agents), expanded from the treatment json of the entities
+    """
+    return (
+        "SELECT {entity_id_col} AS entity_id, (elem->>'REGIMEN_NUMBER')::int AS regimen_number, "
+        "array_agg(elem->>'AGENT' ORDER BY elem->>'AGENT') AS agents "
+        "FROM {schema}.{table}, jsonb_array_elements(treatment::jsonb) elem "
+        "GROUP BY {entity_id_col}, elem->>'REGIMEN_NUMBER'".format(schema=schema, table=table, entity_id_col=entity_id_col)
+    )
+
+
+class TreatmentTables:
+    """Derived tables of the treatment rows (see treatment_rows_sql) with indexes for the lookups of the treatment filter
+    The tables are only built explicitly with refresh() (the refreshTreatments route), e.g. after the entity data was
+    loaded or updated. Requests only look them up: while a table does not exist (or can not be built, e.g. without
+    privileges), the treatment filters expand the json of every entity. The statements stored with the cohorts never
+    reference the derived tables.
+    """
+
+    def __init__(self, recheck_interval=TREATMENT_TABLE_RECHECK):
+        self.recheck_interval = recheck_interval
+        self.tables = {}  # (database, schema, table) -> (time of the lookup, name of the table or None if it does not exist)
+        self.entity_id_cols = {}  # (database, schema, table) -> entity id column
+        self.lock = threading.Lock()
+
+    def get_table(self, query, database, schema, table, entity_id_col):
+        """Return the name of the treatment table of the entity table, None if it does not exist
+        The lookup runs on the connection of the query, a missing table is looked up again after recheck_interval seconds
+        (it may have been built by another worker in the meantime).
+        """
+        key = (database, schema, table)
+        with self.lock:
+            self.entity_id_cols[key] = entity_id_col
+            entry = self.tables.get(key)
+        if entry is not None and (entry[1] is not None or entry[0] + self.recheck_interval > time.monotonic()):
+            return entry[1]
+
+        name = TREATMENT_TABLE.format(schema=schema, table=table)
+        rows = query.execute_sql_query_as_dict("SELECT to_regclass(:name) IS NOT NULL AS exists", database, params={"name": name})
+        if not rows[0]["exists"]:
+            _log.info("Treatment table %s does not exist, the treatment json is expanded instead", name)
+            name = None
+
+        with self.lock:
+            self.tables[key] = (time.monotonic(), name)
+        return name
+
+    def build(self, database, schema, table, entity_id_col):
+        """Build the treatment table of the entity table as a new table and replace the old one with it
+        Concurrent builds of the table (e.g. by several workers) wait for each other on an advisory lock. The new table is
+        filled and indexed while the old one is still read. Only the final DROP and RENAME take an exclusive lock, for
+        which they wait until the running statements on the old table end; statements that start meanwhile wait and then
+        read the new table.
+        """
+        name = TREATMENT_TABLE.format(schema=schema, table=table)
+        new_name = TREATMENT_TABLE_NEW.format(schema=schema, table=table)
+        _log.info("Build treatment table %s", name)
+        with get_engine(database).begin() as connection:
+            connection.execute(text("SELECT pg_advisory_xact_lock(hashtext(:name))"), {"name": name})
+            connection.execute(text("DROP TABLE IF EXISTS {new_name}".format(new_name=new_name)))
+            connection.execute(
+                text("CREATE TABLE {new_name} AS {rows}".format(new_name=new_name, rows=treatment_rows_sql(schema, table, entity_id_col)))
+            )
+            # agents @> (base agents), regimen_number and agents = (exact combination), entity and regimen (null check)
+            connection.execute(text("CREATE INDEX ON {new_name} USING gin (agents)".format(new_name=new_name)))
+            connection.execute(text("CREATE INDEX ON {new_name} (regimen_number, agents)".format(new_name=new_name)))
+            connection.execute(text("CREATE INDEX ON {new_name} (entity_id, regimen_number)".format(new_name=new_name)))
+            connection.execute(text("ANALYZE {new_name}".format(new_name=new_name)))
+
+            connection.execute(text("DROP TABLE IF EXISTS {name}".format(name=name)))
+            connection.execute(text("ALTER TABLE {new_name} RENAME TO {table}".format(new_name=new_name, table=name.split(".", 1)[1])))
+        return name
+
+    def refresh(self, database=None, schema=None, table=None, entity_id_col=None):
+        """Build the treatment table of an entity table, or of all entity tables whose treatment tables were looked up by
+        this process, returns the names of the built tables
+        """
+        with self.lock:
+            keys = dict(self.entity_id_cols)
+        if database is not None:
+            keys = {(database, schema, table): entity_id_col}
+
+        built = []
+        for (key_database, key_schema, key_table), key_entity_id_col in keys.items():
+            name = self.build(key_database, key_schema, key_table, key_entity_id_col)
+            with self.lock:
+                self.tables[(key_database, key_schema, key_table)] = (time.monotonic(), name)
+                self.entity_id_cols[(key_database, key_schema, key_table)] = key_entity_id_col
+            built.append(name)
+        return built
+
+
+treatment_tables = TreatmentTables()
@@ -1,6 +1,7 @@
 import pytest
 from fastapi import FastAPI
 from fastapi.testclient import TestClient
+from sqlalchemy import create_engine, text
 from visyn_core.security.manager import SecurityManager
 from visyn_core.security.model import User
 from visyn_core.server.visyn_server import create_visyn_server
@@ -8,6 +9,25 @@ from visyn_core.tests.fixtures.postgres_db import postgres_db
 
 assert postgres_db  # silence unused import warning
 
+# entity tables of the tests: 30 tissues, a gene score (missing for every 7th tissue) and a panel
+ENTITY_TABLES_SQL = """
+CREATE SCHEMA IF NOT EXISTS tissue;
+CREATE TABLE IF NOT EXISTS public.tdp_gene (ensg text PRIMARY KEY, symbol text, species text);
+INSERT INTO public.tdp_gene VALUES ('ENSG1', 'TP53', 'human'), ('ENSG2', 'KRAS', 'human') ON CONFLICT DO NOTHING;
+CREATE TABLE tissue.tdp_tissue (tissuename text PRIMARY KEY, age integer, gender text, bmi real, weight numeric(4, 1), treatment text);
+INSERT INTO tissue.tdp_tissue
+SELECT 'T' || lpad(i::text, 2, '0'), CASE WHEN i % 10 = 0 THEN NULL ELSE 20 + i END,
+  CASE WHEN i % 2 = 0 THEN 'male' ELSE 'female' END, 0.1 * (1 + i % 3), 50 + i * 0.5,
+  CASE WHEN i % 5 = 0 THEN NULL
+  ELSE '[{"AGENT": "Cisplatin", "REGIMEN_NUMBER": "1"}, {"AGENT": "' || (ARRAY['Crizotinib', 'Paclitaxel'])[1 + i % 2] || '", "REGIMEN_NUMBER": "' || (1 + i % 2) || '"}]'
+  END
+FROM generate_series(1, 30) i;
+CREATE TABLE tissue.tdp_expression (tissuename text, ensg text, tpm real, PRIMARY KEY (tissuename, ensg));
+INSERT INTO tissue.tdp_expression SELECT 'T' || lpad(i::text, 2, '0'), 'ENSG1', i * 1.5 FROM generate_series(1, 30) i WHERE i % 7 <> 0;
+CREATE TABLE tissue.tdp_panelassignment (tissuename text, panel text);
+INSERT INTO tissue.tdp_panelassignment SELECT 'T' || lpad(i::text, 2, '0'), 'TCGA normals' FROM generate_series(1, 30) i WHERE i % 4 = 0;
+"""
+
 
 @pytest.fixture(scope="session")
 def app(postgres_db) -> FastAPI:
@@ -17,6 +37,8 @@ def app(postgres_db) -> FastAPI:
             "coral": {
                 "dburl": postgres_db.url,
             },
+            # the entity tables of the tests are in the database of the cohorts
+            "tdp_publicdb": {"dburl": postgres_db.url},
         }
     )
 
@@ -32,3 +54,30 @@ def client(monkeypatch, app: FastAPI):
 
     with TestClient(app) as client:
         yield client
+
+
+@pytest.fixture(scope="session")
+def entity_db(app, postgres_db):
+    # engine of the test database, with the entity tables
+    engine = create_engine(postgres_db.url)
+    with engine.begin() as connection:
+        connection.execute(text(ENTITY_TABLES_SQL))
+    yield engine
+    engine.dispose()
+
+
+@pytest.fixture()
+def db_get(client, entity_db):
+    # get a route of the cohort db, returns the json of the response
+    def get(route, **params):
+        response = client.get("/api/cohortdb/db/" + route, params=params)
+        assert response.status_code == 200, response.text
+        return response.json()
+
+    return get
+
+
+@pytest.fixture()
+def root_cohort(db_get):
+    # id of a new initial cohort of all tissues
+    return db_get("create", name="All", previous=-1, isInitial=1, database="tdp_publicdb", schema="tissue", table="tdp_tissue")[0]
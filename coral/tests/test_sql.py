@@ -0,0 +1,182 @@
+import json
+
+from sqlalchemy import text
+from visyn_core.security.manager import SecurityManager
+from visyn_core.security.model import User
+
+from coral.sql_bitmap import cohort_bitmaps
+from coral.sql_cohort_cache import cohort_cache
+from coral.sql_query_mapper import VALUE_LIST_DELIMITER, QueryElements
+from coral.sql_response import CONTINUATION_TOKEN_HEADER
+from coral.sql_stats import stats_catalog
+
+
+def test_pages_of_tied_real_values_do_not_repeat_or_skip_rows(client, db_get, root_cohort):
+    # bmi has three distinct real values, every page ends inside a group of tied values
+    expected = sorted(db_get("cohortData", cohortId=root_cohort), key=lambda row: row["tissuename"])
+    for direction in ["asc", "desc"]:
+        rows = []
+        params = {"cohortId": root_cohort, "orderBy": "bmi", "direction": direction, "limit": 4, "attributes": "bmi"}
+        for _page in range(len(expected)):
+            response = client.get("/api/cohortdb/db/cohortData", params=params)
+            rows += response.json()
+            if CONTINUATION_TOKEN_HEADER not in response.headers:
+                break
+            params["after"] = response.headers[CONTINUATION_TOKEN_HEADER]
+
+        ordered = sorted(expected, key=lambda row: row["bmi"], reverse=direction == "desc")  # stable, by id within a value
+        assert [row["tissuename"] for row in rows] == [row["tissuename"] for row in ordered]
+        assert set(rows[0]) == {"tissuename", "bmi"}
+
+
+def test_request_cancelled_before_its_statement_starts(client, db_get, root_cohort):
+    assert db_get("cancel", requestId="cancelled-early") == {"requestId": "cancelled-early", "cancelled": 0}
+
+    response = client.get("/api/cohortdb/db/size", params={"cohortId": root_cohort}, headers={"X-Request-Id": "cancelled-early"})
+    assert response.status_code == 409
+    assert response.json()["requestId"] == "cancelled-early"
+
+    assert db_get("size", cohortId=root_cohort) == [{"size": 30}]  # other requests still run
+
+
+def test_hist_batch_prefetches_only_the_statistics(monkeypatch, db_get, root_cohort):
+    specs = [
+        {"type": "dataCat", "attribute": "gender"},
+        {"type": "dataNum", "attribute": "age"},
+        {"type": "geneScoreNum", "table": "expression", "attribute": "tpm", "ensg": "ENSG1"},
+        {"type": "panelAnnotation", "panel": "TCGA normals"},
+    ]
+    built = []
+    parallel = []
+    get_hist_sql, execute_parallel = QueryElements.get_hist_sql, QueryElements.execute_parallel
+
+    def record_hist_sql(self, args, *rest):
+        built.append(args["type"])
+        return get_hist_sql(self, args, *rest)
+
+    def record_parallel(self, function, items):
+        parallel.append(len(self.connections))  # the children must not wait for the pool while the request holds a connection
+        return execute_parallel(self, function, items)
+
+    monkeypatch.setattr(QueryElements, "get_hist_sql", record_hist_sql)
+    monkeypatch.setattr(QueryElements, "execute_parallel", record_parallel)
+    db_get("cohortData", cohortId=root_cohort, attributes="age")  # caches the cohort, histBatch holds no connection before the prefetch
+    db_get("refreshStats")
+    hists = db_get("histBatch", cohortId=root_cohort, specs=json.dumps(specs))
+
+    assert built == [spec["type"] for spec in specs]  # once, by the batch statement
+    assert parallel == [0]
+    assert len(stats_catalog.summary()) == len(specs)
+    assert hists == [db_get("hist", cohortId=root_cohort, **spec) for spec in specs]
+
+
+def test_set_operations_check_the_cohort_ids_before_reading_the_bitmaps(monkeypatch, client, db_get, root_cohort):
+    women = db_get("createUseEqulasFilter", cohortId=root_cohort, name="Women", attribute="gender", numeric="false", values="female")[0]
+    old = db_get("createUseNumFilter", cohortId=root_cohort, name="Old", attribute="age", ranges="gte_40")[0]
+
+    def get_bitmap(query, cohort):
+        raise AssertionError("bitmap of cohort {id} read".format(id=cohort.id))
+
+    with monkeypatch.context() as patch:
+        patch.setattr(cohort_bitmaps, "get_bitmap", get_bitmap)
+        for cohort_ids in [[women], [women, women], [women, old, women], [women, "x"]]:
+            params = {"name": "Invalid", "cohortIds": VALUE_LIST_DELIMITER.join(str(cohort_id) for cohort_id in cohort_ids)}
+            assert client.get("/api/cohortdb/db/createUnion", params=params).status_code == 400
+
+    union = db_get("createUnion", name="Women or old", cohortIds=VALUE_LIST_DELIMITER.join([str(women), str(old)]))[0]
+    difference = db_get("createDifference", name="Young women", cohortIds=VALUE_LIST_DELIMITER.join([str(women), str(old)]))[0]
+    assert db_get("size", cohortId=union) == [{"size": 19}]
+    assert db_get("size", cohortId=difference) == [{"size": 10}]
+
+
+def test_sizes_are_stored_with_the_cohorts_and_backfilled(entity_db, db_get, root_cohort):
+    men = db_get("createUseEqulasFilter", cohortId=root_cohort, name="Men", attribute="gender", numeric="false", values="male")[0]
+
+    def stored_sizes():
+        with entity_db.connect() as connection:
+            rows = connection.execute(text("SELECT id, size FROM cohort.cohort WHERE id = ANY(:ids)"), {"ids": [root_cohort, men]})
+            return dict(rows.fetchall())
+
+    assert stored_sizes() == {root_cohort: None, men: 15}  # initial cohorts get their size on first access
+
+    # as do the cohorts created before the size was stored
+    with entity_db.begin() as connection:
+        connection.execute(text("UPDATE cohort.cohort SET size = NULL WHERE id = :id"), {"id": men})
+    cohort_cache.invalidate(men)
+    cohorts = db_get("getDBCohorts", cohortIds=VALUE_LIST_DELIMITER.join([str(root_cohort), str(men)]))
+    assert {cohort["id"]: cohort["size"] for cohort in cohorts} == {root_cohort: 30, men: 15}
+    assert stored_sizes() == {root_cohort: 30, men: 15}
+    assert db_get("size", cohortId=men) == [{"size": 15}]
+
+
+def test_size_preview_matches_the_size_of_each_filter(client, db_get, root_cohort):
+    filters = [
+        ("sizeUseEqulasFilter", {"type": "equals", "attribute": "gender", "numeric": "false"}, "values", ["male", "female", "null"]),
+        ("sizeUseNumFilter", {"type": "num", "attribute": "age"}, "ranges", ["lt_30", "gte_30%lt_40", "gte_40", "gte_null"]),
+        (
+            "sizeUseGeneNumFilter",
+            {"type": "geneNum", "table": "expression", "attribute": "tpm", "ensg": "ENSG1"},
+            "ranges",
+            ["lt_20", "gte_20"],
+        ),
+        ("sizeUsePanelAnnotationFilter", {"type": "panel", "panel": "TCGA normals"}, "values", ["true", "false"]),
+    ]
+    for route, parameters, candidate_parameter, candidates in filters:
+        sizes = db_get("sizePreview", cohortId=root_cohort, candidates=json.dumps(candidates), **parameters)
+        expected = [
+            db_get(route, cohortId=root_cohort, **dict(parameters, **{candidate_parameter: candidate}))[0]["size"]
+            for candidate in candidates
+        ]
+        assert sizes == [{"candidate": candidate, "size": size} for candidate, size in zip(candidates, expected, strict=True)]
+
+    for parameters in [
+        {"type": "equals", "attribute": "gender", "numeric": "false", "candidates": "male"},  # not json
+        {"type": "equals", "attribute": "gender", "numeric": "false", "candidates": '{"values": "male"}'},
+        {"type": "equals", "attribute": "gender", "numeric": "false", "candidates": "[]"},
+        {"type": "equals", "attribute": "gender", "numeric": "false", "candidates": "[1]"},
+        {"type": "equals", "attribute": "gender", "candidates": '["male"]'},  # numeric is missing
+        {"type": "treatment", "candidates": '["Cisplatin"]'},
+    ]:
+        assert client.get("/api/cohortdb/db/sizePreview", params=dict(parameters, cohortId=root_cohort)).status_code == 400
+
+
+def test_data_routes_return_the_projected_attributes(entity_db, db_get, root_cohort):
+    old = db_get("createUseNumFilter", cohortId=root_cohort, name="Old", attribute="age", ranges="gte_40")[0]
+    everything = {row["tissuename"]: row for row in db_get("cohortData", cohortId=root_cohort)}
+    old_ids = sorted(name for name, row in everything.items() if row["age"] is not None and row["age"] >= 40)
+
+    def projected(rows, columns):
+        assert all(set(row) == set(columns) for row in rows)
+        assert all(row[column] == everything[row["tissuename"]][column] for row in rows for column in columns)
+        return sorted(row["tissuename"] for row in rows)
+
+    assert projected(db_get("cohortData", cohortId=root_cohort, attributes="age, gender"), ["tissuename", "age", "gender"]) == sorted(
+        everything
+    )
+    assert projected(db_get("cohortData", cohortId=old, attributes="gender,tissuename"), ["tissuename", "gender"]) == old_ids
+    assert db_get("cohortData", cohortId=old, attribute="bmi") == db_get("cohortData", cohortId=old, attributes="bmi")
+    data = db_get("dataUseNumFilter", cohortId=root_cohort, attribute="age", ranges="gte_40", attributes="weight")
+    assert projected(data, ["tissuename", "weight"]) == old_ids
+
+    # cohorts without stored filters and membership select the attributes from their statement
+    with entity_db.begin() as connection:
+        connection.execute(text("UPDATE cohort.cohort SET filters = NULL WHERE id = :id"), {"id": old})
+        connection.execute(text("DELETE FROM cohort.cohort_entity WHERE cohort_id = :id"), {"id": old})
+    cohort_cache.invalidate(old)
+    assert projected(db_get("cohortData", cohortId=old, attributes="treatment"), ["tissuename", "treatment"]) == old_ids
+
+
+def test_requests_are_only_cancelled_by_their_user(monkeypatch, client, db_get, root_cohort):
+    with monkeypatch.context() as patch:
+        patch.setattr(SecurityManager, "current_user", property(lambda self: User(id="other")))
+        assert db_get("cancel", requestId="shared-id") == {"requestId": "shared-id", "cancelled": 0}
+
+    headers = {"X-Request-Id": "shared-id"}
+    response = client.get("/api/cohortdb/db/size", params={"cohortId": root_cohort}, headers=headers)
+    assert response.status_code == 200
+
+    db_get("cancel", requestId="shared-id")
+    response = client.get(
+        "/api/cohortdb/db/hist", params={"cohortId": root_cohort, "type": "dataCat", "attribute": "gender"}, headers=headers
+    )
+    assert response.status_code == 409
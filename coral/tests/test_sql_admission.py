@@ -0,0 +1,46 @@
+import asyncio
+import threading
+
+import pytest
+
+from coral.sql_admission import AdmissionRejectedError, PriorityClass
+
+
+def test_requests_above_the_limit_wait_and_are_shed():
+    priority_class = PriorityClass("hist", limit=1, queue_size=0, max_wait=0.01)
+    priority_class.acquire()
+    with pytest.raises(AdmissionRejectedError):
+        priority_class.acquire()  # the queue is full
+
+    priority_class.queue_size = 1
+    with pytest.raises(AdmissionRejectedError):
+        priority_class.acquire()  # the deadline passed
+
+    priority_class.release()
+    priority_class.acquire()
+    assert priority_class.stats()["rejected"] == 2
+    assert priority_class.stats()["running"] == 1
+
+
+def test_async_requests_wait_in_the_same_queue():
+    priority_class = PriorityClass("hist", limit=1, queue_size=1, max_wait=5)
+
+    async def wait_for_release():
+        priority_class.acquire()
+        waiting = asyncio.ensure_future(priority_class.acquire_async())
+        await asyncio.sleep(0.05)
+        assert priority_class.stats()["waiting"] == 1
+        with pytest.raises(AdmissionRejectedError):
+            await priority_class.acquire_async()  # the queue is full
+
+        threading.Thread(target=priority_class.release).start()  # e.g. a flask request that ends
+        await waiting
+
+    asyncio.run(wait_for_release())
+    assert priority_class.stats()["running"] == 1
+    assert priority_class.stats()["waiting"] == 0
+
+    priority_class.max_wait = 0.05
+    with pytest.raises(AdmissionRejectedError):
+        asyncio.run(priority_class.acquire_async())  # the deadline passed
+    assert priority_class.stats()["rejected"] == 2
@@ -0,0 +1,81 @@
+import asyncio
+import threading
+
+import pytest
+from sqlalchemy.ext.asyncio import AsyncTransaction
+
+from coral.sql_admission import PRIORITY_DATA, PRIORITY_SIZE, PriorityClass, admission_controller
+from coral.sql_async import FILTER_BUILDERS, AsyncQueryElements, async_engine_registry
+from coral.sql_engines import engine_registry
+from coral.sql_query_mapper import QueryElements
+
+
+def test_filter_routes_use_the_builders_of_the_flask_routes():
+    for filter_name, builder_name in FILTER_BUILDERS.items():
+        assert callable(getattr(QueryElements, builder_name)), filter_name
+
+
+def test_async_data_is_decoded_like_the_flask_data(client, db_get, root_cohort):
+    params = {"cohortId": root_cohort, "attributes": "age,weight", "orderBy": "weight", "limit": 50}
+    response = client.get("/api/cohortdb/async/cohortData", params=params)
+    assert response.status_code == 200, response.text
+    rows = response.json()
+    assert rows == db_get("cohortData", **params)
+    assert rows[0] == {"tissuename": "T01", "age": 21, "weight": 50.5}  # numeric values are sent as numbers
+
+
+def test_async_filter_routes_build_the_statements_off_the_event_loop(monkeypatch, client, db_get, root_cohort):
+    adults = db_get("createUseNumFilter", cohortId=root_cohort, name="Adults", attribute="age", ranges="gte_30")[0]
+    threads = []
+    build = QueryElements.create_cohort_equals_filtered
+
+    def create_cohort_equals_filtered(self, *args):
+        with pytest.raises(RuntimeError):
+            asyncio.get_running_loop()  # the builder reads the stored members with a blocking query
+        threads.append(threading.current_thread().name)
+        return build(self, *args)
+
+    monkeypatch.setattr(QueryElements, "create_cohort_equals_filtered", create_cohort_equals_filtered)
+    params = {"cohortId": adults, "attribute": "gender", "numeric": "false", "values": "male"}
+    response = client.get("/api/cohortdb/async/sizeUseEqulasFilter", params=params)
+    assert response.status_code == 200, response.text
+    assert response.json() == db_get("sizeUseEqulasFilter", **params) == [{"size": 8}]
+    assert len(threads) == 2
+
+
+def test_async_routes_are_rejected_by_the_admission_of_their_priority(monkeypatch, client, root_cohort):
+    monkeypatch.setitem(admission_controller.classes, PRIORITY_SIZE, PriorityClass(PRIORITY_SIZE, 0, 0, 0))
+    response = client.get("/api/cohortdb/async/size", params={"cohortId": root_cohort})
+    assert response.status_code == 503
+    assert response.json()["priority"] == PRIORITY_SIZE
+    assert "Retry-After" in response.headers
+
+    response = client.get("/api/cohortdb/async/cohortData", params={"cohortId": root_cohort, "attributes": "age"})
+    assert response.status_code == 200
+
+
+def test_async_routes_return_their_connections_and_slots(monkeypatch, client, db_get, root_cohort):
+    adults = db_get("createUseNumFilter", cohortId=root_cohort, name="Adults", attribute="age", ranges="gte_30")[0]
+    statements = []
+    execute = AsyncQueryElements.execute_sql_query_as_dict
+
+    async def execute_sql_query_as_dict(self, sql_text, *args):
+        statements.append(len(self.query.connections))  # the sync connections of the builders are returned before
+        return await execute(self, sql_text, *args)
+
+    async def rollback(self):
+        raise RuntimeError("connection was closed in the middle of operation")
+
+    monkeypatch.setattr(AsyncQueryElements, "execute_sql_query_as_dict", execute_sql_query_as_dict)
+    monkeypatch.setattr(AsyncTransaction, "rollback", rollback)
+    for limit in range(1, admission_controller.classes[PRIORITY_DATA].limit + 2):  # more requests than slots, none cached
+        params = {"cohortId": adults, "attribute": "gender", "numeric": "false", "values": "male", "limit": limit}
+        response = client.get("/api/cohortdb/async/dataUseEqulasFilter", params=params)
+        assert response.status_code == 200, response.text
+        assert len(response.json()) == limit
+
+    assert statements == [0] * len(statements)
+    assert len(statements) > admission_controller.classes[PRIORITY_DATA].limit
+    assert admission_controller.classes[PRIORITY_DATA].stats()["running"] == 0
+    assert all(pool["checkedOut"] == 0 for pool in engine_registry.status())
+    assert all(engine.pool.checkedout() == 0 for engine in async_engine_registry.engines.values())
@@ -0,0 +1,137 @@
+import threading
+
+from sqlalchemy import text
+
+from coral.sql_bitmap import (
+    CohortBitmaps,
+    EntityDictionary,
+    bitmap_size,
+    cohort_bitmaps,
+    decode_bitmap,
+    difference,
+    encode_bitmap,
+    intersection,
+    union,
+)
+from coral.sql_cohort_cache import cohort_cache
+from coral.sql_engines import connect_unpooled
+from coral.sql_query_mapper import VALUE_LIST_DELIMITER, QueryElements
+
+
+def test_set_algebra_on_the_bitmaps_of_the_dictionary():
+    dictionary = EntityDictionary(("tdp_publicdb", "tissue", "tdp_tissue"))
+    for position, entity_id in enumerate(["T1", "T2", "T3", "T4", "T5"]):
+        dictionary.add(entity_id, position)
+
+    first = dictionary.get_bitmap(["T1", "T2", "T3"])
+    second = dictionary.get_bitmap(["T3", "T5"])
+    assert dictionary.get_entity_ids(union([first, second])) == ["T1", "T2", "T3", "T5"]
+    assert dictionary.get_entity_ids(intersection([first, second])) == ["T3"]
+    assert dictionary.get_entity_ids(difference(first, [second])) == ["T1", "T2"]
+    assert bitmap_size(first) == 3
+    assert dictionary.get_entity_ids(0) == []
+
+
+def test_bitmap_encoding_roundtrip():
+    bitmap = (1 << 100000) | (1 << 3) | 1
+    assert decode_bitmap(encode_bitmap(bitmap)) == bitmap
+    assert decode_bitmap(encode_bitmap(0)) == 0
+    assert len(encode_bitmap(bitmap)) < 200
+
+
+def test_workers_backfill_the_same_bitmaps_at_the_same_time(entity_db, db_get, root_cohort):
+    women = db_get("createUseEqulasFilter", cohortId=root_cohort, name="Women", attribute="gender", numeric="false", values="female")[0]
+    old = db_get("createUseNumFilter", cohortId=root_cohort, name="Old", attribute="age", ranges="gte_40")[0]
+    members = {cohort_id: sorted(row["tissuename"] for row in db_get("cohortData", cohortId=cohort_id)) for cohort_id in [women, old]}
+
+    # cohorts and entity tables from before the bitmaps were stored
+    with entity_db.begin() as connection:
+        connection.execute(text("UPDATE cohort.cohort SET bitmap = NULL"))
+        connection.execute(text("DELETE FROM cohort.entity_dictionary WHERE entity_table = 'tdp_tissue'"))
+    cohort_cache.invalidate()
+    cohort_bitmaps.dictionaries.clear()
+    cohort_bitmaps.invalidate()
+
+    workers = [CohortBitmaps(max_bytes=1024 * 1024, ttl=60) for _ in range(4)]  # the processes of the server
+    start = threading.Barrier(len(workers))
+    results = {}
+
+    def backfill(worker):
+        query = QueryElements()
+        try:
+            cohorts = [query.get_cohort_from_db({"cohortId": cohort_id}, "") for cohort_id in [old, women]]
+            start.wait()
+            results[id(worker)] = {
+                cohort.id: sorted(worker.get_entity_ids(query, cohort, worker.get_bitmap(query, cohort))) for cohort in cohorts
+            }
+        finally:
+            query.close()
+
+    threads = [threading.Thread(target=backfill, args=(worker,)) for worker in workers]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert list(results.values()) == [members] * len(workers)
+    with entity_db.connect() as connection:
+        positions = connection.execute(
+            text("SELECT entity_id, position FROM cohort.entity_dictionary WHERE entity_table = 'tdp_tissue'")
+        ).fetchall()
+        stored = dict(
+            connection.execute(
+                text("SELECT id, bitmap FROM cohort.cohort WHERE id IN (:women, :old)"), {"women": women, "old": old}
+            ).fetchall()
+        )
+    assert sorted(position for _entity_id, position in positions) == list(range(len(set(members[women] + members[old]))))
+
+    # the stored bitmaps are read by the other workers with the stored dictionary
+    query = QueryElements()
+    try:
+        for cohort_id, bitmap in stored.items():
+            cohort = query.get_cohort_from_db({"cohortId": cohort_id}, "")
+            assert (
+                sorted(CohortBitmaps(max_bytes=1024 * 1024, ttl=60).get_entity_ids(query, cohort, decode_bitmap(bytes(bitmap))))
+                == members[cohort_id]
+            )
+    finally:
+        query.close()
+    overlaps = db_get("cohortOverlaps", cohortIds=VALUE_LIST_DELIMITER.join([str(women), str(old)]))
+    assert overlaps == [{"cohortIds": [women, old], "size": len(set(members[women]) & set(members[old]))}]
+
+
+class DictionaryCohort:
+    def __init__(self, table):
+        self.entity_database = "tdp_publicdb"
+        self.entity_schema = "cellline"
+        self.entity_table = table
+
+
+def test_positions_of_an_entity_table_are_assigned_while_another_one_waits(entity_db):
+    bitmaps = CohortBitmaps(max_bytes=1024 * 1024, ttl=60)
+    created = {}
+
+    def create(table):
+        query = QueryElements()
+        try:
+            created[table] = bitmaps.create_bitmap(query, DictionaryCohort(table), ["C1", "C2"])
+        finally:
+            query.close()
+
+    blocker = connect_unpooled(entity_db)  # another worker assigns the positions of the first table
+    try:
+        blocker.cursor().execute("SELECT pg_advisory_lock(hashtext('coral_dictionary_tdp_publicdb/cellline/first'))")
+        waiting = threading.Thread(target=create, args=("first",))
+        waiting.start()
+        other = threading.Thread(target=create, args=("second",))
+        other.start()
+        other.join(5)
+        assert created == {"second": 0b11}
+        assert waiting.is_alive()
+    finally:
+        blocker.close()  # releases the advisory lock
+    waiting.join(5)
+    assert created == {"second": 0b11, "first": 0b11}
+
+    with entity_db.begin() as connection:
+        connection.execute(text("DELETE FROM cohort.entity_dictionary WHERE entity_schema = 'cellline'"))
@@ -0,0 +1,34 @@
+import pytest
+
+from coral.sql_cache import LRUResultCache, ResultCache, fingerprint
+
+
+def test_fingerprint_ignores_argument_order_and_assignids():
+    assert fingerprint("/hist", {"cohortId": ["2"], "type": ["dataCat"]}) == fingerprint(
+        "/hist", {"type": ["dataCat"], "_assignids": ["true"], "cohortId": ["2"]}
+    )
+    assert fingerprint("/hist", {"cohortId": ["2"]}) != fingerprint("/size", {"cohortId": ["2"]})
+
+
+def test_lru_evicts_by_size_and_invalidates_by_cohort():
+    cache = LRUResultCache(max_bytes=10, ttl=60)
+    cache.put("a", "A", 4, "1")
+    cache.put("b", "B", 4, "2")
+    assert cache.get("a") == "A"  # a is now the most recently used entry
+    cache.put("c", "C", 4, "2")
+    assert cache.get("b") is None
+    assert cache.stats()["evictions"] == 1
+
+    cache.invalidate("2")
+    assert cache.get("c") is None
+    assert cache.get("a") == "A"
+    assert cache.stats()["hits"] == 2
+
+
+def test_result_cache_implementations_have_to_implement_the_interface():
+    class GetOnlyCache(ResultCache):
+        def get(self, key):
+            return None
+
+    with pytest.raises(TypeError):
+        GetOnlyCache()
@@ -0,0 +1,40 @@
+import pytest
+
+from coral.sql_cancel import QueryCancelledError, RunningQueries
+
+
+class RecordingQueries(RunningQueries):
+    def __init__(self):
+        super().__init__()
+        self.cancelled_pids = []
+
+    def cancel_backend(self, engine, backend_pid):
+        self.cancelled_pids.append(backend_pid)
+        return True
+
+
+def test_newer_request_of_a_group_cancels_the_running_statements():
+    queries = RecordingQueries()
+    first = queries.start("alice", "a", "slider", None, 11)
+    queries.start("alice", "b", "slider", None, 12)
+    assert queries.cancelled_pids == [11]
+    assert queries.is_cancelled("alice", "a")
+
+    queries.finish("alice", "a", first)
+    assert queries.cancel("alice", "a") == 0  # finished statements are not cancelled again
+
+    queries.cancel("alice", "c")
+    with pytest.raises(QueryCancelledError):
+        queries.start("alice", "c", None, None, 13)  # cancelled before its statement started
+
+
+def test_requests_of_other_users_are_not_cancelled():
+    queries = RecordingQueries()
+    queries.start("alice", "a", "slider", None, 11)
+    queries.start("bob", "b", "slider", None, 12)  # same group name, another user
+    queries.start("bob", "a", None, None, 13)  # same request id, another user
+    assert queries.cancelled_pids == []
+
+    assert queries.cancel("bob", "a") == 1
+    assert queries.cancelled_pids == [13]
+    assert not queries.is_cancelled("alice", "a")
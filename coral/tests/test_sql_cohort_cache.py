@@ -0,0 +1,98 @@
+import select
+import time
+
+from sqlalchemy import text
+
+from coral.sql_cohort_cache import NOTIFY_CHANNEL, CohortCache, cohort_cache, config
+from coral.sql_engines import connect_unpooled
+from coral.sql_query_mapper import QueryElements
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def test_cohort_cache_is_bounded_and_invalidated_by_id():
+    cache = CohortCache(max_entries=2)
+    cache.put(1, {"id": 1, "name": "a"})
+    cache.put(2, {"id": 2, "name": "b"})
+    assert cache.get(1)["name"] == "a"  # 1 is now the most recently used cohort
+    cache.put(3, {"id": 3, "name": "c"})
+    assert cache.get(2) is None
+
+    cache.invalidate(1)
+    assert cache.get(1) is None
+    assert cache.get(3)["name"] == "c"
+
+
+def test_renamed_cohorts_are_read_again(db_get, root_cohort):
+    db_get("hist", cohortId=root_cohort, type="dataCat", attribute="gender")
+    assert cohort_cache.get(root_cohort)["name"] == "All"
+
+    assert db_get("updateCohortName", cohortId=root_cohort, name="Renamed")[0]["name"] == "Renamed"
+    assert cohort_cache.get(root_cohort) is None
+    db_get("hist", cohortId=root_cohort, type="dataNum", attribute="age")
+    assert cohort_cache.get(root_cohort)["name"] == "Renamed"
+
+
+def test_rows_read_before_the_rename_is_committed_are_not_kept(monkeypatch, client, db_get, root_cohort):
+    notify_cohort_changed = QueryElements.notify_cohort_changed
+
+    def read_concurrently(self, session, cohort_id):
+        notify_cohort_changed(self, session, cohort_id)
+        query = QueryElements()  # another request of the worker, before the rename is committed
+        try:
+            assert query.get_cohort_from_db({"cohortId": cohort_id}, "").name == "All"
+        finally:
+            query.close()
+        assert cohort_cache.get(cohort_id)["name"] == "All"
+
+    monkeypatch.setattr(QueryElements, "notify_cohort_changed", read_concurrently)
+    db_get("updateCohortName", cohortId=root_cohort, name="Renamed")
+    assert cohort_cache.get(root_cohort) is None
+
+    response = client.get("/api/cohortdb/db/updateCohortName", params={"cohortId": "1 OR 1=1", "name": "Renamed"})
+    assert response.status_code == 400
+
+
+def test_stale_entries_are_invalidated_by_the_notifications_of_other_workers(monkeypatch, entity_db, db_get, root_cohort):
+    monkeypatch.setattr(config, "cohort_cache_notify", True)
+    invalidated = []
+    invalidate = cohort_cache.invalidate
+
+    def record_invalidate(cohort_id=None):
+        invalidated.append(cohort_id)
+        invalidate(cohort_id)
+
+    monkeypatch.setattr(cohort_cache, "invalidate", record_invalidate)
+    db_get("hist", cohortId=root_cohort, type="dataCat", attribute="gender")  # starts the listener of this worker
+    wait_for(lambda: cohort_cache.listener is not None and None in invalidated)  # everything is invalidated once it listens
+    db_get("hist", cohortId=root_cohort, type="dataNum", attribute="age")
+    assert cohort_cache.get(root_cohort)["name"] == "All"
+
+    # another worker renames the cohort
+    with entity_db.begin() as connection:
+        connection.execute(text("UPDATE cohort.cohort SET name = 'Renamed elsewhere' WHERE id = :id"), {"id": root_cohort})
+        connection.execute(text("SELECT pg_notify(:channel, :payload)"), {"channel": NOTIFY_CHANNEL, "payload": str(root_cohort)})
+    wait_for(lambda: root_cohort in invalidated)
+    assert cohort_cache.get(root_cohort) is None
+
+    db_get("hist", cohortId=root_cohort, type="dataNum", attribute="bmi")
+    assert cohort_cache.get(root_cohort)["name"] == "Renamed elsewhere"
+
+
+def test_renames_are_sent_to_the_other_workers(monkeypatch, entity_db, db_get, root_cohort):
+    monkeypatch.setattr(config, "cohort_cache_notify", True)
+    listener = connect_unpooled(entity_db)
+    try:
+        listener.cursor().execute("LISTEN {channel}".format(channel=NOTIFY_CHANNEL))
+        db_get("updateCohortName", cohortId=root_cohort, name="Renamed")
+
+        assert select.select([listener], [], [], 5) != ([], [], [])
+        listener.poll()
+        assert [notify.payload for notify in listener.notifies] == [str(root_cohort)]
+    finally:
+        listener.close()
@@ -0,0 +1,49 @@
+from coral.sql_filter import FILTER_GENE_NUM, FILTER_NUM, CohortFilter, FilterCompiler
+
+
+class ClauseStub:
+    def num_filter_clause(self, ranges, column, error_msg):
+        return "{column} {ranges}".format(column=column, ranges=ranges)
+
+
+def test_filter_json_roundtrip():
+    cohort_filter = CohortFilter("tissue", "tdp_tissue").add_predicate({"type": FILTER_NUM, "attribute": "age", "ranges": "gt_2"})
+    restored = CohortFilter.from_json(cohort_filter.to_json())
+    assert restored.entity_table == "tdp_tissue"
+    assert restored.predicates == cohort_filter.predicates
+
+
+def test_compile_is_flat_and_deduplicates_score_joins():
+    gene = {"type": FILTER_GENE_NUM, "table": "expression", "attribute": "tpm", "ensg": "ENSG00000141510"}
+    cohort_filter = CohortFilter("tissue", "tdp_tissue")
+    for predicate in [{"type": FILTER_NUM, "attribute": "age", "ranges": "gt_2"}, dict(gene, ranges="gt_1"), dict(gene, ranges="lt_5")]:
+        cohort_filter = cohort_filter.add_predicate(predicate)
+
+    sql_text = FilterCompiler(ClauseStub(), "tissuename", "error").compile(cohort_filter)
+    assert sql_text.startswith("SELECT base.* FROM tissue.tdp_tissue base LEFT OUTER JOIN")
+    assert sql_text.count("JOIN (") == 1
+    assert sql_text.endswith("WHERE (base.age gt_2) AND (j0.score gt_1) AND (j0.score lt_5)")
+
+
+def test_compile_counts_evaluates_all_candidates_in_one_scan():
+    gene = {"type": FILTER_GENE_NUM, "table": "expression", "attribute": "tpm", "ensg": "ENSG00000141510"}
+    predicates = [dict(gene, ranges="lt_1"), dict(gene, ranges="gte_1")]
+
+    sql_text = FilterCompiler(ClauseStub(), "tissuename", "error").compile_counts(
+        CohortFilter("tissue", "tdp_tissue"), "SELECT 1", predicates
+    )
+    assert sql_text.startswith(
+        "SELECT COUNT(*) FILTER (WHERE (j0.score lt_1)) AS size_0, COUNT(*) FILTER (WHERE (j0.score gte_1)) AS size_1"
+    )
+    assert sql_text.count("JOIN (") == 1
+
+
+def test_compile_restricted_to_the_parent_ids():
+    cohort_filter = CohortFilter("tissue", "tdp_tissue", [{"type": FILTER_NUM, "attribute": "age", "ranges": "gt_2"}])
+
+    sql_text = FilterCompiler(ClauseStub(), "tissuename", "error").compile(
+        cohort_filter, "base.tissuename", "base.tissuename::varchar = ANY(:parent_ids_0)"
+    )
+    assert sql_text == (
+        "SELECT base.tissuename FROM tissue.tdp_tissue base WHERE base.tissuename::varchar = ANY(:parent_ids_0) AND (base.age gt_2)"
+    )
@@ -0,0 +1,31 @@
+import threading
+import time
+
+import pytest
+
+from coral.sql_parallel import ParallelExecutor
+
+
+def test_results_keep_the_order_and_the_request_limit():
+    executor = ParallelExecutor(max_workers=4, request_limit=2)
+    lock = threading.Lock()
+    running = []
+    peak = []
+
+    def square(n):
+        with lock:
+            running.append(n)
+            peak.append(len(running))
+        time.sleep(0.01)
+        with lock:
+            running.remove(n)
+        return n * n
+
+    assert executor.map(square, range(6)) == [0, 1, 4, 9, 16, 25]
+    assert max(peak) == 2
+
+    def fail(n):
+        raise RuntimeError("query {n} failed".format(n=n))
+
+    with pytest.raises(RuntimeError):
+        executor.map(fail, range(3))
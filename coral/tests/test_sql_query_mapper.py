@@ -0,0 +1,111 @@
+import pytest
+
+from coral.sql_bitmap import EntityDictionary, cohort_bitmaps
+from coral.sql_query_mapper import SET_OPERATION_DIFFERENCE, QueryElements
+from coral.sql_tables import Cohort
+
+
+def test_num_hist_adds_empty_bins_and_merges_the_max_bin():
+    query = QueryElements.__new__(QueryElements)  # the formatting does not need a database
+    rows = [
+        {"bin": 1, "min": 0, "max": 4, "count": 2},
+        {"bin": 5, "min": 0, "max": 4, "count": 1},
+        {"bin": None, "min": 0, "max": 4, "count": 3},
+    ]
+    # the bins of the statement come first, in their order, the empty bins are appended
+    assert query.format_num_hist_dict(rows, 4) == [
+        {"bin": "[0, 1)", "count": 2, "index": 1},
+        {"bin": None, "count": 3, "index": None},
+        {"bin": "[1, 2)", "count": 0, "index": 2},
+        {"bin": "[2, 3)", "count": 0, "index": 3},
+        {"bin": "[3, 4]", "count": 1, "index": 4},
+    ]
+    rows = [{"bin": 0, "min": 0, "max": 4, "count": 1}, {"bin": 2, "min": 0, "max": 4, "count": 5}]
+    assert query.format_num_hist_dict(rows, 2) == [
+        {"bin": "[-2, 0)", "count": 1, "index": 0},
+        {"bin": "[2, 4]", "count": 5, "index": 2},
+        {"bin": "[0, 2)", "count": 0, "index": 1},
+        {"bin": None, "count": 0, "index": None},
+    ]
+
+
+def test_quantile_hist_uses_the_edges_of_the_statement():
+    query = QueryElements.__new__(QueryElements)
+    rows = [{"bin": 2, "edges": [1.0, 2.5, 7.0], "count": 5}]
+    assert query.format_num_hist_dict(rows, 2) == [
+        {"bin": "[1, 2.5)", "count": 0, "index": 1},
+        {"bin": "[2.5, 7]", "count": 5, "index": 2},
+        {"bin": None, "count": 0, "index": None},
+    ]
+
+
+def test_difference_of_cohorts_from_their_bitmaps(monkeypatch):
+    query = QueryElements.__new__(QueryElements)
+    dictionary = EntityDictionary(("tdp_publicdb", "tissue", "tdp_tissue"))
+    for position, entity_id in enumerate(["T1", "T2", "T3", "T4"]):
+        dictionary.add(entity_id, position)
+    cohorts = [
+        Cohort(id=index, entity_database="tdp_publicdb", entity_schema="tissue", entity_table="tdp_tissue", statement=statement)
+        for index, statement in [(1, "SELECT * FROM tissue.tdp_tissue"), (2, "SELECT * FROM tissue.tdp_tissue WHERE age < 40")]
+    ]
+    bitmaps = [dictionary.get_bitmap(["T1", "T2", "T3"]), dictionary.get_bitmap(["T2"])]
+    monkeypatch.setattr(query, "get_cohort_bitmaps", lambda args, error_msg, min_cohorts: (cohorts, bitmaps))
+    monkeypatch.setattr(cohort_bitmaps, "get_entity_ids", lambda query, cohort, bitmap: dictionary.get_entity_ids(bitmap))
+
+    new_cohort, entity_ids = query.create_cohort_set_operation({"name": "rest"}, SET_OPERATION_DIFFERENCE, "error")
+    assert entity_ids == ["T1", "T3"]
+    assert new_cohort.previous_cohort == 1
+    assert new_cohort.statement == (
+        "SELECT base.* FROM tissue.tdp_tissue base WHERE base.tissuename IN ("
+        "SELECT c0.tissuename FROM (SELECT * FROM tissue.tdp_tissue) c0 EXCEPT "
+        "SELECT c1.tissuename FROM (SELECT * FROM tissue.tdp_tissue WHERE age < 40) c1)"
+    )
+
+
+def request_query(monkeypatch, rows, cohort_database):
+    # QueryElements of one request, with the results of its statements instead of a database
+    query = QueryElements.__new__(QueryElements)
+    query.sql_params, query.shared_entities, query.cohort_entity_ids, query.stored_memberships = {}, {}, {}, {}
+    query.executed = []
+
+    def execute_sql_query_as_dict(sql_text, database, params=None):
+        query.executed.append(sql_text)
+        return rows
+
+    monkeypatch.setattr(query, "execute_sql_query_as_dict", execute_sql_query_as_dict)
+    monkeypatch.setattr(query, "is_cohort_database", lambda database: cohort_database)
+    return query
+
+
+def test_stored_members_are_read_once_per_request(monkeypatch):
+    cohort = Cohort(id=7, is_initial=0, size=2, entity_database="tdp_publicdb", entity_schema="tissue", entity_table="tdp_tissue")
+
+    query = request_query(monkeypatch, [{"entity_id": "T1"}, {"entity_id": "T2"}], cohort_database=False)
+    assert (
+        query.get_cohort_entities_sql(cohort, ["age"])
+        == "SELECT e.age FROM tissue.tdp_tissue e WHERE e.tissuename::varchar = ANY(:cohort_ids_7)"
+    )
+    query.get_cohort_entities_sql(cohort)
+    assert query.sql_params == {"cohort_ids_7": ["T1", "T2"]}
+    assert len(query.executed) == 1
+
+    # the membership is joined if the cohorts are in the entity database
+    query = request_query(monkeypatch, [{"stored": True}], cohort_database=True)
+    assert query.get_cohort_entities_sql(cohort) == (
+        "SELECT e.* FROM tissue.tdp_tissue e WHERE e.tissuename::varchar IN "
+        "(SELECT ce.entity_id FROM cohort.cohort_entity ce WHERE ce.cohort_id = 7)"
+    )
+    query.get_cohort_entities_sql(cohort)
+    assert query.sql_params == {}
+    assert len(query.executed) == 1
+
+
+def test_entity_id_columns_of_the_samples_and_panels():
+    query = QueryElements.__new__(QueryElements)
+    assert query.get_sample_id_col("tdp_cellline", "error") == "celllinename"
+    assert query.get_panel_columns("tdp_gene", "error") == ("ensg", "tdp_geneassignment")
+    assert query.get_panel_columns("tdp_tissue_2", "error") == ("tissuename", "tdp_panelassignment")
+    with pytest.raises(RuntimeError, match="error"):
+        query.get_sample_id_col("tdp_gene", "error")
+    with pytest.raises(RuntimeError, match="error"):
+        query.get_panel_columns("korea", "error")
@@ -0,0 +1,21 @@
+import datetime
+import decimal
+import json
+
+from coral.sql_response import RowDecoder, dumps_json
+
+
+class FakeResult:
+    def __init__(self, description):
+        self.cursor = type("Cursor", (), {"description": description})()
+
+    def keys(self):
+        return [column[0] for column in self.cursor.description]
+
+
+def test_numeric_columns_are_converted_and_dates_encoded_as_iso():
+    decoder = RowDecoder(FakeResult([("id", 1043), ("score", 1700), ("day", 1082)]))
+    rows = decoder.decode([("a", decimal.Decimal("1.5"), datetime.date(2020, 1, 2)), ("b", None, None)])
+    assert rows == [{"id": "a", "score": 1.5, "day": datetime.date(2020, 1, 2)}, {"id": "b", "score": None, "day": None}]
+    assert json.loads(dumps_json(rows)) == [{"id": "a", "score": 1.5, "day": "2020-01-02"}, {"id": "b", "score": None, "day": None}]
+    assert decoder.decode([]) == []
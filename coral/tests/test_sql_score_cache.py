@@ -0,0 +1,57 @@
+from sqlalchemy import text
+
+from coral.sql_cache import invalidate_results
+from coral.sql_score_cache import ScoreVector, array_literal, config, score_vectors
+
+TPM = {"table": "expression", "attribute": "tpm", "ensg": "ENSG1"}
+
+
+def test_vector_is_intersected_with_the_cohort_ids():
+    vector = ScoreVector(["A", "B", "B", "D"], ["1.5", "2", None, "-0.25"], "real")
+    cohort_vector = vector.intersect(["D", "B", "C", "B"])
+    assert cohort_vector.entity_ids == ["B", "B", "D"]
+    assert cohort_vector.scores == ["2", None, "-0.25"]
+    assert cohort_vector.score_type == "real"
+    assert cohort_vector.array_literals() == ('{"B","B","D"}', '{"2",NULL,"-0.25"}')
+
+
+def test_array_literal_escapes_the_values():
+    assert array_literal([]) == "{}"
+    assert array_literal(['say "hi"', "back\\slash", "NULL", None]) == '{"say \\"hi\\"","back\\\\slash","NULL",NULL}'
+
+
+def test_cached_scores_equal_the_scores_of_the_table(monkeypatch, db_get, root_cohort):
+    old = db_get("createUseNumFilter", cohortId=root_cohort, name="Old", attribute="age", ranges="gte_40")[0]
+    db_get("refreshStats")
+
+    def scores(cohort_id):
+        invalidate_results()
+        return sorted((row["tissuename"], row["score"]) for row in db_get("geneScore", cohortId=cohort_id, **TPM))
+
+    cached = [scores(root_cohort), scores(old)]
+    assert score_vectors.stats()["entries"] == 1
+    assert [len(cohort_scores) for cohort_scores in cached] == [30, 9]
+    assert cached[0][:7] == [("T01", 1.5), ("T02", 3), ("T03", 4.5), ("T04", 6), ("T05", 7.5), ("T06", 9), ("T07", None)]
+
+    monkeypatch.setattr(config, "score_cache_enabled", False)
+    assert [scores(root_cohort), scores(old)] == cached
+
+
+def test_updated_gene_scores_are_loaded_again_on_refresh(entity_db, db_get, root_cohort):
+    def score(tissuename):
+        invalidate_results()
+        return {row["tissuename"]: row["score"] for row in db_get("geneScore", cohortId=root_cohort, **TPM)}[tissuename]
+
+    db_get("refreshStats")
+    assert score("T01") == 1.5
+    try:
+        with entity_db.begin() as connection:
+            connection.execute(text("UPDATE tissue.tdp_expression SET tpm = 99 WHERE tissuename = 'T01' AND ensg = 'ENSG1'"))
+        assert score("T01") == 1.5  # the vector of the gene is cached until the refresh
+
+        db_get("refreshStats")
+        assert score("T01") == 99
+    finally:
+        with entity_db.begin() as connection:
+            connection.execute(text("UPDATE tissue.tdp_expression SET tpm = 1.5 WHERE tissuename = 'T01' AND ensg = 'ENSG1'"))
+        db_get("refreshStats")
@@ -0,0 +1,79 @@
+from sqlalchemy import text
+
+from coral.sql_cache import invalidate_results
+from coral.sql_stats import StatisticsCatalog, stats_catalog
+
+
+class CohortStub:
+    entity_database = "tdp_publicdb"
+    entity_schema = "tissue"
+    entity_table = "tdp_tissue"
+
+
+class QueryStub:
+    def __init__(self, rows):
+        self.rows = rows
+        self.executed = []
+
+    def execute_sql_query_as_dict(self, sql_text, database, supplemental_data=False, custom_statement_timeout=None):
+        self.executed.append(sql_text)
+        return self.rows
+
+
+def test_categories_are_computed_once_until_refresh():
+    catalog = StatisticsCatalog(max_age=60)
+    query = QueryStub([{"cat": "female", "count": 3}, {"cat": "null", "count": 2}])
+
+    stats = catalog.get_attribute_categories(query, CohortStub(), "gender")
+    assert stats == {"categories": ["female", "null"], "nulls": 2}
+    catalog.get_attribute_categories(query, CohortStub(), "gender")
+    assert len(query.executed) == 1
+
+    catalog.refresh()
+    catalog.get_attribute_categories(query, CohortStub(), "gender")
+    assert len(query.executed) == 2
+
+
+def test_range_keeps_the_column_type():
+    catalog = StatisticsCatalog(max_age=0)  # every request computes the statistics again
+    query = QueryStub([{"min": "0.5", "max": "9.25", "type": "real", "nulls": 1}])
+
+    stats = catalog.get_attribute_range(query, CohortStub(), "bmi")
+    assert stats["type"] == "real"
+    assert "MIN(c.score)::text" in query.executed[0]
+    catalog.get_attribute_range(query, CohortStub(), "bmi")
+    assert len(query.executed) == 2
+
+
+def test_histograms_use_the_statistics_until_refresh(entity_db, db_get, root_cohort):
+    def bins(attribute):
+        return [(row["bin"], row["count"]) for row in db_get("hist", cohortId=root_cohort, type="dataNum", attribute=attribute, bins=3)]
+
+    db_get("refreshStats")
+    weights = bins("weight")
+    assert weights == [
+        ("[50.5, 55.333333333333336)", 10),
+        ("[55.333333333333336, 60.166666666666664)", 10),
+        ("[60.166666666666664, 65]", 10),
+        (None, 0),
+    ]
+    assert stats_catalog.summary()[0]["stats"] == {"min": "50.5", "max": "65.0", "type": "numeric", "nulls": 0}
+
+    try:
+        with entity_db.begin() as connection:
+            connection.execute(text("UPDATE tissue.tdp_tissue SET weight = 80 WHERE tissuename = 'T30'"))
+        invalidate_results()
+        assert bins("weight")[:3] == weights[:3]  # the range is computed once over the whole table, not for every histogram
+
+        assert db_get("refreshStats") == {"statistics": 0}
+        assert bins("weight") == [
+            ("[50.5, 60.333333333333336)", 20),
+            ("[60.333333333333336, 70.16666666666667)", 9),
+            ("[70.16666666666667, 80]", 1),
+            (None, 0),
+        ]
+        assert stats_catalog.summary()[0]["stats"]["max"] == "80.0"
+    finally:
+        with entity_db.begin() as connection:
+            connection.execute(text("UPDATE tissue.tdp_tissue SET weight = 65 WHERE tissuename = 'T30'"))
+        db_get("refreshStats")
@@ -0,0 +1,76 @@
+import threading
+
+from sqlalchemy import text
+
+from coral import sql_query_mapper
+from coral.sql_query_mapper import QueryElements
+from coral.sql_treatment import TREATMENT_TABLE, TreatmentTables, treatment_rows_sql, treatment_tables
+
+TISSUE_TREATMENTS = {"database": "tdp_publicdb", "schema": "tissue", "table": "tdp_tissue"}
+
+
+class LookupQuery(QueryElements):
+    def __init__(self, exists):
+        self.exists = exists
+        self.executed = []
+
+    def execute_sql_query_as_dict(self, sql_text, database, supplemental_data=False, custom_statement_timeout=None, params=None):
+        self.executed.append(params["name"])
+        return [{"exists": self.exists}]
+
+
+def test_missing_treatment_table_falls_back_to_the_json(monkeypatch):
+    tables = TreatmentTables(recheck_interval=60)
+    query = LookupQuery(exists=False)
+    assert tables.get_table(query, "tdp_publicdb", "tissue", "tdp_tissue", "tissuename") is None
+    assert tables.get_table(query, "tdp_publicdb", "tissue", "tdp_tissue", "tissuename") is None
+    assert query.executed == ["tissue.coral_tdp_tissue_treatment"]  # looked up again after the recheck interval
+
+    monkeypatch.setattr(sql_query_mapper, "treatment_tables", tables)
+    sql_text = query.treatment_filter_statement("Cisplatin", "1", "true", "tissue", "tdp_tissue", "tissuename", "tdp_publicdb")
+    assert "FROM ({rows}) tmp".format(rows=treatment_rows_sql("tissue", "tdp_tissue", "tissuename")) in sql_text
+    assert "tmp.agents @> " in sql_text
+    assert "tmp.regimen_number = 1" in sql_text
+
+
+def test_treatment_table_is_only_built_by_the_refresh(entity_db, db_get, root_cohort):
+    name = TREATMENT_TABLE.format(schema="tissue", table="tdp_tissue")
+    with entity_db.begin() as connection:
+        connection.execute(text("DROP TABLE IF EXISTS {name}".format(name=name)))
+    treatment_tables.tables.clear()
+
+    def table_exists():
+        with entity_db.connect() as connection:
+            return connection.execute(text("SELECT to_regclass(:name) IS NOT NULL"), {"name": name}).scalar()
+
+    def create_cohorts():
+        # the sizes of the new cohorts are evaluated on the members of their parents, with the treatment table if it exists
+        cisplatin = db_get(
+            "createUseTreatmentFilter", cohortId=root_cohort, name="Cisplatin", agent="Cisplatin", regimen="1", baseAgent="true"
+        )[0]
+        paclitaxel = db_get("createUseTreatmentFilter", cohortId=cisplatin, name="Paclitaxel", agent="Paclitaxel", baseAgent="false")[0]
+        return [cisplatin, paclitaxel], [db_get("size", cohortId=cisplatin), db_get("size", cohortId=paclitaxel)]
+
+    _ids, sizes = create_cohorts()
+    assert sizes == [[{"size": 24}], [{"size": 12}]]
+    assert not table_exists()  # the requests only look it up
+
+    # concurrent builds wait for each other, each replaces the table
+    built = []
+    builders = [
+        threading.Thread(target=lambda: built.append(treatment_tables.build("tdp_publicdb", "tissue", "tdp_tissue", "tissuename")))
+        for _ in range(3)
+    ]
+    for builder in builders:
+        builder.start()
+    for builder in builders:
+        builder.join()
+    assert built == [name] * 3
+    assert db_get("refreshTreatments", **TISSUE_TREATMENTS) == {"tables": [name]}
+
+    ids, table_sizes = create_cohorts()
+    assert table_sizes == sizes
+    with entity_db.connect() as connection:
+        statements = connection.execute(text("SELECT statement FROM cohort.cohort WHERE id = ANY(:ids)"), {"ids": ids}).scalars().all()
+    assert len(statements) == 2
+    assert all(name not in statement for statement in statements)  # the stored statements do not depend on the table